@@ -1,44 +1,252 @@
-import sys
+"""
+医療記録の一括分析CLI
+
+患者IDのハッシュで患者をシャードに分割し、各シャードを独立に分析して部分結果ファイルに保存した後、
+merge で1つの分析結果にまとめる。1台のマシンではローカルのワーカープロセスでシャードを並列に処理し、
+複数のマシンでは共有ファイルシステム上の同じ --parts-dir を指定して --shard-index でシャードを分担する。
+
+既定では全テンプレートを患者ごとに1回のLLM呼び出しでまとめて分析する（analyze_with_templates）。
+テンプレートごとに個別に呼び出す場合（以前の既定の動作）は --no-fused を指定する。
+
+シャードに分割する場合、LLM応答キャッシュはシャードごとに別のファイル（--cache-path の名前にシャード番号を付けたもの）
+とし、複数のプロセス・ノードが同じSQLiteファイルに書き込まないようにする。プロバイダーのレート制限は
+同時に実行するプロセス数（--processes、複数ノードの場合は --num-nodes。省略時は --num-shards）で分割する。
+
+使い方:
+    # 1プロセスで全患者を分析
+    python analyze_medical_records.py run --input data/sample_data.xlsx --output analyzed_results.xlsx
+
+    # 8シャードを4つのワーカープロセスで分析し、最後にまとめる
+    python analyze_medical_records.py run --input cohort.parquet --output analyzed_results.parquet --num-shards 8 --processes 4
+
+    # 複数ノードで分担する場合（各ノードで担当のシャード番号を指定し、全シャードの完了後に merge を実行）
+    # 4ノードで同時に実行する場合は --num-nodes 4 でレート制限を4分割する
+    python analyze_medical_records.py run --input /shared/cohort.parquet --output /shared/analyzed_results.parquet --num-shards 8 --shard-index 3 --num-nodes 4
+    python analyze_medical_records.py merge --output /shared/analyzed_results.parquet --num-shards 8
+"""
+import argparse
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 from analyzer import ExcelAnalyzer
+from analyzer.backends import BACKENDS, get_backend_class
+from analyzer.response_cache import ResponseCache
+from analyzer.sharding import find_partial_results, missing_shards, partial_result_path
+
+# 既定で分析するテンプレート
+DEFAULT_TEMPLATES = [
+    "cancer_diagnosis",
+    "cancer_stage",
+    "diagnostic_test",
+    "first_treatment",
+    "chemotherapy_info",
+    "surgery_type",
+    "special_notes"
+]
+
 
-def main():
-    # サンプルデータのパスを指定
-    sample_data_path = "data/sample_data.xlsx"
-    
-    # ExcelAnalyzerのインスタンスを作成
+def default_parts_dir(output_path: str) -> str:
+    """部分結果ファイルの既定の保存先（出力ファイルと同じ場所の <出力ファイル名>_parts）"""
+    return os.path.splitext(output_path)[0] + "_parts"
+
+
+def shard_cache_path(cache_path: str, shard_index: int) -> str:
+    """シャードごとのLLM応答キャッシュのパス（例: responses.sqlite → responses-shard00003.sqlite）"""
+    base, ext = os.path.splitext(cache_path)
+    return f"{base}-shard{shard_index:05d}{ext}"
+
+
+def create_analyzer(args, processes: int = 1, shard_index: Optional[int] = None) -> ExcelAnalyzer:
+    """
+    コマンドライン引数からExcelAnalyzerを作成する
+
+    Parameters:
+    - processes: 同時に実行するプロセス数（全ノードの合計）。プロバイダーのレート制限はプロセスごとに
+      管理されるため、既定のレート制限をプロセス数で分割する
+    - shard_index: シャードを分析する場合のシャード番号。LLM応答キャッシュはシャードごとのファイルとし、
+      共有ファイルシステム上でも使えるようWALを使用しない
+    """
+    rate_limits = None
+    if processes > 1:
+        rate_limits = {
+            name: value / processes
+            for name, value in get_backend_class(args.provider).default_rate_limits.items() if value
+        }
+    response_cache = None
+    if args.cache_path and shard_index is not None:
+        response_cache = ResponseCache(shard_cache_path(args.cache_path, shard_index), journal_mode="DELETE")
     analyzer = ExcelAnalyzer(
-        llm_server_url="http://localhost:8000/v1",
-        template_path="templates/prompt_templates.json"
+        llm_server_url=args.server_url,
+        template_path=args.template_path,
+        provider=args.provider,
+        max_workers=args.max_workers,
+        rate_limits=rate_limits,
+        cache_path=args.cache_path,
+        budget_usd=args.budget_usd,
+        use_async=args.use_async,
+        response_cache=response_cache
     )
-    
-    # サンプルデータの読み込み
-    if not analyzer.load_excel(sample_data_path):
-        print(f"エラー: {sample_data_path} の読み込みに失敗しました")
-        return
-    
-    # データの基本情報を表示
+    if args.model:
+        analyzer.set_model(args.model)
+    analyzer.set_column_mapping(args.id_column, args.date_column, args.text_column)
+    return analyzer
+
+
+def analyze(args, output_path: str, shard_index: Optional[int] = None, num_shards: int = 1, processes: int = 1) -> bool:
+    """
+    入力ファイルを読み込み（シャードを指定した場合はその患者のみに絞り込み）、分析して結果を保存する
+
+    シャードの部分結果は全テンプレートの分析が完了した場合のみ保存する（1つの出力ファイルに保存する場合は、
+    未完了でも得られた結果を保存する）
+
+    Returns:
+    - bool: 全テンプレートの分析が完了し、結果を保存できた場合はTrue
+    """
+    analyzer = create_analyzer(args, processes, shard_index)
+
+    # 選択された3列のみをストリーミングで読み込む
+    if not analyzer.load_excel(args.input, mapped_columns_only=True):
+        print(f"エラー: {args.input} の読み込みに失敗しました")
+        return False
+    if shard_index is not None and not analyzer.select_shard(shard_index, num_shards):
+        return False
     analyzer.display_data_info()
-    
-    # 各テンプレートを使用して分析を実行
-    templates_to_analyze = [
-        "cancer_diagnosis",
-        "cancer_stage",
-        "diagnostic_test",
-        "first_treatment",
-        "chemotherapy_info",
-        "surgery_type",
-        "special_notes"
-    ]
-    
-    for template_key in templates_to_analyze:
-        print(f"\n{template_key}の分析を開始します...")
-        analyzer.analyze_with_template(template_key)
-    
+
+    # 前回の分析結果と比較し、新規・変更された患者のみを分析する
+    if args.previous and not analyzer.load_previous_results(args.previous):
+        return False
+
+    if args.fused:
+        # 全テンプレートを患者ごとに1回のLLM呼び出しでまとめて分析
+        print(f"\n{', '.join(args.templates)}の分析を開始します...")
+        summary = analyzer.analyze_with_templates(args.templates)
+    else:
+        summary = {}
+        for template_key in args.templates:
+            print(f"\n{template_key}の分析を開始します...")
+            summary[template_key] = analyzer.analyze_with_template(template_key)
+
+    completed = all(result.get("success") for result in summary.values())
+    if shard_index is not None and not completed:
+        # 部分結果ファイルの有無で完了を判定するため（--skip-existing・merge）、未完了のシャードは保存しない
+        failed = [key for key, result in summary.items() if not result.get("success")]
+        print(f"エラー: シャード {shard_index} の {', '.join(failed)} の分析が完了しなかったため、部分結果を保存しません")
+        return False
+
     # 分析結果を保存
-    analyzer.save_results("analyzed_results.xlsx")
+    saved = analyzer.save_results(output_path)
+    return saved and completed
+
+
+def run_shard(args, shard_index: int, processes: int) -> bool:
+    """1つのシャードを分析して部分結果ファイルに保存する（ワーカープロセスから呼び出される）"""
+    path = partial_result_path(args.parts_dir, shard_index, args.num_shards)
+    print(f"\nシャード {shard_index + 1}/{args.num_shards} の分析を開始します（出力: {path}）")
+    return analyze(args, path, shard_index, args.num_shards, processes)
+
+
+def command_run(args) -> int:
+    """run サブコマンド: 全体またはシャード単位で分析する"""
+    args.parts_dir = args.parts_dir or default_parts_dir(args.output)
+
+    if args.num_shards == 1 and args.shard_index is None:
+        return 0 if analyze(args, args.output) else 1
+
+    os.makedirs(args.parts_dir, exist_ok=True)
+    if args.shard_index is not None:
+        # このノードの担当のシャードのみを分析する（まとめは全ノードの完了後に merge で行う）。
+        # 他のノードも同時に同じプロバイダーを呼び出すため、レート制限は同時に実行するノード数で分割する
+        return 0 if run_shard(args, args.shard_index, args.num_nodes or args.num_shards) else 1
+
+    shard_indices = list(range(args.num_shards))
+    if args.skip_existing:
+        # 部分結果が保存済みのシャード（中断前に完了したもの）は再実行しない
+        shard_indices = missing_shards(args.parts_dir, args.num_shards)
+        print(f"部分結果が保存済みのシャードを除き、{len(shard_indices)}件のシャードを分析します")
+
+    processes = max(1, min(args.processes, len(shard_indices) or 1))
+    if processes == 1:
+        results = [run_shard(args, shard_index, 1) for shard_index in shard_indices]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(run_shard, args, shard_index, processes) for shard_index in shard_indices]
+            results = [future.result() for future in futures]
+
+    failed = [shard_index for shard_index, ok in zip(shard_indices, results) if not ok]
+    if failed:
+        print(f"エラー: シャード {', '.join(str(index) for index in failed)} の分析が完了しませんでした。"
+              f"--skip-existing を指定して再実行すると、完了したシャードは省略されます")
+        return 1
+    return command_merge(args)
+
+
+def command_merge(args) -> int:
+    """merge サブコマンド: 全シャードの部分結果を1つの分析結果にまとめる"""
+    parts_dir = args.parts_dir or default_parts_dir(args.output)
+    missing = missing_shards(parts_dir, args.num_shards)
+    if missing:
+        print(f"エラー: シャード {', '.join(str(index) for index in missing)} の部分結果が '{parts_dir}' にありません")
+        return 1
+    partial_paths = [path for _, path in sorted(find_partial_results(parts_dir, args.num_shards).items())]
+    return 0 if ExcelAnalyzer.merge_results(partial_paths, args.output, id_column=args.id_column) else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """コマンドライン引数の定義"""
+    parser = argparse.ArgumentParser(description="医療記録の一括分析（シャード単位の並列・分散実行に対応）")
+    subparsers = parser.add_subparsers(dest="command")
+
+    shared = argparse.ArgumentParser(add_help=False)
+    shared.add_argument("--output", default="analyzed_results.xlsx", help="分析結果の保存先（形式は拡張子から判定）")
+    shared.add_argument("--num-shards", type=int, default=1, help="患者を分割するシャード数")
+    shared.add_argument("--parts-dir", default=None, help="部分結果ファイルの保存先（既定: <出力ファイル名>_parts）")
+    shared.add_argument("--id-column", default="ID", help="患者IDの列名")
+
+    run = subparsers.add_parser("run", parents=[shared], help="分析を実行する")
+    run.add_argument("--input", default="data/sample_data.xlsx", help="入力ファイル（.xlsx / .csv / .parquet / .feather）")
+    run.add_argument("--date-column", default="day", help="日付の列名")
+    run.add_argument("--text-column", default="text", help="テキストの列名")
+    run.add_argument("--templates", nargs="+", default=DEFAULT_TEMPLATES, help="分析するテンプレートキー")
+    run.add_argument("--template-path", default="templates/prompt_templates.json", help="テンプレートファイルのパス")
+    run.add_argument("--provider", default="vllm", choices=list(BACKENDS), help="LLMプロバイダー")
+    run.add_argument("--server-url", default="http://localhost:8000/v1",
+                     help="vLLMサーバーのURL（複数のサーバーはカンマ区切り）")
+    run.add_argument("--model", default=None, help="使用するモデル（省略時はプロバイダーの既定値）")
+    run.add_argument("--max-workers", type=int, default=1, help="1プロセス内のLLM呼び出しの同時実行数")
+    run.add_argument("--use-async", action="store_true", help="非同期クライアントで同時実行する")
+    run.add_argument("--cache-path", default=".llm_cache/responses.sqlite",
+                     help="LLM応答キャッシュのパス（シャードに分割する場合はシャード番号を付けたファイルを使用する）")
+    run.add_argument("--budget-usd", type=float, default=None, help="料金の上限（USD、プロセスごと）")
+    run.add_argument("--no-fused", dest="fused", action="store_false",
+                     help="テンプレートをまとめず、テンプレートごとにLLMを呼び出す")
+    run.add_argument("--previous", default=None,
+                     help="前回の分析結果ファイル。指定した場合は新規・変更された患者のみを分析する")
+    run.add_argument("--shard-index", type=int, default=None,
+                     help="このプロセスで分析するシャード番号（0始まり）。複数ノードで分担する場合に指定する")
+    run.add_argument("--num-nodes", type=int, default=None,
+                     help="--shard-index で同時に実行するノード数（レート制限をこの数で分割する。省略時は --num-shards）")
+    run.add_argument("--processes", type=int, default=1, help="シャードを並列に処理するローカルのワーカープロセス数")
+    run.add_argument("--skip-existing", action="store_true", help="部分結果が保存済みのシャードを再実行しない")
+    run.set_defaults(handler=command_run)
+
+    merge = subparsers.add_parser("merge", parents=[shared], help="シャードごとの部分結果をまとめる")
+    merge.set_defaults(handler=command_merge)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in ("run", "merge", "-h", "--help"):
+        # サブコマンドを省略した場合は run として実行する
+        argv = ["run", *argv]
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main())
@@ -2,29 +2,145 @@ import streamlit as st
 import os
 import sys
 import json
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 from analyzer import ExcelAnalyzer 
+from analyzer.excel_analyzer import FINGERPRINT_SUFFIX
+from analyzer.backends import BACKENDS, get_backend_class
+from analyzer.chunking import MERGE_STRATEGIES, infer_merge_strategy
+from analyzer.response_cache import ResponseCache
+from analyzer.jobs import AnalysisJob, JOB_CANCELLED, JOB_FAILED, JOB_RUNNING
 from data.data_generator import MedicalDataGenerator
 import pandas as pd
 import altair as alt
+from io import BytesIO
 
-def display_analysis_summary_streamlit(analyzer, analysis_columns):
+# 分析結果の保存先（アプリ内の読み書きはParquet、Excelはダウンロード用のエクスポートのみ）
+RESULTS_PATH = "analyzed_results.parquet"
+
+# 分析ジョブの進捗表示を更新する間隔（秒）
+JOB_POLL_INTERVAL_SEC = 1.0
+
+# モデル一覧のキャッシュの有効期間（秒）
+MODEL_LIST_TTL_SEC = 300
+
+# テンプレートの結果の統合方法（merge）の表示名
+MERGE_STRATEGY_LABELS = {
+    "latest": "最新の結果を採用（latest）",
+    "first": "最初の結果を採用（first）",
+    "all": "すべての結果を連結（all）"
+}
+
+def to_excel_bytes(df):
+    """データフレームをダウンロード用のExcelバイト列に変換する"""
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+def _write_upload(suffix, content):
+    """アップロードされたファイルを一時保存してパスを返す（形式判定のため拡張子は維持する）"""
+    temp_path = "temp" + suffix
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    return temp_path
+
+# 以下のキャッシュにより、ウィジェット操作による再実行ではファイルの解析・テンプレートの読み込み・
+# モデル一覧の取得・バックエンドと応答キャッシュの作成を繰り返さない
+# （データフレームは複製を避けるため st.cache_resource で共有し、読み取り専用として扱う）
+
+def upload_cache_key(uploaded_file):
+    """アップロードされたファイルのキャッシュのキー（内容を読んでハッシュを計算しないよう、file_idとサイズを使用する）"""
+    return uploaded_file.file_id, uploaded_file.size
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_upload_columns(upload_key, suffix, _uploaded_file):
+    """アップロードされたファイルの列名を読み込む（アップロードごとにキャッシュ）"""
+    return ExcelAnalyzer.read_columns(_write_upload(suffix, _uploaded_file.getvalue()))
+
+@st.cache_resource(show_spinner="ファイルを読み込み中...", max_entries=8)
+def load_upload_frame(upload_key, suffix, id_column, date_column, text_column, _analyzer, _uploaded_file):
+    """
+    アップロードされたファイルから選択された3列を読み込み、患者IDごとにテキストを結合する（アップロードと列の選択ごとにキャッシュ）
+    
+    Parameters:
+    - upload_key: upload_cache_key の値（キャッシュのキー）
+    - id_column, date_column, text_column: 選択された列（キャッシュのキー）
+    - _analyzer: 読み込みに使用するExcelAnalyzer（列マッピングを設定済みのもの）
+    - _uploaded_file: アップロードされたファイル（キャッシュにない場合のみ内容を読む）
+    
+    Returns:
+    - (DataFrame, 結合テキスト)。必須列がない場合などは (None, None)。
+      再実行間で同じオブジェクトを共有するため変更しないこと（分析ジョブにはデータフレームの複製を渡す）。
+      再実行ごとに作成されるExcelAnalyzerには set_data で結合テキストとともに渡し、結合を繰り返さない
+    """
+    if not _analyzer.load_excel(_write_upload(suffix, _uploaded_file.getvalue()), mapped_columns_only=True):
+        return None, None
+    return _analyzer.df, dict(_analyzer.combined_texts)
+
+@st.cache_resource(show_spinner=False)
+def get_shared_backend(provider, llm_server_url, api_key, backend_options_items):
+    """
+    接続設定ごとにバックエンドを1つだけ作成して共有する
+    （Geminiのキャッシュ済みコンテンツなどのバックエンドの状態を再実行・分析ジョブの間で引き継ぐ）
+    """
+    return ExcelAnalyzer(
+        llm_server_url=llm_server_url,
+        provider=provider,
+        api_key=api_key,
+        backend_options=dict(backend_options_items)
+    ).backend
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache(cache_path):
+    """LLM応答キャッシュをパスごとに1つだけ開いて共有する（期限切れの削除も最初の1回のみ行う）"""
+    return ResponseCache(cache_path)
+
+@st.cache_data(show_spinner=False)
+def load_template_file(template_path, modified_time):
+    """テンプレートファイルを読み込む（ファイルの更新時刻ごとにキャッシュするため、編集後は読み直される）"""
+    with open(template_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def get_templates(template_path):
+    """キャッシュを使用してテンプレートを取得する（読み込めない場合はNone）"""
+    try:
+        return load_template_file(template_path, os.path.getmtime(template_path))
+    except (OSError, json.JSONDecodeError):
+        return None
+
+@st.cache_data(show_spinner=False, ttl=MODEL_LIST_TTL_SEC)
+def list_available_models(provider, llm_server_url, api_key, backend_options_items):
+    """プロバイダーから利用可能なモデル一覧と既定のモデルを取得する（接続設定ごとに一定時間キャッシュ）"""
+    backend = get_shared_backend(provider, llm_server_url, api_key, backend_options_items)
+    try:
+        models = backend.list_models()
+    except Exception as e:
+        print(f"モデル一覧の取得に失敗しました: {str(e)}")
+        models = []
+    return models, backend.default_model
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def load_results_frame(results_path, modified_time):
+    """保存された分析結果を読み込む（ファイルの更新時刻ごとにキャッシュ。共有されるため変更しないこと）"""
+    return ExcelAnalyzer.read_results(results_path)
+
+def display_analysis_summary_streamlit(df, analysis_columns):
     """
     分析結果の概要をStreamlitで視覚的に表示する関数
     
     Parameters:
-    - analyzer: ExcelAnalyzerのインスタンス
+    - df: 分析結果のデータフレーム
     - analysis_columns: 分析結果の列名リスト
     """
     st.subheader("分析結果の概要")
     
     for col in analysis_columns:
         with st.expander(f"📊 {col}", expanded=True):
-            if analyzer.df[col].dtype == bool:
+            if df[col].dtype == bool:
                 # ブール型の列（バイナリ分析結果）の場合
-                true_count = analyzer.df[col].sum()
-                total_count = len(analyzer.df)
+                true_count = df[col].sum()
+                total_count = len(df)
                 percentage = (true_count / total_count) * 100
                 
                 # 進捗バーで表示
@@ -53,12 +169,12 @@ def display_analysis_summary_streamlit(analyzer, analysis_columns):
                 
             else:
                 # 文字列型の列（抽出・分類結果）の場合
-                value_counts = analyzer.df[col].value_counts()
-                na_count = analyzer.df[col].isna().sum() + (analyzer.df[col] == 'N/A').sum()
+                value_counts = df[col].value_counts()
+                na_count = df[col].isna().sum() + (df[col] == 'N/A').sum()
                 
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    st.metric("総データ数", f"{len(analyzer.df)}件")
+                    st.metric("総データ数", f"{len(df)}件")
                 with col2:
                     st.metric("ユニークな値の数", f"{len(value_counts)}種類")
                 with col3:
@@ -94,6 +210,181 @@ def display_analysis_summary_streamlit(analyzer, analysis_columns):
                     
                     st.altair_chart(pie_chart, use_container_width=True)
 
+def run_analysis_job(job, analyzer, selected_templates, fused_mode):
+    """
+    バックグラウンドのジョブで選択された分析を実行し、結果を保存する関数
+    （ワーカースレッドで実行されるため、Streamlitの描画は行わず job.update_progress で進捗を報告する）
+    
+    Parameters:
+    - job: 実行中のAnalysisJob
+    - analyzer: 分析に使用するExcelAnalyzerのインスタンス
+    - selected_templates: 実行するテンプレートのキーのリスト
+    - fused_mode: 選択した分析をまとめて実行するかどうか
+    """
+    analyzer.cancel_token = job.token
+
+    def make_progress_callback(template_name, template_index, total_templates):
+        def progress_callback(current_row, total_rows, result):
+            job.update_progress(template=template_name, template_index=template_index, total_templates=total_templates,
+                                current_row=current_row, total_rows=total_rows, latest_result=result)
+        return progress_callback
+
+    if fused_mode and len(selected_templates) > 1:
+        template_name = f"{len(selected_templates)}件の分析（まとめて実行）"
+        job.update_progress(template=template_name, template_index=1, total_templates=1, current_row=0, total_rows=0)
+        analyzer.analyze_with_templates(selected_templates, progress_callback=make_progress_callback(template_name, 1, 1))
+    else:
+        total_templates = len(selected_templates)
+        for i, template_key in enumerate(selected_templates):
+            # 停止が要求された場合は残りのテンプレートを実行しない
+            if job.token.cancelled:
+                break
+            template_name = analyzer.templates[template_key]["name"]
+            job.update_progress(template=template_name, template_index=i + 1, total_templates=total_templates,
+                                current_row=0, total_rows=0)
+            analyzer.analyze_with_template(
+                template_key, progress_callback=make_progress_callback(template_name, i + 1, total_templates)
+            )
+
+    # 停止した場合も、それまでの分析結果を保存する
+    job.update_progress(saving=True)
+    return analyzer.save_results(RESULTS_PATH)
+
+def show_job_progress(job):
+    """
+    実行中の分析ジョブの進捗と停止ボタンを表示する関数
+    （Streamlit 1.37以降ではこの部分だけを定期的に再実行して進捗を更新する）
+    """
+    snapshot = job.snapshot()
+    if snapshot["state"] != JOB_RUNNING:
+        # ジョブが終了したら、結果を表示するためにページ全体を再実行する
+        st.rerun()
+
+    total_templates = snapshot.get("total_templates") or 1
+    template_index = snapshot.get("template_index") or 1
+    total_rows = snapshot.get("total_rows") or 0
+    current_row = snapshot.get("current_row") or 0
+    row_ratio = current_row / total_rows if total_rows else 0.0
+    st.progress(min(1.0, (template_index - 1 + row_ratio) / total_templates))
+
+    if snapshot["cancel_requested"]:
+        st.warning("分析を停止しています...（実行中のLLM呼び出しが終わり次第停止します）")
+    elif snapshot.get("saving"):
+        st.write("分析結果を保存中...")
+    elif "template" in snapshot:
+        st.write(f"進捗: {template_index}/{total_templates} - {snapshot['template']}の分析中...")
+        if total_rows:
+            st.write(f"🔄 {total_rows}件中{current_row}件目を処理中 ({(row_ratio*100):.1f}%)")
+    st.caption(f"経過時間: {snapshot['elapsed_sec']:.0f}秒")
+
+    if snapshot.get("latest_result"):
+        st.write(f"""
+        **最新の分析結果:**
+        {json.dumps(snapshot['latest_result'], ensure_ascii=False, indent=2)}
+        """)
+
+    if st.button("分析を停止", type="secondary", disabled=snapshot["cancel_requested"]):
+        job.cancel()
+        st.rerun()
+
+# Streamlit 1.37以降は進捗表示の部分だけを定期的に再実行する（それ以前はページ全体を再実行する）
+if hasattr(st, "fragment"):
+    show_job_progress = st.fragment(run_every=JOB_POLL_INTERVAL_SEC)(show_job_progress)
+
+def display_run_results(analyzer, job, sample_id="すべて"):
+    """
+    分析ジョブの終了後に、そのジョブが保存した分析結果・使用量・計測値を表示する関数
+    
+    Parameters:
+    - analyzer: 分析に使用したExcelAnalyzerのインスタンス
+    - job: 終了した分析ジョブ（completed / cancelled）。結果は run_analysis_job が保存に成功した場合のみ表示する
+    - sample_id: 表示する患者ID（"すべて"の場合は全件）
+    """
+    # 保存前に停止・失敗した場合、RESULTS_PATH は前回の実行のものなので今回の結果として表示しない
+    if job.result is not True or not os.path.exists(RESULTS_PATH):
+        if job.state == JOB_CANCELLED:
+            st.error("分析が停止されましたが、結果は保存されませんでした。")
+        else:
+            st.error("分析結果が保存されていません")
+        if os.path.exists(RESULTS_PATH):
+            st.caption(f"'{RESULTS_PATH}' には前回の分析結果が残っています（今回の結果ではないため表示しません）")
+        return
+
+    # 分析結果の列を特定
+    analysis_columns = [col for col in analyzer.df.columns
+                        if col.startswith('分析結果_') and not col.endswith(FINGERPRINT_SUFFIX)]
+    
+    # 結合テキストを含む新しいデータフレームを読み込む
+    result_df = load_results_frame(RESULTS_PATH, os.path.getmtime(RESULTS_PATH))
+    
+    usage = analyzer.usage.summary()
+    if job.state == JOB_CANCELLED:
+        st.error("分析が停止されました。以下は停止時点までの分析結果です。")
+    elif analyzer.usage.budget_exceeded():
+        st.warning(f"予算上限（${usage['budget_usd']:.2f}）に達したため、一部の患者は未分析です。")
+    else:
+        st.success("すべての分析が完了しました！")
+    st.caption(
+        f"API呼び出し: {usage['requests']:,}回 / 入力 {usage['input_tokens']:,} トークン"
+        f"（うちキャッシュ読み込み {usage['cached_input_tokens']:,}） / "
+        f"出力 {usage['output_tokens']:,} トークン / 料金 ${usage['cost_usd']:.4f}"
+    )
+
+    # テンプレートごとの応答時間・スループットなどの計測値
+    metrics_summary = analyzer.metrics.summary()
+    if metrics_summary:
+        with st.expander("LLM呼び出しの計測値"):
+            st.dataframe(pd.DataFrame([
+                {
+                    "テンプレート": group["template"],
+                    "呼び出し": group["calls"],
+                    "エラー": group["errors"],
+                    "再試行": group["retries"],
+                    "キャッシュヒット": group["cache_hits"],
+                    "解析失敗": group["parse_failures"],
+                    "p50応答時間(秒)": group["latency_sec"]["p50"],
+                    "p95応答時間(秒)": group["latency_sec"]["p95"],
+                    "p99応答時間(秒)": group["latency_sec"]["p99"],
+                    "p95待機時間(秒)": group["queue_wait_sec"]["p95"],
+                    "スループット(件/秒)": group["throughput_per_sec"]
+                }
+                for group in metrics_summary
+            ]))
+            metrics_col1, metrics_col2 = st.columns(2)
+            metrics_col1.download_button("JSONでダウンロード", analyzer.metrics.to_json(),
+                                         file_name="llm_metrics.json", mime="application/json")
+            metrics_col2.download_button("Prometheus形式でダウンロード", analyzer.metrics.to_prometheus(),
+                                         file_name="llm_metrics.prom", mime="text/plain")
+
+    # 分析結果の概要を表示
+    if analysis_columns:
+        # 全体の分析結果概要
+        if sample_id == "すべて":
+            display_analysis_summary_streamlit(result_df, analysis_columns)
+        else:
+            # 特定IDの分析結果概要
+            st.subheader(f"ID: {sample_id} の分析結果概要")
+            display_analysis_summary_streamlit(
+                result_df[result_df[analyzer.column_mapping['id_column']] == sample_id], analysis_columns
+            )
+    
+    # 分析結果の表示
+    st.subheader("分析結果データ")
+    if sample_id != "すべて":
+        result_df = result_df[result_df[analyzer.column_mapping['id_column']] == sample_id]
+    
+    st.write("分析結果の一覧を表示します")
+    st.dataframe(result_df)
+
+    # 結果のダウンロード機能（Excel形式でエクスポート）
+    st.download_button(
+        label="分析結果をダウンロード",
+        data=to_excel_bytes(result_df),
+        file_name="analyzed_results.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        help="分析結果をExcelファイルとしてダウンロードできます"
+    )
+
 def main():
     # ページ設定 - アプリケーションのタイトルとレイアウトを設定
     st.set_page_config(
@@ -121,15 +412,15 @@ def main():
         # LLMプロバイダーの選択
         provider = st.selectbox(
             "LLMプロバイダー",
-            options=["vllm", "openai", "gemini", "claude", "deepseek"],
+            options=list(BACKENDS),
             help="使用するLLMプロバイダーを選択してください"
         )
         
-        # APIキーの入力（vllm以外の場合）
+        # APIキーの入力（APIキーが必要なプロバイダーの場合）
         api_key = None
-        if provider != "vllm":
+        if get_backend_class(provider).api_key_env:
             # 環境変数名を取得
-            env_var_name = ExcelAnalyzer.ENV_VAR_NAMES.get(provider)
+            env_var_name = get_backend_class(provider).api_key_env
             
             # デバッグ情報の表示
             st.write("### デバッグ情報")
@@ -227,24 +518,42 @@ def main():
         
         # LLMサーバーの設定（vllmの場合のみ表示）
         llm_server_url = None
+        backend_options = {}
         if provider == "vllm":
-            llm_server_url = st.text_input(
+            llm_server_url = st.text_area(
                 "LLMサーバーURL",
                 value="http://10.240.59.247:8000/v1",
                 help="OpenAI互換のLLMサーバーのURLを入力してください。デフォルトはwindows serverです。"
+                     "複数のレプリカを使用する場合は1行に1台ずつ入力し、「URL 重み」の形式で重みを指定できます。"
             )
+            if len([line for line in llm_server_url.splitlines() if line.strip()]) > 1:
+                backend_options["routing"] = st.selectbox(
+                    "振り分け方",
+                    options=["least_outstanding", "weighted"],
+                    format_func=lambda value: {"least_outstanding": "処理中の件数が最少のサーバー", "weighted": "重みの比率で順番に割り当て"}[value],
+                    help="複数のvLLMサーバーへのリクエストの振り分け方です。障害が発生したサーバーの分は自動的に他のサーバーへ再送されます。"
+                )
+        elif provider == "vllm_offline":
+            st.info("vLLMの推論エンジンをこのプロセス内で起動し、全患者分を1回の一括推論で処理します（vllmのインストールとGPUが必要です）。")
         
-        # 一時的なExcelAnalyzerインスタンスを作成してモデル一覧を取得
+        # モデル一覧を取得（接続設定ごとにキャッシュされ、再実行のたびには問い合わせない）
         try:
-            temp_analyzer = ExcelAnalyzer(
-                llm_server_url=llm_server_url,
-                provider=provider,
-                api_key=api_key  # 直接入力されたAPIキーを優先
+            available_models, default_model = list_available_models(
+                provider,
+                llm_server_url,
+                api_key,  # 直接入力されたAPIキーを優先
+                tuple(sorted(backend_options.items()))
             )
-            available_models = temp_analyzer.get_available_models()
 
             # モデルの選択
-            if available_models:
+            if provider == "vllm_offline":
+                # 推論エンジンはモデルごとに起動するため、任意のモデルIDまたはローカルパスを指定できるようにする
+                selected_model = st.text_input(
+                    "使用するモデル",
+                    value=default_model,
+                    help="Hugging FaceのモデルIDまたはローカルのモデルディレクトリを入力してください"
+                )
+            elif available_models:
                 selected_model = st.selectbox(
                     "使用するモデル",
                     options=available_models,
@@ -252,7 +561,7 @@ def main():
                 )
             else:
                 st.error("利用可能なモデルを取得できませんでした")
-                selected_model = temp_analyzer.model_name  # デフォルトモデルを使用
+                selected_model = default_model  # デフォルトモデルを使用
         except ValueError as e:
             st.error(str(e))
             st.stop()
@@ -260,6 +569,39 @@ def main():
             st.error(f"エラーが発生しました: {str(e)}")
             st.stop()
         
+        # 同時実行数の設定
+        max_workers = st.number_input(
+            "同時実行数",
+            min_value=1,
+            max_value=64,
+            value=4 if provider == "vllm" else 1,
+            disabled=provider == "vllm_offline",
+            help="患者ごとのLLM呼び出しを並列に実行する数です。ローカルのvLLMサーバーでは大きめの値で高速化できます（複数のサーバーを使用する場合は台数に比例して増やしてください）。"
+        )
+        
+        use_async = st.checkbox(
+            "非同期クライアントで実行",
+            value=False,
+            help="スレッドの代わりに非同期クライアントで同時実行数分のLLM呼び出しを並行に行います。"
+        )
+        
+        # LLM応答キャッシュの設定
+        use_cache = st.checkbox(
+            "LLM応答をキャッシュする",
+            value=True,
+            help="同じデータ・テンプレート・モデルでの再実行時に、保存済みの応答を再利用してAPI呼び出しを省略します。"
+        )
+        cache_path = ".llm_cache/responses.sqlite" if use_cache else None
+        
+        # 料金の上限設定
+        budget_usd = st.number_input(
+            "予算上限（USD、0は無制限）",
+            min_value=0.0,
+            value=0.0,
+            step=1.0,
+            help="API料金の累計がこの金額に達した時点で、残りの患者の分析を中止します。"
+        )
+        
         # テンプレートファイルの設定
         template_path = st.text_input(
             "テンプレートファイルパス",
@@ -275,29 +617,40 @@ def main():
         # Excelファイルのアップロード機能
         uploaded_file = st.file_uploader(
             "医療記録Excelファイルをアップロード", 
-            type=['xlsx'],
-            help="分析対象の医療記録データをExcelファイル形式でアップロードしてください。"
+            type=['xlsx', 'csv', 'parquet'],
+            help="分析対象の医療記録データをExcel（またはCSV・Parquet）ファイル形式でアップロードしてください。"
         )
 
         if uploaded_file is not None:
             # ExcelAnalyzerのインスタンスを作成 - 分析エンジンの初期化
+            # （バックエンド・応答キャッシュ・テンプレートは再実行間で共有されるため、作成は軽量）
+            backend_options_items = tuple(sorted(backend_options.items()))
             analyzer = ExcelAnalyzer(
                 llm_server_url=llm_server_url,
-                template_path=template_path,
                 provider=provider,
-                api_key=api_key
+                api_key=api_key,
+                max_workers=max_workers,
+                use_async=use_async,
+                budget_usd=budget_usd or None,
+                backend_options=backend_options,
+                backend=get_shared_backend(provider, llm_server_url, api_key, backend_options_items),
+                response_cache=get_response_cache(cache_path) if cache_path else None
             )
+            templates = get_templates(template_path)
+            if templates is None:
+                st.error(f"テンプレートファイル '{template_path}' を読み込めませんでした")
+            else:
+                analyzer.set_templates(templates)
             
             # 選択されたモデルを設定
             analyzer.set_model(selected_model)
 
-            # アップロードされたファイルを一時保存して読み込む
-            with open("temp.xlsx", "wb") as f:
-                f.write(uploaded_file.getvalue())
+            # アップロードのfile_idとサイズをキーにして、解析済みの列名・データを再利用する
+            upload_key = upload_cache_key(uploaded_file)
+            upload_suffix = os.path.splitext(uploaded_file.name)[1].lower()
             
-            # 一時的にファイルを読み込んで列名を取得
-            temp_df = pd.read_excel("temp.xlsx")
-            columns = temp_df.columns.tolist()
+            # ヘッダー行のみを読み込んで列名を取得
+            columns = read_upload_columns(upload_key, upload_suffix, uploaded_file)
             
             # 列の選択UI
             st.subheader("列の設定")
@@ -330,7 +683,11 @@ def main():
             # 列のマッピングを設定
             analyzer.set_column_mapping(id_column, date_column, text_column)
         
-            if analyzer.load_excel("temp.xlsx"):
+            # 選択された3列のみをストリーミングで読み込む（同じファイル・列の選択では解析済みのデータを使用する）
+            upload_df, upload_texts = load_upload_frame(upload_key, upload_suffix, id_column, date_column, text_column,
+                                                        analyzer, uploaded_file)
+            if upload_df is not None:
+                analyzer.set_data(upload_df, upload_texts)
                 st.success("ファイルの読み込みが完了しました")
 
                 # データプレビュー - アップロードされたデータの確認
@@ -363,152 +720,65 @@ def main():
                 #     )
                 sample_id = "すべて"  # デフォルトで全データを分析
 
-                # 分析実行ボタンと処理
-                if st.button("分析を実行", type="primary", help="選択した分析を開始します"):
-                    # 停止フラグの初期化
-                    if 'stop_analysis' not in st.session_state:
-                        st.session_state.stop_analysis = False
+                # 複数テンプレートの一括実行
+                fused_mode = st.checkbox(
+                    "選択した分析をまとめて実行",
+                    value=len(selected_templates) > 1,
+                    help="選択したすべての分析を患者ごとに1回のLLM呼び出しで実行します。入力トークン数と処理時間を削減できます。"
+                )
 
-                    # プログレスバーの初期化
-                    progress_bar = st.progress(0)
-                    status_container = st.empty()
-                    result_container = st.empty()
-                    
-                    # 停止ボタン
-                    if st.button("分析を停止", type="secondary"):
-                        st.session_state.stop_analysis = True
-                        st.warning("分析を停止しています...")
-                        
-                        # 分析結果の列を特定
-                        analysis_columns = [col for col in analyzer.df.columns if col.startswith('分析結果_')]
-                        
-                        if analysis_columns:
-                            # 分析結果の概要を表示
-                            if sample_id == "すべて":
-                                # 新しいExcelAnalyzerインスタンスを作成して結果データを設定
-                                summary_analyzer = ExcelAnalyzer(llm_server_url=llm_server_url, template_path=template_path)
-                                summary_analyzer.df = analyzer.df
-                                display_analysis_summary_streamlit(summary_analyzer, analysis_columns)
-                            else:
-                                # 特定IDの分析結果概要
-                                temp_df = analyzer.df[analyzer.df[analyzer.column_mapping['id_column']] == sample_id].copy()
-                                temp_analyzer = ExcelAnalyzer(llm_server_url=llm_server_url, template_path=template_path)
-                                temp_analyzer.df = temp_df
-                                
-                                st.subheader(f"ID: {sample_id} の分析結果概要")
-                                display_analysis_summary_streamlit(temp_analyzer, analysis_columns)
-                        
-                        # 分析結果の表示
-                        st.subheader("分析結果データ")
-                        if sample_id != "すべて":
-                            result_df = analyzer.df[analyzer.df[analyzer.column_mapping['id_column']] == sample_id]
+                # 前回の分析結果との差分実行
+                # 別のコホートの結果を誤って再利用しないよう、既定では無効にする
+                reuse_previous = st.checkbox(
+                    "前回の分析結果を再利用する",
+                    value=False,
+                    disabled=not os.path.exists(RESULTS_PATH),
+                    help="前回保存した分析結果と比較し、新しい患者と記載が追加・変更された患者のみを分析します。テンプレートやモデルを変更した場合は再分析されます。"
+                         "前回と同じコホートのデータ（追加・更新分を含む）をアップロードした場合にのみ有効にしてください。"
+                )
+                if reuse_previous:
+                    analyzer.set_previous_results(load_results_frame(RESULTS_PATH, os.path.getmtime(RESULTS_PATH)))
+
+                # 実行前の見積もり
+                if st.button("トークン数と料金を見積もる", help="選択した分析を実行した場合のトークン数・所要時間・料金を見積もります"):
+                    estimate = analyzer.estimate_run(selected_templates, fused=fused_mode)
+                    if estimate:
+                        est_col1, est_col2, est_col3, est_col4 = st.columns(4)
+                        est_col1.metric("リクエスト数", f"{estimate['requests']:,}")
+                        est_col2.metric("入力トークン", f"{estimate['input_tokens']:,}")
+                        est_col3.metric("出力トークン（想定）", f"{estimate['output_tokens']:,}")
+                        est_col4.metric("所要時間（目安）", f"{estimate['estimated_seconds'] / 60:.1f}分")
+                        if estimate["estimated_cost_usd"] is None:
+                            st.info(f"モデル '{analyzer.model_name}' の料金が不明なため、料金は見積もれません")
                         else:
-                            result_df = analyzer.df
-                        
-                        st.write("分析結果の一覧を表示します")
-                        st.dataframe(result_df)
-
-                        # 結果のダウンロード機能
-                        analyzer.save_results("analyzed_results.xlsx")
-                        with open("analyzed_results.xlsx", "rb") as f:
-                            st.download_button(
-                                label="分析結果をダウンロード",
-                                data=f,
-                                file_name="analyzed_results.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                help="分析結果をExcelファイルとしてダウンロードできます"
-                            )
-                        
-                        # 分析を停止したことを明示的に表示
-                        st.error("分析が停止されました。上記は停止時点までの分析結果です。")
-                        st.stop()  # これ以降の処理を停止
-                    
-                    with st.spinner("分析を実行中..."):
-                        # 選択された各テンプレートに対して分析を実行
-                        total_templates = len(selected_templates)
-                        for i, template_key in enumerate(selected_templates):
-                            if st.session_state.stop_analysis:
-                                st.warning("分析が停止されました")
-                                break
-
-                            template_name = analyzer.templates[template_key]["name"]
-                            status_container.write(f"進捗: {i+1}/{total_templates} - {template_name}の分析中...")
-                            
-                            # テンプレートごとの進捗を更新
-                            progress = (i + 1) / total_templates
-                            progress_bar.progress(progress)
-
-                            # 分析実行時の詳細な進捗表示用のコンテナ
-                            analysis_progress = st.empty()
-                            analysis_result = st.empty()
-
-                            def progress_callback(current_row, total_rows, result):
-                                analysis_progress.write(f"🔄 {total_rows}件中{current_row}件目を処理中 ({(current_row/total_rows*100):.1f}%)")
-                                if result:
-                                    analysis_result.write(f"""
-                                    **最新の分析結果:**
-                                    {json.dumps(result, ensure_ascii=False, indent=2)}
-                                    """)
-
-                            # コールバック関数を渡して分析を実行
-                            result = analyzer.analyze_with_template(template_key, progress_callback=progress_callback)
-                            
-                            # 分析結果をリアルタイムで表示
-                            with result_container.container():
-                                st.write(f"✅ {template_name}の分析が完了")
-                                # 最新の分析結果を表示
-                                latest_col = [col for col in analyzer.df.columns if col.startswith('分析結果_')][-1]
-                                st.dataframe(analyzer.df[[analyzer.column_mapping['id_column'], latest_col]].head())
-
-                        if not st.session_state.stop_analysis:
-                            # 分析結果の保存
-                            status_container.write("分析結果を保存中...")
-                            analyzer.save_results("analyzed_results.xlsx")
-                            
-                            # 分析結果の列を特定
-                            analysis_columns = [col for col in analyzer.df.columns if col.startswith('分析結果_')]
-                            
-                            # 結合テキストを含む新しいデータフレームを読み込む
-                            result_df = pd.read_excel("analyzed_results.xlsx")
-                            
-                            # プログレスバーを完了状態に
-                            progress_bar.progress(1.0)
-                            status_container.success("すべての分析が完了しました！")
-
-                            # 分析結果の概要を表示
-                            if analysis_columns:
-                                # 全体の分析結果概要
-                                if sample_id == "すべて":
-                                    # 新しいExcelAnalyzerインスタンスを作成して結果データを設定
-                                    summary_analyzer = ExcelAnalyzer(llm_server_url=llm_server_url, template_path=template_path)
-                                    summary_analyzer.df = result_df
-                                    display_analysis_summary_streamlit(summary_analyzer, analysis_columns)
-                                else:
-                                    # 特定IDの分析結果概要
-                                    temp_df = result_df[result_df[analyzer.column_mapping['id_column']] == sample_id].copy()
-                                    temp_analyzer = ExcelAnalyzer(llm_server_url=llm_server_url, template_path=template_path)
-                                    temp_analyzer.df = temp_df
-                                    
-                                    st.subheader(f"ID: {sample_id} の分析結果概要")
-                                    display_analysis_summary_streamlit(temp_analyzer, analysis_columns)
-                            
-                            # 分析結果の表示
-                            st.subheader("分析結果データ")
-                            if sample_id != "すべて":
-                                result_df = result_df[result_df[analyzer.column_mapping['id_column']] == sample_id]
-                            
-                            st.write("分析結果の一覧を表示します")
-                            st.dataframe(result_df)
-
-                            # 結果のダウンロード機能
-                            with open("analyzed_results.xlsx", "rb") as f:
-                                st.download_button(
-                                    label="分析結果をダウンロード",
-                                    data=f,
-                                    file_name="analyzed_results.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                    help="分析結果をExcelファイルとしてダウンロードできます"
-                                )
+                            st.info(f"料金の目安: ${estimate['estimated_cost_usd']:.4f}（出力が最大トークン数に達した場合: ${estimate['max_cost_usd']:.4f}）")
+
+                # 分析実行ボタンと処理（分析はバックグラウンドのジョブで実行し、画面は進捗を定期的に表示する）
+                job = st.session_state.get("analysis_job")
+                if st.button("分析を実行", type="primary", help="選択した分析を開始します",
+                             disabled=job is not None and job.running):
+                    # 分析結果の列は analyzer.df に追加されるため、キャッシュで共有しているデータフレームの複製を渡す
+                    # （結合テキストは変わらないため、キャッシュ済みのものを引き継ぐ）
+                    analyzer.set_data(analyzer.df.copy(), upload_texts)
+                    job = AnalysisJob(
+                        lambda job: run_analysis_job(job, analyzer, list(selected_templates), fused_mode),
+                        name="分析"
+                    )
+                    st.session_state.analysis_job = job
+                    st.session_state.analysis_job_analyzer = analyzer
+                    job.start()
+
+                if job is not None:
+                    job_analyzer = st.session_state.analysis_job_analyzer
+                    if job.running:
+                        show_job_progress(job)
+                        if not hasattr(st, "fragment"):
+                            time.sleep(JOB_POLL_INTERVAL_SEC)
+                            st.rerun()
+                    elif job.state == JOB_FAILED:
+                        st.error(f"分析中にエラーが発生しました: {job.error}")
+                    else:
+                        display_run_results(job_analyzer, job, sample_id)
 
                 # 個別の医療記録テキスト表示
                 if sample_id != "すべて":
@@ -538,10 +808,9 @@ def main():
     with tab2:
         st.header("プロンプトテンプレート編集")
         
-        # テンプレートファイルの読み込み
+        # テンプレートファイルの読み込み（保存すると更新時刻が変わるため、キャッシュは読み直される）
         try:
-            with open(template_path, 'r', encoding='utf-8') as f:
-                templates = json.load(f)
+            templates = load_template_file(template_path, os.path.getmtime(template_path))
             
             # テンプレートの選択
             template_keys = list(templates.keys())
@@ -583,6 +852,16 @@ def main():
                         help="分析の種類を選択してください"
                     )
                     
+                    # 長いテキストを分割して抽出した場合の結果の統合方法
+                    template_merge = st.selectbox(
+                        "結果の統合方法",
+                        options=list(MERGE_STRATEGIES),
+                        index=MERGE_STRATEGIES.index(infer_merge_strategy(templates[selected_template]["system_prompt"],
+                                                                          templates[selected_template])),
+                        format_func=MERGE_STRATEGY_LABELS.get,
+                        help="長いテキストを日付単位で分割して抽出した場合に、分割ごとの結果をどのようにまとめるかを選択してください"
+                    )
+                    
                     # システムプロンプト
                     template_system_prompt = st.text_area(
                         "システムプロンプト",
@@ -599,6 +878,7 @@ def main():
                         templates[selected_template]["name"] = template_name
                         templates[selected_template]["description"] = template_description
                         templates[selected_template]["analysis_type"] = template_analysis_type
+                        templates[selected_template]["merge"] = template_merge
                         templates[selected_template]["system_prompt"] = template_system_prompt
                         
                         # ファイルに保存
@@ -638,6 +918,13 @@ def main():
                             help="分析の種類を選択してください"
                         )
                         
+                        new_template_merge = st.selectbox(
+                            "結果の統合方法",
+                            options=list(MERGE_STRATEGIES),
+                            format_func=MERGE_STRATEGY_LABELS.get,
+                            help="長いテキストを日付単位で分割して抽出した場合に、分割ごとの結果をどのようにまとめるかを選択してください"
+                        )
+                        
                         new_template_system_prompt = st.text_area(
                             "システムプロンプト",
                             height=300,
@@ -655,6 +942,7 @@ def main():
                                     "name": new_template_name,
                                     "description": new_template_description,
                                     "analysis_type": new_template_analysis_type,
+                                    "merge": new_template_merge,
                                     "system_prompt": new_template_system_prompt
                                 }
                                 
@@ -725,7 +1013,7 @@ def main():
             output_filename = st.text_input(
                 "出力ファイル名",
                 value="sample_data.xlsx",
-                help="生成したデータを保存するExcelファイルの名前を指定してください"
+                help="生成したデータを保存するファイルの名前を指定してください。拡張子で形式が決まります（.xlsx / .parquet / .feather / .csv）"
             )
         
         # データ生成の実行
@@ -736,10 +1024,7 @@ def main():
                     generator = MedicalDataGenerator()
                     
                     # データの生成と保存
-                    generator.save_to_excel(output_filename, num_patients=num_patients)
-                    
-                    # 生成したデータのプレビュー
-                    df = pd.read_excel(output_filename)
+                    df = generator.save(output_filename, num_patients=num_patients)
                     
                     st.success(f"{num_patients}件のテストデータを生成し、{output_filename}に保存しました")
                     
@@ -764,7 +1049,7 @@ def main():
                             label="生成したデータをダウンロード",
                             data=f,
                             file_name=output_filename,
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet" if output_filename.lower().endswith(".xlsx") else "application/octet-stream"
                         )
                     
                     # 詳細な統計情報
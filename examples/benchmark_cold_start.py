@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+起動時間（コールドスタート）のベンチマーク
+
+新しいPythonプロセスで analyzer パッケージをインポートし、ExcelAnalyzer を作成するまでの時間を計測する。
+プロバイダーのSDK（openai / anthropic / google.genai）が使用するバックエンドの初回使用時まで
+インポートされないこと、APIキーの解決（.zshrcを読み込むシェルの起動を含む）がプロセス内で1回だけ
+行われることを、読み込まれたモジュールとインスタンスの再作成にかかる時間で確認する。
+
+使い方:
+    python examples/benchmark_cold_start.py
+    python examples/benchmark_cold_start.py --provider openai --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# 起動時に読み込まれていないことを確認するモジュール
+SDK_MODULES = ["openai", "anthropic", "google.genai", "requests", "tiktoken", "vllm"]
+
+# 新しいプロセスで実行する計測コード
+PROBE = """
+import json, sys, time
+sys.path.insert(0, {src_dir!r})
+start = time.perf_counter()
+from analyzer import ExcelAnalyzer
+imported = time.perf_counter()
+loaded_after_import = [name for name in {sdk_modules!r} if name in sys.modules]
+analyzer = ExcelAnalyzer(provider={provider!r})
+first = time.perf_counter()
+analyzer.client
+client_ready = time.perf_counter()
+for _ in range({instances}):
+    ExcelAnalyzer(provider={provider!r})
+repeated = time.perf_counter()
+print(json.dumps({{
+    "import_sec": imported - start,
+    "first_instance_sec": first - imported,
+    "first_client_sec": client_ready - first,
+    "instance_sec": (repeated - client_ready) / {instances},
+    "loaded_after_import": loaded_after_import,
+    "loaded_after_client": [name for name in {sdk_modules!r} if name in sys.modules]
+}}))
+"""
+
+
+def run_probe(provider: str, instances: int) -> dict:
+    """新しいPythonプロセスで計測コードを実行し、結果を返す"""
+    code = PROBE.format(src_dir=SRC_DIR, sdk_modules=SDK_MODULES, provider=provider, instances=instances)
+    # 計測結果以外の出力（テンプレートの読み込みなど）と区別するため、最後の行のみを解析する
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間（コールドスタート）のベンチマーク")
+    parser.add_argument("--provider", default="vllm", help="作成するバックエンド（APIキーは環境変数から取得する）")
+    parser.add_argument("--repeat", type=int, default=5, help="新しいプロセスでの計測の繰り返し回数")
+    parser.add_argument("--instances", type=int, default=20, help="1プロセス内でExcelAnalyzerを再作成する回数")
+    args = parser.parse_args()
+
+    try:
+        results = [run_probe(args.provider, args.instances) for _ in range(args.repeat)]
+    except subprocess.CalledProcessError as e:
+        raise SystemExit(f"エラー: 計測に失敗しました\n{e.stderr}")
+
+    print(f"プロバイダー: {args.provider}（{args.repeat}回の中央値）")
+    for key, label in [
+        ("import_sec", "パッケージのインポート"),
+        ("first_instance_sec", "ExcelAnalyzerの初回作成"),
+        ("first_client_sec", "クライアントの初回作成（SDKのインポートを含む）"),
+        ("instance_sec", "ExcelAnalyzerの再作成（1回あたり）"),
+    ]:
+        print(f"{label:<40} {statistics.median(result[key] for result in results) * 1000:10.1f} ms")
+
+    print(f"インポート直後に読み込まれていたSDK: {', '.join(results[0]['loaded_after_import']) or 'なし'}")
+    print(f"クライアント作成後に読み込まれていたSDK: {', '.join(results[0]['loaded_after_client']) or 'なし'}")
+
+
+if __name__ == "__main__":
+    main()
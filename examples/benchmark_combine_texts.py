@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+_combine_texts_by_id のベンチマーク
+
+MedicalDataGenerator で生成したデータに対して、ID単位のフィルタリングと iterrows を用いる
+旧実装と、IDの整数コード化（factorize）、(ID, 日付) での1回の安定ソート（lexsort）、
+ID別件数（bincount）による区切りで結合する現在の実装の処理時間を比較し、
+両者の結合テキストが完全に一致することを確認する。
+
+使い方:
+    python examples/benchmark_combine_texts.py
+    python examples/benchmark_combine_texts.py --rows 10000 100000 1000000 --legacy-max-rows 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from analyzer import ExcelAnalyzer
+from data.data_generator import MedicalDataGenerator
+
+
+def legacy_combine_texts_by_id(df: pd.DataFrame, column_mapping: dict) -> dict:
+    """旧実装（IDごとのブールマスクと iterrows）"""
+    df[column_mapping['date_column']] = pd.to_datetime(df[column_mapping['date_column']])
+    combined_texts = {}
+    for id_val in df[column_mapping['id_column']].unique():
+        group = df[df[column_mapping['id_column']] == id_val].sort_values(column_mapping['date_column'])
+        texts = [f"[{row[column_mapping['date_column']].strftime('%Y-%m-%d')}]\n{row[column_mapping['text_column']]}"
+                 for _, row in group.iterrows()]
+        combined_texts[id_val] = "\n\n".join(texts)
+    return combined_texts
+
+
+def generate_rows(num_rows: int) -> pd.DataFrame:
+    """概ね num_rows 行のテストデータを生成する（1患者あたり平均5行）"""
+    generator = MedicalDataGenerator()
+    df = generator.generate_patient_records(num_patients=max(1, num_rows // 5))
+    # 実際のEHR出力に近づけるため、行の順序をシャッフルする
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="_combine_texts_by_id のベンチマーク")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="計測する行数")
+    parser.add_argument("--legacy-max-rows", type=int, default=100_000,
+                        help="旧実装を計測する最大行数（旧実装は患者数×行数に比例するため）")
+    args = parser.parse_args()
+
+    random.seed(0)
+    # ExcelAnalyzer はクライアント初期化のみ行い、LLMへの接続はしない
+    analyzer = ExcelAnalyzer()
+
+    print(f"{'行数':>10} {'患者数':>8} {'旧実装(秒)':>12} {'新実装(秒)':>12} {'高速化':>8}")
+    for num_rows in args.rows:
+        df = generate_rows(num_rows)
+
+        analyzer.df = df.copy()
+        start = time.perf_counter()
+        combined = analyzer._combine_texts_by_id()
+        new_elapsed = time.perf_counter() - start
+
+        legacy_elapsed = None
+        if num_rows <= args.legacy_max_rows:
+            start = time.perf_counter()
+            legacy = legacy_combine_texts_by_id(df.copy(), analyzer.column_mapping)
+            legacy_elapsed = time.perf_counter() - start
+            if list(legacy.items()) != list(combined.items()):
+                raise SystemExit(f"エラー: {num_rows}行で旧実装と結合テキストが一致しません")
+
+        legacy_text = f"{legacy_elapsed:12.2f}" if legacy_elapsed is not None else f"{'-':>12}"
+        speedup = f"{legacy_elapsed / new_elapsed:7.0f}x" if legacy_elapsed is not None else f"{'-':>8}"
+        print(f"{len(df):>10} {len(combined):>8} {legacy_text} {new_elapsed:12.2f} {speedup}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,668 @@
+# -*- coding: utf-8 -*-
+"""
+LLMプロバイダーのバックエンドとそのレジストリ。
+
+各バックエンドはクライアントの作成、リクエストの組み立て（構造化出力・プロンプトキャッシュの指定を含む）、
+応答と使用量の取り出し、トークン数の計測、モデル一覧の取得を担当する。
+再試行・レート制限・応答キャッシュ・予算管理はプロバイダーに依存しないため ExcelAnalyzer 側で行う。
+
+新しいプロバイダーやローカル推論エンジンは ProviderBackend を継承し、
+@register_backend("名前") で登録すると ExcelAnalyzer(provider="名前") で使用できる。
+"""
+import asyncio
+import json
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Type
+
+from .batch import AnthropicBatchBackend, BatchBackend, LocalBatchBackend, OpenAIBatchBackend
+from .clients import HTTP_LIMITS, get_async_client, get_client
+from .load_balancer import Endpoint, EndpointPool, EndpointSpec, is_endpoint_failure, parse_endpoints
+from .structured_output import RESULT_TOOL_NAME, is_strict_compatible, to_gemini_schema
+from .usage import get_token_counter
+
+
+class CompletionResult(NamedTuple):
+    """1回の呼び出しの応答テキストと使用量（使用量が取得できない場合はNone）"""
+    text: str
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    cached_input_tokens: Optional[int] = None
+
+
+class ProviderBackend:
+    """
+    LLMプロバイダーのバックエンドの基底クラス
+
+    Parameters:
+    - api_key: APIキー
+    - base_url: 接続先URL（省略時はプロバイダーの既定値）
+    - temperature: 生成時のtemperature
+    """
+
+    name = ""
+    default_model = ""
+    # APIキーを取得する環境変数名（不要な場合はNone）
+    api_key_env: Optional[str] = None
+    api_key_error = "APIキーが必要です"
+    default_rate_limits: Dict[str, Optional[float]] = {"requests_per_minute": None, "tokens_per_minute": None}
+
+    # 能力の宣言（スケジューラーが最速の実行経路を選ぶために使用する）
+    supports_async = False   # acomplete を非同期クライアントで実行できる
+    supports_batch_api = False   # プロバイダーのバッチAPI（create_batch_backend）がある
+    native_batch = False   # complete_batch が複数件を1回の推論でまとめて処理する
+    max_concurrency: Optional[int] = None   # 同時実行数の上限（Noneは制限なし）
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, temperature: float = 0.1):
+        if self.api_key_env and not api_key:
+            raise ValueError(self.api_key_error)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.temperature = temperature
+        self._client = None
+
+    @classmethod
+    def capabilities(cls) -> Dict[str, object]:
+        """バックエンドの能力を辞書で返す"""
+        return {
+            "async": cls.supports_async,
+            "batch_api": cls.supports_batch_api,
+            "native_batch": cls.native_batch,
+            "max_concurrency": cls.max_concurrency
+        }
+
+    # ---- クライアント ----
+
+    @property
+    def client(self):
+        """プロセス内で共有される同期クライアント"""
+        if self._client is None:
+            self._client = get_client((self.name, self.api_key, self.base_url), self.create_client)
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    def async_client(self):
+        """実行中のイベントループで共有される非同期クライアント"""
+        return get_async_client((self.name, self.api_key, self.base_url), self.create_async_client)
+
+    def create_client(self):
+        """同期クライアントを作成する"""
+        raise NotImplementedError
+
+    def create_async_client(self):
+        """非同期クライアントを作成する"""
+        raise NotImplementedError
+
+    # ---- 呼び出し ----
+
+    def build_request(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> dict:
+        """APIに渡す引数を作成する"""
+        raise NotImplementedError
+
+    def send(self, request: dict):
+        """同期クライアントでリクエストを送信し、SDKの応答オブジェクトを返す"""
+        raise NotImplementedError
+
+    async def asend(self, request: dict):
+        """非同期クライアントでリクエストを送信し、SDKの応答オブジェクトを返す"""
+        raise NotImplementedError
+
+    def parse(self, completion) -> CompletionResult:
+        """SDKの応答オブジェクトから応答テキストと使用量を取り出す"""
+        raise NotImplementedError
+
+    def complete(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> CompletionResult:
+        """1件のテキストを分析する"""
+        return self.parse(self.send(self.build_request(model, system_prompt, text, max_tokens, schema)))
+
+    async def acomplete(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> CompletionResult:
+        """complete の非同期版"""
+        return self.parse(await self.asend(self.build_request(model, system_prompt, text, max_tokens, schema)))
+
+    def complete_batch(self, model: str, requests: List[dict]) -> List[CompletionResult]:
+        """
+        複数のリクエスト（system_prompt, text, max_tokens, 任意で schema を持つ辞書）を処理し、
+        同じ順序で結果を返す。native_batch のバックエンドは1回の推論でまとめて処理する
+        """
+        return [
+            self.complete(model, request["system_prompt"], request["text"], request["max_tokens"], request.get("schema"))
+            for request in requests
+        ]
+
+    # ---- その他 ----
+
+    def count_tokens(self, model: str, text: str) -> int:
+        """トークン数を数える（トークナイザーがない場合は概算）"""
+        return get_token_counter(self.name, model)(text)
+
+    def list_models(self) -> List[str]:
+        """利用可能なモデル名の一覧を返す"""
+        return [self.default_model]
+
+    def create_batch_backend(self, model: str, work_dir: str, responder: Callable[[dict], str]) -> BatchBackend:
+        """
+        オフライン一括推論のバックエンドを返す。バッチAPIのないプロバイダーは
+        responder（通常のAPI呼び出し）で順に処理するローカルバックエンドを使用する
+        """
+        return LocalBatchBackend(responder=responder, work_dir=work_dir)
+
+
+BACKENDS: Dict[str, Type[ProviderBackend]] = {}
+
+
+def register_backend(name: str):
+    """バックエンドクラスをプロバイダー名で登録するデコレーター"""
+    def decorator(cls: Type[ProviderBackend]) -> Type[ProviderBackend]:
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def get_backend_class(name: str) -> Type[ProviderBackend]:
+    """登録されたバックエンドクラスを返す"""
+    if name not in BACKENDS:
+        raise ValueError(f"未対応のプロバイダーです: {name}")
+    return BACKENDS[name]
+
+
+def create_backend(name: str, api_key: Optional[str] = None, base_url: Optional[str] = None, temperature: float = 0.1,
+                   **options) -> ProviderBackend:
+    """プロバイダー名からバックエンドを作成する（options はバックエンド固有の引数）"""
+    return get_backend_class(name)(api_key=api_key, base_url=base_url, temperature=temperature, **options)
+
+
+# ---- OpenAI互換API（vLLM・OpenAI・Deepseek） ----
+
+class OpenAICompatibleBackend(ProviderBackend):
+    """OpenAI互換のChat Completions APIを使用するバックエンド"""
+
+    supports_async = True
+    default_base_url: Optional[str] = None
+
+    def create_client(self, base_url: Optional[str] = None):
+        from openai import OpenAI, DefaultHttpxClient
+        return OpenAI(api_key=self.api_key or "EMPTY", base_url=base_url or self.base_url or self.default_base_url,
+                      http_client=DefaultHttpxClient(limits=HTTP_LIMITS))
+
+    def create_async_client(self, base_url: Optional[str] = None):
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        return AsyncOpenAI(api_key=self.api_key or "EMPTY", base_url=base_url or self.base_url or self.default_base_url,
+                           http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS))
+
+    def structured_options(self, schema: dict) -> dict:
+        """構造化出力の指定（既定はOpenAIのStructured Outputs）"""
+        return {
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "extraction_result", "schema": schema, "strict": is_strict_compatible(schema)}
+            }
+        }
+
+    def build_request(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> dict:
+        # システムプロンプトを常に先頭に置き、患者ごとに変わるテキストはその後ろに送る。
+        # 同じテンプレートの呼び出しでは先頭が完全に一致するため、OpenAI・DeepSeekの自動キャッシュや
+        # vLLMの自動プレフィックスキャッシュ（--enable-prefix-caching）でプレフィルが再利用される
+        request = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"テキスト: {text}"}
+            ],
+            "temperature": self.temperature,
+            "max_tokens": max_tokens
+        }
+        if schema is not None:
+            request.update(self.structured_options(schema))
+        return request
+
+    def send(self, request: dict):
+        return self.client.chat.completions.create(**request)
+
+    async def asend(self, request: dict):
+        return await self.async_client().chat.completions.create(**request)
+
+    def parse(self, completion) -> CompletionResult:
+        usage = getattr(completion, "usage", None)
+        # キャッシュから読み込まれた入力トークン数（OpenAI: prompt_tokens_details、DeepSeek: prompt_cache_hit_tokens）
+        cached_tokens = (getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+                         or getattr(usage, "prompt_cache_hit_tokens", None))
+        return CompletionResult(
+            completion.choices[0].message.content.strip(),
+            getattr(usage, "prompt_tokens", None),
+            getattr(usage, "completion_tokens", None),
+            cached_tokens
+        )
+
+    def list_models(self) -> List[str]:
+        return [model.id for model in self.client.models.list().data]
+
+
+@register_backend("vllm")
+class VLLMBackend(OpenAICompatibleBackend):
+    """
+    OpenAI互換のvLLMサーバー
+
+    base_url に複数の接続先（load_balancer.parse_endpoints の形式）を指定すると各サーバーに振り分け、
+    接続エラーや5xx応答を返したサーバーへのリクエストは残りのサーバーに再送する
+
+    Parameters（ProviderBackend の引数に加えて）:
+    - routing: 振り分け方（least_outstanding: 処理中の件数が最少のサーバー / weighted: 重みの比率で順番に割り当て）
+    - health_check_interval: models.list() によるヘルスチェックの間隔（秒）
+    """
+
+    default_model = "Qwen/Qwen2.5-72B-Instruct-GPTQ-Int4"
+    # ヘルスチェックの応答を待つ時間（秒）
+    HEALTH_CHECK_TIMEOUT_SEC = 5.0
+
+    def __init__(self, api_key: Optional[str] = None, base_url: EndpointSpec = None, temperature: float = 0.1,
+                 routing: str = "least_outstanding", health_check_interval: float = 30.0):
+        endpoints = parse_endpoints(base_url)
+        super().__init__(api_key=api_key, base_url=endpoints[0][0], temperature=temperature)
+        # 処理中の件数や障害の状態は、同じ接続先を使う全てのインスタンスで共有する
+        self.pool: EndpointPool = get_client(
+            ("vllm_pool", endpoints, routing),
+            lambda: EndpointPool(endpoints, routing=routing, health_check_interval=health_check_interval)
+        )
+
+    @property
+    def client(self):
+        """固定のクライアント（設定されている場合）、なければ最初の接続先のクライアント"""
+        return self._client if self._client is not None else self.endpoint_client(self.pool.endpoints[0])
+
+    @client.setter
+    def client(self, value):
+        # 設定したクライアントには振り分けを行わずに全てのリクエストを送る
+        self._client = value
+
+    def endpoint_client(self, endpoint: Endpoint):
+        """接続先ごとにプロセス内で共有される同期クライアント"""
+        return get_client((self.name, self.api_key, endpoint.url), lambda: self.create_client(endpoint.url))
+
+    def endpoint_async_client(self, endpoint: Endpoint):
+        """接続先ごとに実行中のイベントループで共有される非同期クライアント"""
+        return get_async_client((self.name, self.api_key, endpoint.url), lambda: self.create_async_client(endpoint.url))
+
+    def structured_options(self, schema: dict) -> dict:
+        return {"extra_body": {"guided_json": schema}}
+
+    def send(self, request: dict):
+        if self._client is not None:
+            return self._client.chat.completions.create(**request)
+        self._run_due_health_check()
+        # この呼び出しで失敗した (接続先, 例外)
+        tried: List[tuple] = []
+        while True:
+            endpoint = self._select(tried)
+            try:
+                with self.pool.track(endpoint):
+                    completion = self.endpoint_client(endpoint).chat.completions.create(**request)
+            except Exception as e:
+                self._handle_failure(endpoint, e, tried)
+                continue
+            self.pool.mark_success(endpoint)
+            return completion
+
+    async def asend(self, request: dict):
+        if self._client is not None:
+            return await super().asend(request)
+        if self.pool.claim_health_check():
+            # ヘルスチェックは同期APIで行うため、イベントループを止めないよう別スレッドで実行する
+            try:
+                await asyncio.to_thread(self.check_health)
+            finally:
+                self.pool.finish_health_check()
+        # この呼び出しで失敗した (接続先, 例外)
+        tried: List[tuple] = []
+        while True:
+            endpoint = self._select(tried)
+            try:
+                with self.pool.track(endpoint):
+                    completion = await self.endpoint_async_client(endpoint).chat.completions.create(**request)
+            except Exception as e:
+                self._handle_failure(endpoint, e, tried)
+                continue
+            self.pool.mark_success(endpoint)
+            return completion
+
+    def _select(self, tried: List[tuple]) -> Endpoint:
+        """まだ試していない接続先を選ぶ（全て失敗した場合は最後の例外を送出する）"""
+        endpoint = self.pool.select(exclude=[endpoint for endpoint, _ in tried])
+        if endpoint is None:
+            raise tried[-1][1]
+        return endpoint
+
+    def _handle_failure(self, endpoint: Endpoint, error: Exception, tried: List[tuple]):
+        """サーバー側の障害であれば記録して再送の対象から外し、それ以外の例外はそのまま送出する"""
+        if not is_endpoint_failure(error):
+            raise error
+        self.pool.mark_failure(endpoint, error)
+        tried.append((endpoint, error))
+
+    def _run_due_health_check(self):
+        """ヘルスチェックの実施時期であれば実施する"""
+        if self.pool.claim_health_check():
+            try:
+                self.check_health()
+            finally:
+                self.pool.finish_health_check()
+
+    def check_health(self) -> List[dict]:
+        """全ての接続先に models.list() を送って状態を更新し、各サーバーの状態を返す"""
+        for endpoint in self.pool.endpoints:
+            try:
+                self.endpoint_client(endpoint).with_options(timeout=self.HEALTH_CHECK_TIMEOUT_SEC).models.list()
+                self.pool.record_health(endpoint, True)
+            except Exception as e:
+                self.pool.record_health(endpoint, False, e)
+        return self.pool.status()
+
+    def list_models(self) -> List[str]:
+        if self._client is not None or len(self.pool.endpoints) == 1:
+            return super().list_models()
+        self.check_health()
+        for endpoint in self.pool.endpoints:
+            if endpoint.healthy:
+                return [model.id for model in self.endpoint_client(endpoint).models.list().data]
+        raise RuntimeError("応答するvLLMサーバーがありません")
+
+
+@register_backend("openai")
+class OpenAIBackend(OpenAICompatibleBackend):
+    """OpenAI API"""
+
+    default_model = "gpt-4o-mini-2024-07-18"
+    api_key_env = "OPENAI_API_KEY"
+    api_key_error = "OpenAIのAPIキーが必要です"
+    default_rate_limits = {"requests_per_minute": 500, "tokens_per_minute": 200_000}
+    supports_batch_api = True
+
+    def create_batch_backend(self, model: str, work_dir: str, responder: Callable[[dict], str]) -> BatchBackend:
+        return OpenAIBatchBackend(self.client, model, self.temperature)
+
+
+@register_backend("deepseek")
+class DeepseekBackend(OpenAICompatibleBackend):
+    """Deepseek API（OpenAI互換）"""
+
+    default_model = "deepseek-chat"
+    api_key_env = "DEEPSEEK_API_KEY"
+    api_key_error = "DeepseekのAPIキーが必要です"
+    default_base_url = "https://api.deepseek.com/v1"
+
+    def structured_options(self, schema: dict) -> dict:
+        # DeepseekはJSONスキーマの指定に対応していないため、JSONモードのみ使用する
+        return {"response_format": {"type": "json_object"}}
+
+    def list_models(self) -> List[str]:
+        return ["deepseek-chat", "deepseek-coder"]
+
+
+# ---- Gemini ----
+
+@register_backend("gemini")
+class GeminiBackend(ProviderBackend):
+    """Google Gemini API"""
+
+    default_model = "gemini-2.0-flash-lite"
+    api_key_env = "GOOGLE_API_KEY"
+    api_key_error = "Google Cloud APIキーが必要です"
+    default_rate_limits = {"requests_per_minute": 30, "tokens_per_minute": 1_000_000}
+    supports_async = True
+
+    # キャッシュ済みコンテンツ（システムプロンプト）の有効期間（秒）
+    CACHE_TTL_SEC = 3600
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # {(モデル, システムプロンプト): (キャッシュ済みコンテンツ名, 期限)}
+        self._cached_contents: Dict[tuple, tuple] = {}
+        # 同じプロンプトのキャッシュを重複して作成しないためのプロンプトごとのロック
+        self._cache_locks: Dict[tuple, threading.Lock] = {}
+        self._cache_lock = threading.Lock()
+
+    def create_client(self):
+        from google import genai
+        # genai.Client は内部のHTTPクライアントを保持するため、インスタンスの共有でプールも共有される
+        return genai.Client(api_key=self.api_key)
+
+    def create_async_client(self):
+        # Geminiの非同期APIは同期クライアントの .aio から利用する
+        return self.client.aio
+
+    def async_client(self):
+        # .aio は共有の同期クライアントに属するため、イベントループの終了時に閉じない
+        return get_async_client((self.name, self.api_key, self.base_url), self.create_async_client, owned=False)
+
+    def _valid_cached_content(self, key: tuple) -> tuple:
+        """登録済みで有効期限内のキャッシュ済みコンテンツがあれば (True, 名前（作成できなかった場合はNone）) を返す"""
+        entry = self._cached_contents.get(key)
+        if entry is not None and (entry[0] is None or time.time() < entry[1]):
+            return True, entry[0]
+        return False, None
+
+    def get_cached_content(self, model: str, system_prompt: str) -> Optional[str]:
+        """
+        システムプロンプトをキャッシュ済みコンテンツとして登録し、その名前を返す。
+        有効期限が近づいたものは作り直す。最小トークン数に満たないなどの理由で作成できない場合は
+        Noneを返し、以降は同じプロンプトの作成を試みない。
+        作成（caches.create）は同期のネットワーク呼び出しのため、ロックはプロンプトごとに取り、
+        他のプロンプトの呼び出しを待たせないようにする
+        """
+        from google.genai import types
+        key = (model, system_prompt)
+        found, name = self._valid_cached_content(key)
+        if found:
+            return name
+        with self._cache_lock:
+            key_lock = self._cache_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # 待機中に他のスレッドが作成した場合はそれを使用する
+            found, name = self._valid_cached_content(key)
+            if found:
+                return name
+            try:
+                cached = self.client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        ttl=f"{self.CACHE_TTL_SEC}s"
+                    )
+                )
+                name = cached.name
+            except Exception as e:
+                print(f"警告: Geminiのコンテキストキャッシュを作成できないため、システムプロンプトを毎回送信します: {str(e)}")
+                name = None
+            # 期限切れの直前に使われないよう、有効期限の1分前を期限として扱う
+            self._cached_contents[key] = (name, time.time() + self.CACHE_TTL_SEC - 60)
+            return name
+
+    def build_request(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None,
+                      cached_content: Optional[str] = None) -> dict:
+        """
+        リクエストを作成する。cached_content を省略した場合は get_cached_content で取得する
+        （非同期の経路では acomplete がイベントループ外で取得したものを渡す）
+        """
+        from google.genai import types
+        # システムプロンプトはキャッシュ済みコンテンツとして参照する（作成できない場合は毎回送信する）
+        if cached_content is None:
+            cached_content = self.get_cached_content(model, system_prompt)
+        # 生成パラメータ（Geminiでは最大トークン数は max_output_tokens として指定する）
+        options = {"temperature": self.temperature, "max_output_tokens": max_tokens}
+        if schema is not None:
+            options.update({"response_mime_type": "application/json", "response_schema": to_gemini_schema(schema)})
+        if cached_content:
+            config = types.GenerateContentConfig(cached_content=cached_content, **options)
+        else:
+            config = types.GenerateContentConfig(system_instruction=system_prompt, **options)
+        return {"model": model, "contents": text, "config": config}
+
+    async def acomplete(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> CompletionResult:
+        found, cached_content = self._valid_cached_content((model, system_prompt))
+        if not found:
+            # キャッシュの作成は同期の呼び出しのため、イベントループを止めないよう別スレッドで行う
+            cached_content = await asyncio.to_thread(self.get_cached_content, model, system_prompt)
+        # 作成できなかった場合（None）は build_request で再取得しないよう空文字列を渡す
+        request = self.build_request(model, system_prompt, text, max_tokens, schema, cached_content or "")
+        return self.parse(await self.asend(request))
+
+    def send(self, request: dict):
+        return self.client.models.generate_content(**request)
+
+    async def asend(self, request: dict):
+        return await self.async_client().models.generate_content(**request)
+
+    def parse(self, completion) -> CompletionResult:
+        usage = getattr(completion, "usage_metadata", None)
+        return CompletionResult(
+            completion.text.strip(),
+            getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None),
+            getattr(usage, "cached_content_token_count", None)
+        )
+
+    def list_models(self) -> List[str]:
+        try:
+            names = [model.name.replace("models/", "") for model in self.client.models.list()]
+            return [name for name in names if name.startswith("gemini")] or [self.default_model]
+        except Exception:
+            return [self.default_model]
+
+
+# ---- Claude ----
+
+@register_backend("claude")
+class ClaudeBackend(ProviderBackend):
+    """Anthropic Claude API"""
+
+    default_model = "claude-3-5-haiku-latest"
+    api_key_env = "ANTHROPIC_API_KEY"
+    api_key_error = "AnthropicのAPIキーが必要です"
+    default_rate_limits = {"requests_per_minute": 50, "tokens_per_minute": 50_000}
+    supports_async = True
+    supports_batch_api = True
+
+    def create_client(self):
+        from anthropic import Anthropic, DefaultHttpxClient
+        return Anthropic(api_key=self.api_key, http_client=DefaultHttpxClient(limits=HTTP_LIMITS))
+
+    def create_async_client(self):
+        from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+        return AsyncAnthropic(api_key=self.api_key, http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS))
+
+    def build_request(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> dict:
+        request = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": self.temperature,
+            # システムプロンプトをキャッシュ対象のプレフィックスとして指定する
+            "system": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+            "messages": [
+                {"role": "user", "content": f"テキスト: {text}"}
+            ]
+        }
+        if schema is not None:
+            # スキーマを入力とするツールの呼び出しを強制し、その入力を応答として受け取る
+            request["tools"] = [{"name": RESULT_TOOL_NAME, "description": "抽出結果を記録する", "input_schema": schema}]
+            request["tool_choice"] = {"type": "tool", "name": RESULT_TOOL_NAME}
+        return request
+
+    def send(self, request: dict):
+        return self.client.messages.create(**request)
+
+    async def asend(self, request: dict):
+        return await self.async_client().messages.create(**request)
+
+    def parse(self, completion) -> CompletionResult:
+        tool_inputs = [block.input for block in completion.content if getattr(block, "type", None) == "tool_use"]
+        if tool_inputs:
+            text = json.dumps(tool_inputs[0], ensure_ascii=False)
+        else:
+            text = completion.content[0].text.strip()
+        usage = getattr(completion, "usage", None)
+        # Anthropicの input_tokens はキャッシュの読み込み・作成分を含まないため合算する
+        input_tokens = getattr(usage, "input_tokens", None)
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+        if input_tokens is not None:
+            input_tokens += cache_read + cache_creation
+        return CompletionResult(text, input_tokens, getattr(usage, "output_tokens", None), cache_read)
+
+    def list_models(self) -> List[str]:
+        try:
+            return [model.id for model in self.client.models.list().data]
+        except Exception:
+            return ["claude-3-5-haiku-latest", "claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"]
+
+    def create_batch_backend(self, model: str, work_dir: str, responder: Callable[[dict], str]) -> BatchBackend:
+        return AnthropicBatchBackend(self.client, model, self.temperature)
+
+
+# ---- vLLMオフライン推論エンジン ----
+
+@register_backend("vllm_offline")
+class VLLMOfflineBackend(ProviderBackend):
+    """
+    vLLMのオフライン推論エンジン（vllm.LLM）をプロセス内で直接使用するバックエンド。
+    HTTPサーバーを経由せず、complete_batch に渡された全リクエストを1回の推論にまとめて投入するため、
+    連続バッチングのスループットをそのまま利用できる。vllm のインストールとGPUが必要
+    """
+
+    default_model = "Qwen/Qwen2.5-72B-Instruct-GPTQ-Int4"
+    native_batch = True
+    # vllm.LLM はスレッドセーフではないため、1件ずつの呼び出しは直列に行う
+    max_concurrency = 1
+
+    # vllm.LLM に渡す引数（tensor_parallel_size、gpu_memory_utilization、max_model_len などを追加できる）
+    engine_options: Dict[str, object] = {"enable_prefix_caching": True}
+
+    def engine(self, model: str):
+        """モデルごとにプロセス内で1つだけ起動する推論エンジンを返す"""
+        return get_client((self.name, model), lambda: self.create_engine(model))
+
+    def create_engine(self, model: str):
+        """推論エンジンを起動する（モデルの読み込みに時間がかかる）"""
+        try:
+            from vllm import LLM
+        except ImportError:
+            raise ImportError("vllm_offline プロバイダーを使用するには vllm をインストールしてください（pip install -r requirements-vllm.txt）")
+        return LLM(model=model, **self.engine_options)
+
+    def sampling_params(self, max_tokens: int, schema: Optional[dict] = None):
+        """生成パラメータを作成する（schema を指定した場合はガイド付きデコーディングでJSONに制約する）"""
+        from vllm import SamplingParams
+        options = {"temperature": self.temperature, "max_tokens": max_tokens}
+        if schema is not None:
+            from vllm.sampling_params import GuidedDecodingParams
+            options["guided_decoding"] = GuidedDecodingParams(json=schema)
+        return SamplingParams(**options)
+
+    def complete(self, model: str, system_prompt: str, text: str, max_tokens: int, schema: Optional[dict] = None) -> CompletionResult:
+        request = {"system_prompt": system_prompt, "text": text, "max_tokens": max_tokens, "schema": schema}
+        return self.complete_batch(model, [request])[0]
+
+    def complete_batch(self, model: str, requests: List[dict]) -> List[CompletionResult]:
+        if not requests:
+            return []
+        # サーバー版と同じメッセージ構成にし、モデルのチャットテンプレートを適用して生成する
+        conversations = [
+            [
+                {"role": "system", "content": request["system_prompt"]},
+                {"role": "user", "content": f"テキスト: {request['text']}"}
+            ]
+            for request in requests
+        ]
+        params = [self.sampling_params(request["max_tokens"], request.get("schema")) for request in requests]
+        outputs = self.engine(model).chat(conversations, params, use_tqdm=False)
+        return [
+            CompletionResult(
+                output.outputs[0].text.strip(),
+                len(output.prompt_token_ids or []),
+                len(output.outputs[0].token_ids or []),
+                getattr(output, "num_cached_tokens", None)
+            )
+            for output in outputs
+        ]
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+プロバイダーのバッチAPIを利用したオフライン一括推論のバックエンド。
+
+リクエストはプロバイダーに依存しない辞書（custom_id, system_prompt, text, max_tokens, 任意で schema）で表し、
+各バックエンドがバッチファイルへの変換・投入・状態確認・結果取得を行う。
+LocalBatchBackend はネットワークを使わないファイルベースの代替実装で、パイプライン全体の動作確認に使用する。
+"""
+import json
+import os
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from .structured_output import RESULT_TOOL_NAME, is_strict_compatible
+
+# poll() が返す状態
+BATCH_IN_PROGRESS = "in_progress"
+BATCH_COMPLETED = "completed"
+BATCH_FAILED = "failed"
+
+
+class BatchBackend:
+    """バッチ推論バックエンドの基底クラス"""
+
+    def submit(self, requests: List[dict], work_dir: str) -> str:
+        """リクエストをバッチとして投入し、バッチIDを返す"""
+        raise NotImplementedError
+
+    def poll(self, batch_id: str) -> str:
+        """バッチの状態（BATCH_IN_PROGRESS / BATCH_COMPLETED / BATCH_FAILED）を返す"""
+        raise NotImplementedError
+
+    def fetch_results(self, batch_id: str) -> Dict[str, str]:
+        """完了したバッチの {custom_id: 応答テキスト} を返す（失敗したリクエストは含まない）"""
+        raise NotImplementedError
+
+
+def _write_jsonl(path: str, lines: List[dict]):
+    with open(path, "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """OpenAI Batch API（/v1/chat/completions）を使用するバックエンド"""
+
+    def __init__(self, client, model_name: str, temperature: float = 0.1):
+        self.client = client
+        self.model_name = model_name
+        self.temperature = temperature
+
+    def _build_body(self, request: dict) -> dict:
+        body = {
+            "model": self.model_name,
+            "messages": [
+                {"role": "system", "content": request["system_prompt"]},
+                {"role": "user", "content": f"テキスト: {request['text']}"}
+            ],
+            "temperature": self.temperature,
+            "max_tokens": request["max_tokens"]
+        }
+        schema = request.get("schema")
+        if schema is not None:
+            body["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "extraction_result", "schema": schema, "strict": is_strict_compatible(schema)}
+            }
+        return body
+
+    def submit(self, requests: List[dict], work_dir: str) -> str:
+        os.makedirs(work_dir, exist_ok=True)
+        input_path = os.path.join(work_dir, f"openai_batch_{uuid.uuid4().hex[:8]}.jsonl")
+        _write_jsonl(input_path, [{
+            "custom_id": request["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": self._build_body(request)
+        } for request in requests])
+        with open(input_path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    def poll(self, batch_id: str) -> str:
+        status = self.client.batches.retrieve(batch_id).status
+        if status == "completed":
+            return BATCH_COMPLETED
+        if status in ("failed", "expired", "cancelled"):
+            return BATCH_FAILED
+        return BATCH_IN_PROGRESS
+
+    def fetch_results(self, batch_id: str) -> Dict[str, str]:
+        batch = self.client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return {}
+        content = self.client.files.content(batch.output_file_id).text
+        results = {}
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            results[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return results
+
+
+class AnthropicBatchBackend(BatchBackend):
+    """Anthropic Message Batches API を使用するバックエンド"""
+
+    def __init__(self, client, model_name: str, temperature: float = 0.1):
+        self.client = client
+        self.model_name = model_name
+        self.temperature = temperature
+
+    def _build_params(self, request: dict) -> dict:
+        params = {
+            "model": self.model_name,
+            "max_tokens": request["max_tokens"],
+            "temperature": self.temperature,
+            "system": [{"type": "text", "text": request["system_prompt"], "cache_control": {"type": "ephemeral"}}],
+            "messages": [{"role": "user", "content": f"テキスト: {request['text']}"}]
+        }
+        schema = request.get("schema")
+        if schema is not None:
+            params["tools"] = [{"name": RESULT_TOOL_NAME, "description": "抽出結果を記録する", "input_schema": schema}]
+            params["tool_choice"] = {"type": "tool", "name": RESULT_TOOL_NAME}
+        return params
+
+    def submit(self, requests: List[dict], work_dir: str) -> str:
+        batch = self.client.messages.batches.create(requests=[{
+            "custom_id": request["custom_id"],
+            "params": self._build_params(request)
+        } for request in requests])
+        return batch.id
+
+    def poll(self, batch_id: str) -> str:
+        batch = self.client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            return BATCH_COMPLETED
+        if batch.processing_status == "canceling":
+            return BATCH_FAILED
+        return BATCH_IN_PROGRESS
+
+    def fetch_results(self, batch_id: str) -> Dict[str, str]:
+        results = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                content = entry.result.message.content
+                tool_inputs = [block.input for block in content if getattr(block, "type", None) == "tool_use"]
+                results[entry.custom_id] = json.dumps(tool_inputs[0], ensure_ascii=False) if tool_inputs else content[0].text
+        return results
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    ファイルベースのローカルバッチバックエンド（ネットワーク不要の代替実装）
+
+    投入されたリクエストを work_dir/<バッチID>/input.jsonl に保存し、最初の poll() で
+    responder を用いて処理して output.jsonl に書き出す。
+
+    Parameters:
+    - responder: リクエスト辞書を受け取り応答テキストを返す関数。
+      省略した場合は全てのリクエストに対して "N/A" を返す
+    - work_dir: 別プロセスで投入したバッチを参照する場合の作業ディレクトリ
+    """
+
+    def __init__(self, responder: Optional[Callable[[dict], str]] = None, work_dir: Optional[str] = None):
+        self.responder = responder or self._default_responder
+        self.work_dir = work_dir
+        self._batch_dirs: Dict[str, str] = {}
+
+    @staticmethod
+    def _default_responder(request: dict) -> str:
+        return json.dumps({"result": "N/A", "reason": "ローカルバッチによる応答"}, ensure_ascii=False)
+
+    def submit(self, requests: List[dict], work_dir: str) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        batch_dir = os.path.join(work_dir, batch_id)
+        os.makedirs(batch_dir, exist_ok=True)
+        _write_jsonl(os.path.join(batch_dir, "input.jsonl"), requests)
+        self._batch_dirs[batch_id] = batch_dir
+        return batch_id
+
+    def _get_batch_dir(self, batch_id: str) -> str:
+        if batch_id in self._batch_dirs:
+            return self._batch_dirs[batch_id]
+        if self.work_dir and os.path.isdir(os.path.join(self.work_dir, batch_id)):
+            return os.path.join(self.work_dir, batch_id)
+        raise ValueError(f"バッチ '{batch_id}' が見つかりません")
+
+    def poll(self, batch_id: str) -> str:
+        batch_dir = self._get_batch_dir(batch_id)
+        output_path = os.path.join(batch_dir, "output.jsonl")
+        if not os.path.exists(output_path):
+            outputs = []
+            with open(os.path.join(batch_dir, "input.jsonl"), "r", encoding="utf-8") as f:
+                for line in f:
+                    request = json.loads(line)
+                    try:
+                        outputs.append({"custom_id": request["custom_id"], "response": self.responder(request)})
+                    except Exception as e:
+                        outputs.append({"custom_id": request["custom_id"], "error": str(e)})
+            _write_jsonl(output_path, outputs)
+        return BATCH_COMPLETED
+
+    def fetch_results(self, batch_id: str) -> Dict[str, str]:
+        output_path = os.path.join(self._get_batch_dir(batch_id), "output.jsonl")
+        results = {}
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if "response" in entry:
+                    results[entry["custom_id"]] = entry["response"]
+        return results
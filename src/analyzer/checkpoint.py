@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+分析の途中経過を記録する追記専用のチェックポイントジャーナル。
+患者ごとの分析が完了するたびに (実行ID, テンプレートキー, 患者ID) 単位で1行のJSONを追記し、
+異常終了後の再開時には記録済みの患者をスキップできるようにする。
+"""
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+def _to_jsonable(value):
+    """numpyのスカラー型などをJSONに保存できる型に変換する"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(key): _to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(item) for item in value]
+    return value
+
+
+class CheckpointJournal:
+    """
+    JSONL形式のチェックポイントジャーナル
+
+    Parameters:
+    - path: ジャーナルファイルのパス（複数の実行で共有できる）
+    - fsync: Trueの場合は1行ごとにディスクへ同期する（電源断にも備える場合）
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._tail_checked = False
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def new_run_id() -> str:
+        """新しい実行IDを作成する（日時 + ランダムな接尾辞）"""
+        return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def patient_key(patient_id) -> str:
+        """患者IDをジャーナル上のキー（文字列）に変換する"""
+        return str(_to_jsonable(patient_id))
+
+    def record(self, run_id: str, template_key: str, patient_id, result, reason, **extra):
+        """1患者分の分析結果を追記する"""
+        entry = {
+            "run_id": run_id,
+            "template_key": template_key,
+            "patient_id": self.patient_key(patient_id),
+            "result": _to_jsonable(result),
+            "reason": _to_jsonable(reason),
+            "time": datetime.now().isoformat(timespec="seconds"),
+            **_to_jsonable(extra)
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if not self._tail_checked:
+                self._repair_tail()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+    def _repair_tail(self):
+        """
+        書き込み途中で終了した最終行（改行で終わらない行）があれば改行を追記する（ロック保持中に呼び出す）
+        そのまま追記すると次の記録が壊れた行と連結され、読み込み時に失われるため
+        """
+        try:
+            with open(self.path, "rb+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+        except FileNotFoundError:
+            pass
+        self._tail_checked = True
+
+    def load(self, run_id: str, template_key: Optional[str] = None) -> Dict[str, Dict[str, Tuple]]:
+        """
+        記録済みの結果を読み込む
+
+        Returns:
+        - Dict[str, Dict[str, Tuple]]: {テンプレートキー: {患者IDキー: (結果, 理由)}}
+          同じ患者が複数回記録されている場合は最後の記録を採用する
+        """
+        completed: Dict[str, Dict[str, Tuple]] = {}
+        if not os.path.exists(self.path):
+            return completed
+        with self._lock:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で終了した最終行などは無視する
+                        continue
+                    if entry.get("run_id") != run_id:
+                        continue
+                    if template_key is not None and entry.get("template_key") != template_key:
+                        continue
+                    completed.setdefault(entry["template_key"], {})[entry["patient_id"]] = (entry["result"], entry["reason"])
+        return completed
+
+    def completed(self, run_id: str, template_key: str) -> Dict[str, Tuple]:
+        """指定したテンプレートで記録済みの {患者IDキー: (結果, 理由)} を返す"""
+        return self.load(run_id, template_key).get(template_key, {})
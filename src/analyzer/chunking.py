@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+長い診療記録をトークン数の上限内のチャンクに分割し、チャンクごとの抽出結果を統合する（map-reduce）。
+
+結合テキストは "[YYYY-MM-DD]\\n本文" の記載が空行区切りで並んだ形式のため、
+日付見出しの境界で分割して記載の途中で切れないようにする。
+"""
+import re
+from typing import Callable, List, Optional, Set, Tuple
+
+from .usage import count_tokens_heuristic
+
+# 記載の境界（空行の直後に日付見出しが続く位置）
+_ENTRY_BOUNDARY = re.compile(r"\n\n(?=\[\d{4}-\d{2}-\d{2}\]\n)")
+
+# 情報が見つからなかったことを表す結果
+EMPTY_RESULTS = {"", "N/A", "記載なし", "null", "None", "なし"}
+
+MERGE_STRATEGIES = ("latest", "first", "all")
+
+
+def split_dated_entries(text: str) -> List[str]:
+    """結合テキストを日付見出しごとの記載に分割する"""
+    return [entry for entry in _ENTRY_BOUNDARY.split(text) if entry]
+
+
+def chunk_text(text: str, max_tokens: int, count_tokens: Callable[[str], int] = count_tokens_heuristic) -> List[str]:
+    """
+    結合テキストを、各チャンクが max_tokens 以内になるように日付の境界でまとめ直す
+
+    1つの記載だけで上限を超える場合は、その記載のみ文字数で分割する。
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    separator_tokens = count_tokens("\n\n")
+
+    for entry in split_dated_entries(text):
+        entry_tokens = count_tokens(entry)
+        if entry_tokens > max_tokens:
+            if current:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_long_entry(entry, max_tokens, count_tokens))
+            continue
+        if current and current_tokens + separator_tokens + entry_tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current_tokens += entry_tokens + (separator_tokens if current else 0)
+        current.append(entry)
+
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _split_long_entry(entry: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """上限を超える1つの記載を、日付見出しを各片に付けたうえで分割する"""
+    header, _, body = entry.partition("\n")
+    if not re.fullmatch(r"\[\d{4}-\d{2}-\d{2}\]", header):
+        header, body = "", entry
+    # トークン数と文字数の比率から1片あたりの文字数を見積もる
+    ratio = max(count_tokens(body), 1) / max(len(body), 1)
+    piece_length = max(1, int((max_tokens - count_tokens(header) - 1) / ratio))
+    pieces = [body[i:i + piece_length] for i in range(0, len(body), piece_length)]
+    return [f"{header}\n{piece}" if header else piece for piece in pieces]
+
+
+def infer_merge_strategy(system_prompt: Optional[str], template: Optional[dict] = None) -> str:
+    """
+    チャンクごとの結果の統合方法を決める
+
+    テンプレートの "merge"（latest / first / all）を使用する。指定がない場合のみ、
+    システムプロンプトの記述（「最初」「初回」→ first、「最新」→ latest）から判定し、警告を表示する
+    （プロンプトの言い回しを変えると統合方法が変わるため、テンプレートには "merge" を指定すること）。
+    """
+    if template and template.get("merge") in MERGE_STRATEGIES:
+        return template["merge"]
+    prompt = system_prompt or ""
+    if "最初" in prompt or "初回" in prompt:
+        strategy = "first"
+    elif "最新" in prompt:
+        strategy = "latest"
+    else:
+        strategy = "all"
+    _warn_inferred_strategy(template, prompt, strategy)
+    return strategy
+
+
+# 統合方法をプロンプトから判定した旨の警告を表示済みの (テンプレート名, プロンプト)
+_warned_prompts: Set[Tuple[str, str]] = set()
+
+
+def _warn_inferred_strategy(template: Optional[dict], prompt: str, strategy: str):
+    """統合方法をプロンプトから判定した場合の警告（患者ごとに表示しないよう、同じテンプレートでは1回のみ）"""
+    name = (template or {}).get("name", "テンプレートなし")
+    if (name, prompt) in _warned_prompts:
+        return
+    _warned_prompts.add((name, prompt))
+    invalid = (template or {}).get("merge")
+    detail = f"merge の値 '{invalid}' が不正なため" if invalid is not None else "merge（latest / first / all）の指定がないため"
+    print(f"警告: {name} に{detail}、システムプロンプトの記述から統合方法を '{strategy}' と判定しました")
+
+
+def _is_empty(result, default_value) -> bool:
+    if result is None or result == default_value:
+        return True
+    return isinstance(result, str) and result.strip() in EMPTY_RESULTS
+
+
+def reduce_chunk_results(outcomes: List[Tuple], strategy: str, default_value) -> Tuple:
+    """
+    日付順に並んだチャンクごとの (結果, 理由) を1つに統合する
+
+    - latest: 情報が見つかった最後のチャンクの結果
+    - first: 情報が見つかった最初のチャンクの結果
+    - all: 情報が見つかった全チャンクの結果を重複を除いて連結
+    二値分析（既定値がFalse）ではいずれかのチャンクで該当すれば該当とする。
+    """
+    found = [outcome for outcome in outcomes if not _is_empty(outcome[0], default_value)]
+    if not found:
+        return outcomes[-1] if outcomes else (default_value, "理由なし")
+    if default_value is False:
+        return found[-1]
+    if strategy == "first":
+        return found[0]
+    if strategy == "latest":
+        return found[-1]
+
+    results = list(dict.fromkeys(str(result) for result, _ in found))
+    reasons = list(dict.fromkeys(str(reason) for _, reason in found))
+    if len(results) == 1:
+        return found[0][0], " / ".join(reasons)
+    return " / ".join(results), " / ".join(reasons)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+LLMプロバイダーのクライアントをプロセス内で共有するモジュール。
+
+同期クライアントは (プロバイダー, APIキー, 接続先URL) ごとに1つだけ作成し、
+keep-aliveを有効にしたHTTPコネクションプールを全てのExcelAnalyzerインスタンスで共有する。
+非同期クライアントはイベントループごとに作成し（httpxの非同期接続はループをまたいで使えないため）、
+ループの終了前に aclose_async_clients で閉じる。
+Streamlitの再実行ごとにクライアントを作り直さないことで、TLSハンドシェイクやクライアント初期化の
+コストが各呼び出しの応答時間に含まれないようにする。
+クライアントの作成方法はプロバイダーごとのバックエンド（backends.py）が定義する。
+"""
+import asyncio
+import inspect
+import threading
+from typing import Callable, Dict, Tuple
+
+import httpx
+
+# コネクションプールの設定（同時実行数の上限より十分大きくする）
+HTTP_LIMITS = httpx.Limits(max_connections=128, max_keepalive_connections=64, keepalive_expiry=120)
+
+_clients: Dict[Tuple, object] = {}
+_async_clients: Dict[Tuple, object] = {}
+# Geminiの非同期クライアントは同期クライアントから作成するため、再入可能なロックを使用する
+_clients_lock = threading.RLock()
+
+
+def get_client(key: Tuple, factory: Callable[[], object]):
+    """
+    プロセス内で共有される同期クライアントを取得する
+
+    Parameters:
+    - key: クライアントを共有する単位（通常は (プロバイダー, APIキー, 接続先URL)）
+    - factory: クライアントが未作成の場合に呼び出す作成関数
+    """
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory()
+            _clients[key] = client
+        return client
+
+
+def get_async_client(key: Tuple, factory: Callable[[], object], owned: bool = True):
+    """
+    実行中のイベントループで共有される非同期クライアントを取得する（イベントループ内から呼び出すこと）
+
+    owned=False は、他のクライアントに属していてループの終了時に閉じてはならないもの（Geminiの .aio など）に指定する
+    """
+    loop = asyncio.get_running_loop()
+    loop_key = (*key, id(loop))
+    with _clients_lock:
+        # 終了したイベントループのクライアントは破棄する
+        for stale in [k for k, (entry_loop, _, _) in _async_clients.items() if entry_loop.is_closed()]:
+            del _async_clients[stale]
+        entry = _async_clients.get(loop_key)
+        # 同じidの別のループが作られた場合に備え、ループ自体も照合する
+        if entry is None or entry[0] is not loop:
+            entry = (loop, factory(), owned)
+            _async_clients[loop_key] = entry
+        return entry[1]
+
+
+async def aclose_async_clients():
+    """
+    実行中のイベントループで作成した非同期クライアントを閉じて破棄する
+    （asyncio.run などでループが終了する前に、そのループ内で呼び出すこと）
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        keys = [k for k, (entry_loop, _, _) in _async_clients.items() if entry_loop is loop]
+        entries = [_async_clients.pop(k) for k in keys]
+    for _, client, owned in entries:
+        if not owned:
+            continue
+        # httpx は aclose、OpenAI・AnthropicのSDKは close（コルーチン）で接続を閉じる
+        close = getattr(client, "aclose", None) or getattr(client, "close", None)
+        if not callable(close):
+            continue
+        try:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            pass
+
+
+def close_clients():
+    """共有クライアントを全て破棄する（接続を閉じる）"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _async_clients.clear()
+    for client in clients:
+        close = getattr(client, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception:
+                pass
@@ -1,43 +1,137 @@
 # 必要なライブラリのインポート
 import pandas as pd
-from typing import List, Optional, Dict, Literal
-from openai import OpenAI
-from google import genai
-from google.genai import types
-from time import sleep
+from typing import List, Optional, Dict, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import hashlib
 import json
+import logging
 import numpy as np
-from anthropic import Anthropic
-import requests
 import os
+import subprocess
+import threading
+import time
+from functools import lru_cache
+from types import MappingProxyType
+from .rate_limiter import get_rate_limiter, get_retry_delay
+from .backends import BACKENDS, ProviderBackend, create_backend, get_backend_class
+from .clients import aclose_async_clients
+from .response_cache import ResponseCache
+from .checkpoint import CheckpointJournal
+from .metrics import MetricsCollector
+from .jobs import AnalysisCancelledError, CancellationToken
+from .chunking import chunk_text, infer_merge_strategy, reduce_chunk_results
+from .usage import DEFAULT_LATENCY_SEC, BudgetExceededError, UsageTracker, estimate_cost, get_pricing
+from .structured_output import (
+    build_fused_schema, build_repair_prompt, check_response, get_template_schema, parse_json, strip_code_fence
+)
+from .batch import BatchBackend, BATCH_COMPLETED, BATCH_FAILED
+from .sharding import shard_of, validate_shard
+
+# 応答の内容など患者情報を含みうる出力はDEBUGレベルでのみ記録する
+logger = logging.getLogger(__name__)
+
+# 残りの患者の分析を中止する例外（予算上限・停止の要求）
+_STOP_ERRORS = (BudgetExceededError, AnalysisCancelledError)
+
+# 差分実行に使用する指紋（テンプレートのバージョンと結合テキストのハッシュ）を格納する列の接尾辞
+FINGERPRINT_SUFFIX = "_fingerprint"
+
+# 列指向形式（Parquet/Feather）で型が混在する列をJSON文字列として保存したことを記録する属性名
+# （データフレームの attrs としてファイルのメタデータに保存され、読み込み時に元の型に戻す）
+JSON_COLUMNS_ATTR = "json_columns"
+
+# 一時的な失敗のため指紋を記録せず、次回の差分実行で再分析する結果の理由
+_RETRY_REASONS = {"エラーが発生しました", "バッチでの応答が得られませんでした"}
+
+def _json_default(value):
+    """JSONに変換できない値（NumPyのスカラーなど）の変換"""
+    return value.item() if hasattr(value, "item") else str(value)
+
+@lru_cache(maxsize=None)
+def _read_env_from_zshrc(env_var_name: str) -> Optional[str]:
+    """
+    .zshrcを読み込んだシェルから環境変数の値を取得する
+    （シェルの起動は遅いため、環境変数ごとにプロセス内で1回だけ実行して結果を再利用する）
+    """
+    zshrc_path = os.path.join(os.path.expanduser("~"), ".zshrc")
+    if not os.path.exists(zshrc_path):
+        return None
+    try:
+        cmd = f"source {zshrc_path} && echo ${env_var_name}"
+        result = subprocess.check_output(cmd, shell=True, text=True, executable='/bin/zsh').strip()
+    except Exception as e:
+        print(f".zshrcからの環境変数取得に失敗: {str(e)}")
+        return None
+    if result:
+        print(f".zshrcから{env_var_name}を取得しました: {result[:5]}...")
+        return result
+    print(f".zshrcから{env_var_name}を取得できませんでした")
+    return None
+
 
 class ExcelAnalyzer:
     """
     医療テキストデータの分析を行うクラス。
     Excelファイルから医療記録を読み込み、LLMを使用して様々な情報を抽出・分析する。
     """
-    # 各プロバイダーの環境変数名を定義
-    ENV_VAR_NAMES = {
-        "vllm": None,
-        "openai": "OPENAI_API_KEY",
-        "gemini": "GOOGLE_API_KEY",
-        "claude": "ANTHROPIC_API_KEY",
-        "deepseek": "DEEPSEEK_API_KEY"
-    }
+    # 各プロバイダーの環境変数名とデフォルトのレート制限（None は制限なし）。
+    # 値は各バックエンド（backends.py）の定義から作成する
+    ENV_VAR_NAMES = {name: backend.api_key_env for name, backend in BACKENDS.items()}
+    DEFAULT_RATE_LIMITS = {name: dict(backend.default_rate_limits) for name, backend in BACKENDS.items()}
 
     def __init__(self, 
-                 llm_server_url: str = "http://localhost:8000",
+                 llm_server_url: Union[str, List[str], Dict[str, float]] = "http://localhost:8000",
                  template_path: str = None,
-                 provider: Literal["vllm", "openai", "gemini", "claude", "deepseek"] = "vllm",
-                 api_key: Optional[str] = None):
+                 provider: str = "vllm",
+                 api_key: Optional[str] = None,
+                 max_workers: int = 1,
+                 rate_limits: Optional[Dict[str, Optional[float]]] = None,
+                 max_retries: int = 5,
+                 cache_path: Optional[str] = None,
+                 cache_max_entries: int = 100_000,
+                 cache_max_age_days: float = 30,
+                 checkpoint_path: Optional[str] = None,
+                 max_input_tokens: int = 4000,
+                 budget_usd: Optional[float] = None,
+                 use_async: bool = False,
+                 backend_options: Optional[dict] = None,
+                 backend: Optional[ProviderBackend] = None,
+                 response_cache: Optional[ResponseCache] = None):
         """
         Parameters:
-        - llm_server_url: OpenAI互換のvLLMサーバーのURL（デフォルトはlocalhost:8000）
+        - llm_server_url: OpenAI互換のvLLMサーバーのURL（デフォルトはlocalhost:8000）。
+          複数のサーバーを使用する場合はURLのリスト（カンマ・改行区切りの文字列も可）または {URL: 重み} を指定する。
+          リクエストは各サーバーに振り分けられ、障害が発生したサーバーの分は残りのサーバーに再送される
         - template_path: プロンプトテンプレートのJSONファイルパス
-        - provider: 使用するLLMプロバイダー
+        - provider: 使用するLLMプロバイダー（vllm / openai / gemini / claude / deepseek、
+          または register_backend で登録したバックエンド名）
         - api_key: APIキー（vllm以外のプロバイダーで必要）。未指定の場合は環境変数から取得
+        - max_workers: 患者ごとのLLM呼び出しの同時実行数（1の場合は逐次実行）
+        - rate_limits: {"requests_per_minute": ..., "tokens_per_minute": ...} 形式のレート制限。
+          未指定の場合はバックエンドごとのデフォルト値を使用
+        - max_retries: 429/5xx応答時の最大再試行回数
+        - cache_path: LLM応答キャッシュ（SQLite）のパス。未指定の場合はキャッシュしない
+        - cache_max_entries: キャッシュの最大件数
+        - cache_max_age_days: キャッシュの保持期間（日）
+        - checkpoint_path: チェックポイントジャーナル（JSONL）のパス。指定した場合は
+          start_run / resume_run で設定した実行IDごとに患者単位の結果を逐次記録する
+        - max_input_tokens: 1回の呼び出しで送る患者テキストのトークン数の上限。
+          超える場合は日付単位のチャンクに分割して抽出し、結果を統合する
+        - budget_usd: 料金の上限（USD）。使用額と実行中の呼び出しの見込み額の合計が達した時点で
+          未着手の患者の分析を中止する。料金が不明なモデル（MODEL_PRICING にないモデル）では機能しない
+        - use_async: Trueの場合、テンプレートごとの分析を非同期クライアントで実行する
+          （スレッドの代わりにイベントループ上で max_workers 件まで同時に呼び出す）。
+          非同期に対応していないバックエンドではスレッドで実行する
+        - backend_options: バックエンド固有の引数（vLLMの routing（least_outstanding / weighted）、
+          health_check_interval など）
+        - backend: 作成済みのバックエンド（provider と同じプロバイダーのもの）。指定した場合は新たに作成せず、
+          他のインスタンスとバックエンドの状態（Geminiのキャッシュ済みコンテンツなど）を共有する
+        - response_cache: 作成済みの応答キャッシュ。指定した場合は cache_path より優先し、接続を共有する
         """
         self.file_path = None
+        # IDごとの結合テキストのキャッシュ（入力データまたは列マッピングの変更時に破棄）
+        self._combined_texts_cache: Optional[dict] = None
         self.df = None
         self.column_mapping = {
             'id_column': 'ID',
@@ -46,15 +140,60 @@ class ExcelAnalyzer:
         }
         
         self.provider = provider
+        backend_class = get_backend_class(provider)
         # APIキーが指定されていない場合は環境変数から取得
         self.api_key = api_key or self._get_api_key_from_env()
         self.llm_server_url = llm_server_url
+        self.max_workers = max(1, int(max_workers))
+        self.use_async = use_async
+        self.backend_options = backend_options or {}
+        self.max_retries = max_retries
+        
+        # 生成パラメータ（キャッシュキーにも使用）
+        self.temperature = 0.1
+        self.max_tokens = 512
+        self.max_input_tokens = max_input_tokens
+        
+        # トークン使用量と料金の集計（予算上限の判定にも使用）
+        self.usage = UsageTracker(budget_usd)
         
-        # プロバイダー別のクライアント初期化
-        self._initialize_client()
+        # 呼び出しごとの計測値（応答時間・待機時間・トークン数・再試行・キャッシュヒットなど）
+        self.metrics = MetricsCollector()
+        # 計測値を集計する単位（実行中のテンプレートキー）
+        self._metrics_label: Optional[str] = None
+        
+        # 分析の停止要求（バックグラウンドのジョブから設定する）
+        self.cancel_token: Optional[CancellationToken] = None
+        
+        # LLM応答の永続キャッシュ
+        self.cache = response_cache
+        if self.cache is None and cache_path:
+            self.cache = ResponseCache(cache_path, max_entries=cache_max_entries, max_age_days=cache_max_age_days)
+        
+        # 再開可能な実行のためのチェックポイントジャーナル
+        self.checkpoint = CheckpointJournal(checkpoint_path) if checkpoint_path else None
+        self.run_id: Optional[str] = None
+        
+        # 差分実行で比較する前回の分析結果（患者IDキーをインデックスとする。load_previous_results で設定）
+        self.previous_results: Optional[pd.DataFrame] = None
+        
+        # プロバイダー単位で共有されるレートリミッター
+        limits = {**backend_class.default_rate_limits, **(rate_limits or {})}
+        self.rate_limiter = get_rate_limiter(
+            self.provider,
+            requests_per_minute=limits.get("requests_per_minute"),
+            tokens_per_minute=limits.get("tokens_per_minute")
+        )
+        
+        # プロバイダー別のバックエンド（クライアント）の初期化
+        if backend is not None:
+            self.backend: ProviderBackend = backend
+        else:
+            self._initialize_client()
         
         # デフォルトのモデル名を設定
         self.model_name = self._get_default_model()
+        self._warn_unpriced_budget()
         
         # プロンプトテンプレートの保存用辞書
         self.templates: Dict = {}
@@ -63,90 +202,130 @@ class ExcelAnalyzer:
 
     def _get_api_key_from_env(self) -> Optional[str]:
         """環境変数からAPIキーを取得"""
-        if self.provider == "vllm":
-            return None
-        
-        env_var_name = self.ENV_VAR_NAMES.get(self.provider.lower())
+        env_var_name = get_backend_class(self.provider).api_key_env
         if not env_var_name:
-            print(f"警告: プロバイダー '{self.provider}' の環境変数名が定義されていません")
+            # vLLMなどAPIキーが不要なバックエンド
             return None
-            
-        # .zshrcから環境変数を読み込み
-        try:
-            import subprocess
-            import os
-            
-            # ユーザーのホームディレクトリを取得
-            home = os.path.expanduser("~")
-            zshrc_path = os.path.join(home, ".zshrc")
-            
-            # .zshrcを読み込んで環境変数を設定
-            cmd = f"source {zshrc_path} && echo ${env_var_name}"
-            result = subprocess.check_output(cmd, shell=True, text=True, executable='/bin/zsh').strip()
-            
-            if result:
-                print(f".zshrcから{env_var_name}を取得しました: {result[:5]}...")
-                # 環境変数を現在のプロセスにも設定
-                os.environ[env_var_name] = result
-                return result
-            else:
-                print(f".zshrcから{env_var_name}を取得できませんでした")
-        except Exception as e:
-            print(f".zshrcからの環境変数取得に失敗: {str(e)}")
 
-        if self.provider != "vllm":
-            raise ValueError(f"{self.provider}のAPIキーが必要です。環境変数 {env_var_name} を設定してください。\n"
-                           f"現在の環境変数の状態:\n"
-                           f"- os.getenv: {os.getenv(env_var_name)}\n"
-                           f"- .zshrc: {subprocess.check_output(f'source {zshrc_path} && echo ${env_var_name}', shell=True, text=True, executable='/bin/zsh').strip()}")
-        
-        return None
+        # プロセスの環境変数を優先し、設定されていない場合のみ.zshrcを読み込む
+        api_key = os.environ.get(env_var_name, "").strip()
+        if api_key:
+            return api_key
+
+        api_key = _read_env_from_zshrc(env_var_name)
+        if api_key:
+            # 環境変数を現在のプロセスにも設定
+            os.environ[env_var_name] = api_key
+            return api_key
+
+        raise ValueError(f"{self.provider}のAPIキーが必要です。環境変数 {env_var_name} を設定してください。\n"
+                       f"現在の環境変数の状態:\n"
+                       f"- os.getenv: {os.getenv(env_var_name)}\n"
+                       f"- .zshrc: 未設定")
 
     def _initialize_client(self):
-        """プロバイダー別のクライアントを初期化"""
-        if self.provider == "vllm":
-            self.client = OpenAI(
-                api_key="EMPTY",
-                base_url=self.llm_server_url
-            )
-        elif self.provider == "openai":
-            if not self.api_key:
-                raise ValueError("OpenAIのAPIキーが必要です")
-            self.client = OpenAI(api_key=self.api_key)
-        elif self.provider == "gemini":
-            if not self.api_key:
-                raise ValueError("Google Cloud APIキーが必要です")
-            self.client = genai.Client(api_key=self.api_key)
-        elif self.provider == "claude":
-            if not self.api_key:
-                raise ValueError("AnthropicのAPIキーが必要です")
-            self.client = Anthropic(api_key=self.api_key)
-        elif self.provider == "deepseek":
-            if not self.api_key:
-                raise ValueError("DeepseekのAPIキーが必要です")
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.deepseek.com/v1"
-            )
+        """
+        プロバイダー別のバックエンドを作成する（APIキーが必要なバックエンドでキーがない場合はValueError）
+        クライアントはプロセス内で共有され、同じ設定の別のインスタンスとコネクションプールを共用する
+        """
+        self.backend: ProviderBackend = create_backend(
+            self.provider, api_key=self.api_key, base_url=self._client_base_url(), temperature=self.temperature,
+            **self.backend_options
+        )
+
+    def _client_base_url(self) -> Optional[str]:
+        """クライアントの接続先URL（vLLMのみ。その他はプロバイダーの既定値）"""
+        return self.llm_server_url if self.provider == "vllm" else None
+
+    @property
+    def client(self):
+        """バックエンドが使用する同期クライアント"""
+        return self.backend.client
+
+    @client.setter
+    def client(self, value):
+        self.backend.client = value
 
     def _get_default_model(self) -> str:
         """プロバイダー別のデフォルトモデルを返す"""
-        defaults = {
-            "vllm": "Qwen/Qwen2.5-72B-Instruct-GPTQ-Int4",
-            "openai": "gpt-4o-mini-2024-07-18",
-            "gemini": "gemini-2.0-flash-lite",
-            "claude": "claude-3-5-haiku-latest",
-            "deepseek": "deepseek-chat"
-        }
-        return defaults.get(self.provider, "")
+        return self.backend.default_model
+
+    def _effective_workers(self, max_workers: Optional[int] = None) -> int:
+        """同時実行数（バックエンドが宣言する上限を超えない値）を返す"""
+        max_workers = max(1, int(max_workers or self.max_workers))
+        if self.backend.max_concurrency:
+            max_workers = min(max_workers, self.backend.max_concurrency)
+        return max_workers
+
+    @property
+    def df(self) -> Optional[pd.DataFrame]:
+        """読み込まれた医療記録データ"""
+        return self._df
+
+    @df.setter
+    def df(self, value: Optional[pd.DataFrame]):
+        # データが差し替えられた場合は結合テキストを作り直す
+        self._df = value
+        self._combined_texts_cache = None
+
+    def set_data(self, df: pd.DataFrame, combined_texts: Optional[dict] = None):
+        """
+        読み込み済みのデータを設定する
+
+        Parameters:
+        - df: 医療記録データ
+        - combined_texts: 同じデータと列マッピングで作成済みの結合テキスト（combined_texts の値）。
+          指定した場合は結合を省略する（Streamlitの再実行・分析ジョブの間で再利用するため）
+        """
+        self.df = df
+        if combined_texts is not None:
+            self._combined_texts_cache = dict(combined_texts)
+
+    @property
+    def combined_texts(self) -> MappingProxyType:
+        """
+        IDごとに日付順で結合したテキストの読み取り専用ビュー。
+        初回アクセス時に作成し、load_excel・set_column_mapping・dfの差し替えまで再利用する。
+        """
+        return MappingProxyType(self._combine_texts_by_id())
 
     def set_column_mapping(self, id_column: str, date_column: str, text_column: str):
         """列名のマッピングを設定する"""
-        self.column_mapping = {
+        column_mapping = {
             'id_column': id_column,
             'date_column': date_column,
             'text_column': text_column
         }
+        if column_mapping != self.column_mapping:
+            self.column_mapping = column_mapping
+            self._combined_texts_cache = None
+
+    def select_shard(self, shard_index: int, num_shards: int) -> bool:
+        """
+        読み込んだデータを指定したシャードの患者の行のみに絞り込む（複数のプロセス・ノードでの分担用）
+
+        患者IDのハッシュでシャードを決めるため、同じ患者の行はすべて同じシャードに入り、
+        各シャードの結果を merge_results でまとめると全患者の結果になる。
+
+        Parameters:
+        - shard_index: 分析するシャードの番号（0 〜 num_shards-1）
+        - num_shards: シャード数
+        """
+        if not self._validate_data():
+            return False
+        try:
+            validate_shard(shard_index, num_shards)
+        except ValueError as e:
+            print(f"エラー: {str(e)}")
+            return False
+
+        id_values = self.df[self.column_mapping['id_column']]
+        # 同じIDの行が多いため、ユニークなIDごとにシャードを計算する
+        shards = {id_val: shard_of(id_val, num_shards) for id_val in id_values.dropna().unique()}
+        self.df = self.df[id_values.map(shards) == shard_index].reset_index(drop=True)
+        self._combined_texts_cache = None
+        print(f"シャード {shard_index + 1}/{num_shards} を選択しました（{self.df[self.column_mapping['id_column']].nunique()}件の患者）")
+        return True
 
     def _validate_data(self) -> bool:
         """データが読み込まれているかを確認"""
@@ -155,11 +334,72 @@ class ExcelAnalyzer:
             return False
         return True
 
-    def load_excel(self, file_path: str) -> bool:
-        """Excelファイルを読み込み、必須列の存在チェックを行う"""
+    @staticmethod
+    def _detect_format(file_path: str) -> str:
+        """拡張子からファイル形式（excel / csv / parquet / feather）を判定する"""
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension in (".csv", ".tsv", ".txt"):
+            return "csv"
+        if extension in (".parquet", ".pq"):
+            return "parquet"
+        if extension in (".feather", ".arrow", ".ipc"):
+            return "feather"
+        return "excel"
+
+    @classmethod
+    def read_columns(cls, file_path: str) -> List[str]:
+        """
+        ファイルのヘッダー行のみを読み込み、列名の一覧を返す（列選択UI用）
+
+        Excelは読み取り専用モードで先頭行のみを読むため、巨大なファイルでも全体は読み込まない。
+        """
+        file_format = cls._detect_format(file_path)
+        if file_format == "csv":
+            sep = "\t" if file_path.lower().endswith(".tsv") else ","
+            return pd.read_csv(file_path, nrows=0, sep=sep).columns.tolist()
+        if file_format == "parquet":
+            import pyarrow.parquet as pq
+            return pq.read_schema(file_path).names
+        if file_format == "feather":
+            import pyarrow.ipc as ipc
+            with ipc.open_file(file_path) as reader:
+                return reader.schema.names
+        if file_path.lower().endswith(".xls"):
+            return pd.read_excel(file_path, nrows=0).columns.tolist()
+
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            header = next(workbook.active.iter_rows(max_row=1, values_only=True), ())
+            return [col for col in header if col is not None]
+        finally:
+            workbook.close()
+
+    def load_excel(self, file_path: str, mapped_columns_only: bool = False, chunk_size: int = 50_000) -> bool:
+        """
+        Excelファイルを読み込み、必須列の存在チェックを行う
+
+        Parameters:
+        - file_path: 入力ファイルのパス（.xlsx / .csv / .parquet / .feather）。形式は拡張子から判定する
+        - mapped_columns_only: Trueの場合はマッピングされた3列（ID・日付・テキスト）のみを
+          chunk_size行ずつストリーミングで読み込む。ピークメモリはシート全体ではなく3列分に比例する。
+        - chunk_size: ストリーミング読み込み時の1チャンクの行数
+        """
         self.file_path = file_path
         try:
-            self.df = pd.read_excel(self.file_path)
+            if mapped_columns_only:
+                # 必須列の存在チェック（ヘッダーのみを読む）
+                header = self.read_columns(self.file_path)
+                missing_columns = [col for col in self.column_mapping.values() if col not in header]
+                if missing_columns:
+                    print(f"エラー: 以下の必須列が見つかりません: {', '.join(missing_columns)}")
+                    print(f"必要な列名: {', '.join(self.column_mapping.values())}")
+                    return False
+                self.df = self._read_mapped_columns(self.file_path, chunk_size)
+                print("ファイルの読み込みが完了しました")
+                return True
+
+            self.df = self._read_table(self.file_path)
             
             # 必須列の存在チェック
             missing_columns = [col for col in self.column_mapping.values() if col not in self.df.columns]
@@ -178,6 +418,66 @@ class ExcelAnalyzer:
             print(f"エラー: ファイルの読み込み中にエラーが発生しました: {str(e)}")
             return False
 
+    def _read_mapped_columns(self, file_path: str, chunk_size: int) -> pd.DataFrame:
+        """マッピングされた3列のみをチャンク単位で読み込み、コンパクトな型に変換して結合する"""
+        columns = list(dict.fromkeys(self.column_mapping.values()))
+        file_format = self._detect_format(file_path)
+
+        if file_format == "csv":
+            sep = "\t" if file_path.lower().endswith(".tsv") else ","
+            chunks = [self._compact_chunk(chunk) for chunk in pd.read_csv(file_path, usecols=columns, sep=sep, chunksize=chunk_size)]
+        elif file_format == "parquet":
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(file_path)
+            chunks = [self._compact_chunk(batch.to_pandas())
+                      for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns)]
+        elif file_format == "feather":
+            # Featherはメモリマップで必要な列のみを読み込む
+            chunks = [self._compact_chunk(pd.read_feather(file_path, columns=columns))]
+        elif file_path.lower().endswith(".xls"):
+            # 旧形式のExcelはopenpyxlで読めないため、列を絞ってpandasで読み込む
+            chunks = [self._compact_chunk(pd.read_excel(file_path, usecols=columns))]
+        else:
+            chunks = list(self._iter_excel_chunks(file_path, columns, chunk_size))
+
+        if not chunks:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(chunks, ignore_index=True)
+
+    def _iter_excel_chunks(self, file_path: str, columns: List[str], chunk_size: int):
+        """openpyxlの読み取り専用モードで行をストリーミングし、必要な列のみのDataFrameを順に返す"""
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            indices = [header.index(col) for col in columns]
+            buffer = {col: [] for col in columns}
+            for row in rows:
+                values = [row[index] if index < len(row) else None for index in indices]
+                # 空行は読み飛ばす（pandas.read_excelと同様）
+                if all(value is None for value in values):
+                    continue
+                for col, value in zip(columns, values):
+                    buffer[col].append(value)
+                if len(buffer[columns[0]]) >= chunk_size:
+                    yield self._compact_chunk(pd.DataFrame(buffer, columns=columns))
+                    buffer = {col: [] for col in columns}
+            if buffer[columns[0]]:
+                yield self._compact_chunk(pd.DataFrame(buffer, columns=columns))
+        finally:
+            workbook.close()
+
+    def _compact_chunk(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """日付列を日付型に変換してメモリ使用量を抑える（変換できない場合はそのまま）"""
+        date_column = self.column_mapping['date_column']
+        if date_column in chunk.columns and not pd.api.types.is_datetime64_any_dtype(chunk[date_column]):
+            try:
+                chunk[date_column] = pd.to_datetime(chunk[date_column])
+            except (ValueError, TypeError):
+                pass
+        return chunk
+
     def display_data_info(self):
         """データの基本情報（行数、列一覧）を表示"""
         if not self._validate_data():
@@ -189,21 +489,41 @@ class ExcelAnalyzer:
             print(f"- {col}")
 
     def _combine_texts_by_id(self) -> dict:
-        """同一IDの自由記載を日付順に結合する"""
+        """同一IDの自由記載を日付順に結合する（結果はキャッシュされるため変更しないこと）"""
         if not self._validate_data():
             return {}
+        if self._combined_texts_cache is not None:
+            return self._combined_texts_cache
 
-        # 日付列を日付型に変換
-        self.df[self.column_mapping['date_column']] = pd.to_datetime(self.df[self.column_mapping['date_column']])
+        id_column = self.column_mapping['id_column']
+        date_column = self.column_mapping['date_column']
+        text_column = self.column_mapping['text_column']
+
+        # 日付列を日付型に変換（変換済みの場合は省略）
+        if not pd.api.types.is_datetime64_any_dtype(self.df[date_column]):
+            self.df[date_column] = pd.to_datetime(self.df[date_column])
         
-        # IDでグループ化し、日付でソート
+        # IDを出現順の整数コードに変換し、(ID, 日付) で1度だけ安定ソートする
+        id_codes, id_values = pd.factorize(self.df[id_column].to_numpy())
+        order = np.lexsort((self.df[date_column].values, id_codes))
+        order = order[id_codes[order] >= 0]  # 欠損IDの行は結合対象外
+
+        dates = self.df[date_column].dt.strftime('%Y-%m-%d').to_numpy()[order]
+        texts = self.df[text_column].to_numpy(dtype=object)[order]
+        entries = [f"[{date}]\n{text}" for date, text in zip(dates, texts)]
+
+        # ソート済みの記載をIDごとの件数で区切って結合する
+        counts = np.bincount(id_codes[order], minlength=len(id_values))
         combined_texts = {}
-        for id_val in self.df[self.column_mapping['id_column']].unique():
-            group = self.df[self.df[self.column_mapping['id_column']] == id_val].sort_values(self.column_mapping['date_column'])
-            texts = [f"[{row[self.column_mapping['date_column']].strftime('%Y-%m-%d')}]\n{row[self.column_mapping['text_column']]}" 
-                    for _, row in group.iterrows()]
-            combined_texts[id_val] = "\n\n".join(texts)
-        
+        start = 0
+        for id_val, count in zip(id_values, counts):
+            combined_texts[id_val] = "\n\n".join(entries[start:start + count])
+            start += count
+
+        if len(order) < len(id_codes):
+            # 欠損IDは従来どおり空文字列として出現順に含める
+            combined_texts = {id_val: combined_texts.get(id_val, "") for id_val in self.df[id_column].unique()}
+        self._combined_texts_cache = combined_texts
         return combined_texts
 
     def get_combined_texts(self, id_value: Optional[str] = None) -> Dict[str, str]:
@@ -224,25 +544,36 @@ class ExcelAnalyzer:
             print(f"警告: ID '{id_value}' が見つかりません")
             return {}
             
-        return combined_texts
+        # キャッシュを呼び出し元に変更されないよう複製して返す
+        return dict(combined_texts)
+
+
+    def set_templates(self, templates: Dict) -> bool:
+        """
+        読み込み済みのプロンプトテンプレートを設定する（Streamlitのキャッシュなど、ファイル以外から渡す場合に使用）
+
+        Parameters:
+        - templates: {テンプレートキー: テンプレート} の辞書（テンプレートファイルと同じ形式）
+        """
+        self.templates = templates
 
+        # テンプレートの形式を検証
+        required_keys = {"name", "analysis_type", "system_prompt"}
+        for key, template in self.templates.items():
+            missing_keys = required_keys - set(template.keys())
+            if missing_keys:
+                print(f"警告: テンプレート '{key}' に必要なキーが不足しています: {missing_keys}")
+                return False
+
+        print(f"テンプレートを読み込みました（{len(self.templates)}件）")
+        return True
 
     def load_templates(self, template_path: str) -> bool:
         """プロンプトテンプレートをJSONファイルから読み込む"""
         try:
             with open(template_path, 'r', encoding='utf-8') as f:
-                self.templates = json.load(f)
-                
-            # テンプレートの形式を検証
-            required_keys = {"name", "analysis_type", "system_prompt"}
-            for key, template in self.templates.items():
-                missing_keys = required_keys - set(template.keys())
-                if missing_keys:
-                    print(f"警告: テンプレート '{key}' に必要なキーが不足しています: {missing_keys}")
-                    return False
-                    
-            print(f"テンプレートを読み込みました（{len(self.templates)}件）")
-            return True
+                templates = json.load(f)
+            return self.set_templates(templates)
             
         except FileNotFoundError:
             print(f"エラー: テンプレートファイル '{template_path}' が見つかりません")
@@ -262,12 +593,15 @@ class ExcelAnalyzer:
 
         template = self.templates[template_key]
         # テンプレート名を含む列名を生成
-        column_name = f"分析結果_{template_key}_{template['analysis_type']}"
+        column_name = self._get_column_name(template_key)
         result = self.analyze_with_llm(
             analysis_type=template["analysis_type"],
             system_prompt=template["system_prompt"],
             progress_callback=progress_callback,
-            column_name=column_name  # 列名を渡す
+            column_name=column_name,  # 列名を渡す
+            template_key=template_key,
+            merge_strategy=infer_merge_strategy(template["system_prompt"], template),
+            schema=get_template_schema(template, template["analysis_type"])
         )
         
         return {
@@ -276,62 +610,548 @@ class ExcelAnalyzer:
             "analysis_type": template["analysis_type"]
         }
 
-    def analyze_with_llm(self, analysis_type: str = "extract", system_prompt: Optional[str] = None, progress_callback=None, column_name: Optional[str] = None) -> bool:
-        """LLMを使用して自由記載を分析し、結果を新しい列として追加"""
+    def analyze_with_templates(self, template_keys: List[str], progress_callback=None, max_workers: Optional[int] = None) -> Dict[str, dict]:
+        """
+        複数のテンプレートを1回のLLM呼び出しでまとめて分析する（患者ごとに1リクエスト）
+
+        各テンプレートのシステムプロンプトを1つの複合プロンプトにまとめ、
+        テンプレートキーごとの結果を持つJSONとして回答させる。
+        結果は analyze_with_template と同じ列（分析結果_{key}_{type} と _理由）に格納され、
+        解析できなかったテンプレートのみ個別の呼び出しで再分析する。
+
+        Returns:
+        - Dict[str, dict]: {テンプレートキー: analyze_with_template と同じ形式の結果}
+        """
+        missing_keys = [key for key in template_keys if key not in self.templates]
+        for key in missing_keys:
+            print(f"エラー: テンプレート '{key}' が見つかりません")
+        template_keys = [key for key in dict.fromkeys(template_keys) if key in self.templates]
+
+        summary = {key: {"success": False, "error": "テンプレートが見つかりません"} for key in missing_keys}
+        if not template_keys:
+            return summary
+        if not self._validate_data():
+            for key in template_keys:
+                summary[key] = self._template_summary(key, False)
+            return summary
+
+        try:
+            combined_texts = self._combine_texts_by_id()
+            fused_prompt = self._build_fused_prompt(template_keys)
+            fused_schema = build_fused_schema({
+                key: get_template_schema(self.templates[key], self.templates[key]["analysis_type"]) for key in template_keys
+            })
+            outcomes = {}  # {ID: {テンプレートキー: (結果, 理由)}}
+            total_items = len(combined_texts)
+            cache_baseline = self._cache_snapshot()
+
+            # チェックポイントまたは前回の結果（指紋が一致するもの）に全テンプレート分がある患者はスキップする
+            digests = self._text_digests(combined_texts)
+            fingerprints = {key: self._fingerprints(self._template_key_version(key), digests) for key in template_keys}
+            completed = {
+                key: {**self._reuse_previous(self._get_column_name(key), fingerprints[key]),
+                      **self._load_completed(key, combined_texts)}
+                for key in template_keys
+            }
+            for id_val in combined_texts:
+                if all(id_val in completed[key] for key in template_keys):
+                    outcomes[id_val] = {key: completed[key][id_val] for key in template_keys}
+            pending_texts = {id_val: text for id_val, text in combined_texts.items() if id_val not in outcomes}
+
+            def on_complete(id_val, patient_outcomes):
+                outcomes[id_val] = patient_outcomes
+                for key, (result, reason) in patient_outcomes.items():
+                    self._record_checkpoint(key, id_val, result, reason)
+                if progress_callback:
+                    callback_id = int(id_val) if isinstance(id_val, (np.int64, np.int32)) else id_val
+                    progress_callback(len(outcomes), total_items, self._with_cache_progress({
+                        "ID": callback_id,
+                        "結果": {key: value[0] for key, value in patient_outcomes.items()},
+                        "理由": {key: value[1] for key, value in patient_outcomes.items()}
+                    }, cache_baseline))
+
+            self._metrics_label = "+".join(template_keys)
+            finished = self._dispatch(
+                pending_texts,
+                lambda id_val, text: self._analyze_fused(id_val, text, template_keys, fused_prompt, fused_schema),
+                on_complete,
+                max_workers
+            )
+
+            # 予算上限・停止の要求で中止した場合、未分析の患者は既定値のまま（チェックポイントにも記録しない）
+            for key in template_keys:
+                default_value = self._get_default_value(self.templates[key]["analysis_type"])
+                unfinished = (default_value, self._unfinished_reason())
+                results = {id_val: outcomes.get(id_val, {key: unfinished})[key][0] for id_val in combined_texts}
+                reasons = {id_val: outcomes.get(id_val, {key: unfinished})[key][1] for id_val in combined_texts}
+                key_outcomes = {id_val: patient_outcomes[key] for id_val, patient_outcomes in outcomes.items()}
+                self._store_results(self._get_column_name(key), results, reasons, default_value,
+                                    self._completed_fingerprints(fingerprints[key], key_outcomes))
+                summary[key] = self._template_summary(key, finished)
+            return summary
+
+        except Exception as e:
+            print(f"エラー: LLM分析中にエラーが発生しました: {str(e)}")
+            for key in template_keys:
+                summary.setdefault(key, self._template_summary(key, False))
+            return summary
+
+    def _get_column_name(self, template_key: str) -> str:
+        """テンプレートの分析結果を格納する列名を返す"""
+        return f"分析結果_{template_key}_{self.templates[template_key]['analysis_type']}"
+
+    def _get_default_value(self, analysis_type: str):
+        """結果が得られなかった場合の既定値を返す"""
+        return False if analysis_type == "binary" else "N/A"
+
+    @property
+    def cancelled(self) -> bool:
+        """分析の停止が要求されているかを返す"""
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+    def _check_cancelled(self):
+        """分析の停止が要求されている場合は AnalysisCancelledError を送出する"""
+        if self.cancel_token is not None:
+            self.cancel_token.raise_if_cancelled()
+
+    def _unfinished_reason(self) -> str:
+        """中止により分析しなかった患者の理由"""
+        return "分析を停止したため未分析" if self.cancelled else "予算上限に達したため未分析"
+
+    def _template_summary(self, template_key: str, success: bool) -> dict:
+        """analyze_with_template と同じ形式の結果を作成する"""
+        template = self.templates[template_key]
+        return {
+            "success": success,
+            "template_name": template["name"],
+            "analysis_type": template["analysis_type"]
+        }
+
+    def _build_fused_prompt(self, template_keys: List[str]) -> str:
+        """複数テンプレートのシステムプロンプトを1つの複合プロンプトにまとめる"""
+        sections = [
+            "あなたは医療テキストから複数の項目を同時に抽出するアシスタントです。",
+            "以下の各タスクをそれぞれ独立に実行し、全タスクの結果を1つのJSONオブジェクトで返してください。",
+            ""
+        ]
+        for key in template_keys:
+            template = self.templates[key]
+            sections.append(f"### タスク: {key}（{template['name']}）")
+            sections.append(template["system_prompt"].strip())
+            sections.append("")
+
+        schema = ", ".join(f'"{key}": {{"result": "抽出結果", "reason": "抽出した記載場所と理由"}}' for key in template_keys)
+        sections.append("出力形式:")
+        sections.append("各タスクの個別の出力形式の指定にかかわらず、タスクキーをキーとする以下のJSON形式のみを返してください。")
+        sections.append(f"{{{schema}}}")
+        sections.append("説明や追加のコメントは不要です。")
+        return "\n".join(sections)
+
+    def _analyze_fused(self, id_val, text: str, template_keys: List[str], fused_prompt: str, fused_schema: Optional[dict] = None) -> Dict[str, tuple]:
+        """1患者分のテキストを複合プロンプトで分析し、{テンプレートキー: (結果, 理由)} を返す"""
+        patient_outcomes = {}
+        try:
+            # 1回の呼び出しに収まらない長いテキストは、テンプレートごとの分割抽出で処理する
+            if self._count_tokens(text) > self.max_input_tokens:
+                raise ValueError("テキストが長いため、テンプレートごとに分割して分析します")
+            response = self._call_structured(text, "extract", fused_prompt, fused_schema, max_tokens=512 * len(template_keys))
+            response_dict = parse_json(response)
+            if isinstance(response_dict, dict):
+                for key in template_keys:
+                    entry = response_dict.get(key)
+                    if isinstance(entry, dict) and entry:
+                        patient_outcomes[key] = self._to_outcome(entry, self._get_default_value(self.templates[key]["analysis_type"]))
+        except json.JSONDecodeError as e:
+            print(f"JSON解析エラー（複合プロンプト）: {str(e)}")
+        except _STOP_ERRORS:
+            raise
+        except Exception as e:
+            print(f"警告: ID {id_val} の複合分析中にエラーが発生: {str(e)}")
+
+        # 解析できなかったテンプレートのみ個別に再分析する
+        for key in template_keys:
+            if key not in patient_outcomes:
+                template = self.templates[key]
+                patient_outcomes[key] = self._analyze_single(
+                    id_val, text, template["analysis_type"], template["system_prompt"],
+                    self._get_default_value(template["analysis_type"]),
+                    infer_merge_strategy(template["system_prompt"], template),
+                    get_template_schema(template, template["analysis_type"])
+                )
+        return patient_outcomes
+
+    def _dispatch(self, combined_texts: dict, worker, on_complete, max_workers: Optional[int] = None) -> bool:
+        """
+        患者ごとに worker(id_val, text) を実行し、完了した順に on_complete(id_val, 戻り値) を呼び出す。
+        max_workers が2以上の場合はスレッドプールで並列に実行する。
+
+        Returns:
+        - bool: 全患者を処理した場合True。予算上限に達した、または停止が要求されたため中止した場合False
+          （中止した患者の on_complete は呼び出されない）
+        """
+        max_workers = self._effective_workers(max_workers)
+        if max_workers == 1:
+            for id_val, text in combined_texts.items():
+                try:
+                    outcome = worker(id_val, text)
+                except _STOP_ERRORS as e:
+                    print(f"警告: {str(e)}。残りの患者の分析を中止します")
+                    return False
+                on_complete(id_val, outcome)
+            return True
+
+        # コールバックは呼び出し元のスレッドで実行する（Streamlitの描画をワーカースレッドから行わないため）
+        stopped = False
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(worker, id_val, text): id_val
+                for id_val, text in combined_texts.items()
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    outcome = future.result()
+                except _STOP_ERRORS as e:
+                    if not stopped:
+                        print(f"警告: {str(e)}。残りの患者の分析を中止します")
+                        stopped = True
+                        # 未着手の患者は実行しない（実行中の呼び出しは完了を待つ）
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                on_complete(futures[future], outcome)
+        return not stopped
+
+    def _dispatch_async(self, combined_texts: dict, worker, on_complete, max_workers: Optional[int] = None) -> bool:
+        """
+        _dispatch の非同期版。worker(id_val, text) はコルーチンを返す関数で、
+        イベントループ上で最大 max_workers 件を同時に実行する。戻り値は _dispatch と同じ
+        """
+        max_workers = self._effective_workers(max_workers)
+
+        async def run() -> bool:
+            semaphore = asyncio.Semaphore(max_workers)
+
+            async def run_one(id_val, text):
+                async with semaphore:
+                    return id_val, await worker(id_val, text)
+
+            tasks = [asyncio.ensure_future(run_one(id_val, text)) for id_val, text in combined_texts.items()]
+            stopped = False
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    try:
+                        id_val, outcome = await next_done
+                    except _STOP_ERRORS as e:
+                        if not stopped:
+                            print(f"警告: {str(e)}。残りの患者の分析を中止します")
+                            stopped = True
+                            for task in tasks:
+                                task.cancel()
+                        continue
+                    except asyncio.CancelledError:
+                        continue
+                    # コールバックはイベントループを実行しているスレッド（呼び出し元）で実行される
+                    on_complete(id_val, outcome)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            return not stopped
+
+        return self._run_async(run())
+
+    @staticmethod
+    def _run_async(coroutine):
+        """
+        コルーチンを新しいイベントループで実行して結果を返す（既にイベントループが動作中の場合は別スレッドで実行する）
+        ループで作成した非同期クライアントは、ループの終了前に閉じる
+        """
+        async def run_and_close():
+            try:
+                return await coroutine
+            finally:
+                await aclose_async_clients()
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(run_and_close())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, run_and_close()).result()
+
+    def start_run(self, run_id: Optional[str] = None) -> str:
+        """
+        チェックポイントに記録する実行IDを設定する
+
+        Parameters:
+        - run_id: 実行ID。省略した場合は新しいIDを作成する
+
+        Returns:
+        - str: 設定した実行ID（resume_runで再開する際に使用する）
+        """
+        if self.checkpoint is None:
+            print("警告: checkpoint_pathが指定されていないため、チェックポイントは記録されません")
+        self.run_id = run_id or CheckpointJournal.new_run_id()
+        return self.run_id
+
+    def resume_run(self, run_id: str, template_keys: List[str], progress_callback=None, fused: bool = False) -> Dict[str, dict]:
+        """
+        中断した実行を再開する。チェックポイントに記録済みの患者はLLMを呼び出さずに結果を復元する。
+
+        Parameters:
+        - run_id: 再開する実行ID
+        - template_keys: 実行するテンプレートキーのリスト
+        - fused: Trueの場合は analyze_with_templates でまとめて実行する
+
+        Returns:
+        - Dict[str, dict]: {テンプレートキー: analyze_with_template と同じ形式の結果}
+        """
+        if self.checkpoint is None:
+            print("エラー: checkpoint_pathが指定されていないため再開できません")
+            return {key: {"success": False, "error": "チェックポイントが設定されていません"} for key in template_keys}
+        self.start_run(run_id)
+        if fused:
+            return self.analyze_with_templates(template_keys, progress_callback=progress_callback)
+        return {key: self.analyze_with_template(key, progress_callback=progress_callback) for key in template_keys}
+
+    def _load_completed(self, checkpoint_key: str, combined_texts: dict) -> dict:
+        """現在の実行でチェックポイントに記録済みの {ID: (結果, 理由)} を返す"""
+        if self.checkpoint is None or self.run_id is None:
+            return {}
+        recorded = self.checkpoint.completed(self.run_id, checkpoint_key)
+        if not recorded:
+            return {}
+        completed = {}
+        for id_val in combined_texts:
+            key = CheckpointJournal.patient_key(id_val)
+            # 一時的な失敗が記録されている場合（以前のバージョンで記録したジャーナル）は再分析する
+            if key in recorded and recorded[key][1] not in _RETRY_REASONS:
+                completed[id_val] = recorded[key]
+        if completed:
+            print(f"チェックポイントから{len(completed)}件の結果を復元しました（{checkpoint_key}）")
+        return completed
+
+    def _record_checkpoint(self, checkpoint_key: str, id_val, result, reason):
+        """
+        1患者分の結果をチェックポイントに追記する
+        （APIエラーなどの一時的な失敗は完了として記録せず、再開時に再分析する）
+        """
+        if reason in _RETRY_REASONS:
+            return
+        if self.checkpoint is not None and self.run_id is not None:
+            self.checkpoint.record(self.run_id, checkpoint_key, id_val, result, reason)
+
+    def _cache_snapshot(self) -> Optional[tuple]:
+        """実行開始時点のキャッシュのヒット数・ミス数を返す"""
+        if self.cache is None:
+            return None
+        return self.cache.hits, self.cache.misses
+
+    def _with_cache_progress(self, payload: dict, baseline: Optional[tuple]) -> dict:
+        """進捗通知にこの実行でのキャッシュのヒット数・ミス数を追加する"""
+        if self.cache is not None and baseline is not None:
+            payload["キャッシュ"] = {
+                "ヒット": self.cache.hits - baseline[0],
+                "ミス": self.cache.misses - baseline[1]
+            }
+        return payload
+
+    def _store_results(self, column_name: str, results: dict, reasons: dict, default_value, fingerprints: Optional[dict] = None):
+        """
+        IDごとの結果と理由を列として追加する
+
+        fingerprints（{ID: 指紋}）を指定した場合は {列名}_fingerprint の列にも格納する。
+        指紋のない患者（未分析・一時的な失敗）は空文字列となり、次回の差分実行で再分析される
+        """
+        id_values = self.df[self.column_mapping['id_column']]
+        self.df[column_name] = id_values.map(results).fillna(default_value)
+        self.df[f"{column_name}_理由"] = id_values.map(reasons).fillna("理由なし")
+        if fingerprints is None:
+            self.df.drop(columns=f"{column_name}{FINGERPRINT_SUFFIX}", errors="ignore", inplace=True)
+        else:
+            self.df[f"{column_name}{FINGERPRINT_SUFFIX}"] = id_values.map(fingerprints).fillna("")
+
+    def _template_version(self, analysis_type: str, system_prompt: Optional[str], schema: Optional[dict], merge_strategy: str) -> str:
+        """
+        分析の指示のバージョン（プロバイダー・バックエンド・モデル名・生成パラメータ・分析タイプ・プロンプト・
+        スキーマ・統合方法のハッシュ）。テンプレートを編集するか、プロバイダー・モデル・temperature などを
+        変更すると変わり、前回の結果は再利用されなくなる
+        """
+        definition = json.dumps([self.provider, type(self.backend).__name__, self.model_name, self.temperature, self.max_tokens,
+                                 analysis_type, system_prompt, schema, merge_strategy],
+                                ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(definition.encode("utf-8")).hexdigest()[:16]
+
+    def _template_key_version(self, template_key: str) -> str:
+        """テンプレートキーの分析の指示のバージョン（analyze_with_template と同じ引数から計算する）"""
+        template = self.templates[template_key]
+        return self._template_version(
+            template["analysis_type"],
+            template["system_prompt"],
+            get_template_schema(template, template["analysis_type"]),
+            infer_merge_strategy(template["system_prompt"], template)
+        )
+
+    @staticmethod
+    def _text_digests(combined_texts: dict) -> dict:
+        """IDごとの結合テキストのハッシュを返す（テンプレートごとの指紋の計算で共有する）"""
+        return {id_val: hashlib.sha256(text.encode("utf-8")).hexdigest() for id_val, text in combined_texts.items()}
+
+    @staticmethod
+    def _fingerprints(version: str, digests: dict) -> dict:
+        """IDごとの指紋（分析の指示のバージョンと結合テキストのハッシュ）を返す"""
+        return {id_val: hashlib.sha256(f"{version}:{digest}".encode("ascii")).hexdigest()[:32]
+                for id_val, digest in digests.items()}
+
+    @staticmethod
+    def _completed_fingerprints(fingerprints: dict, outcomes: dict) -> dict:
+        """結果が得られた患者の指紋のみを返す（未分析・一時的な失敗の患者は次回再分析する）"""
+        return {id_val: fingerprint for id_val, fingerprint in fingerprints.items()
+                if id_val in outcomes and outcomes[id_val][1] not in _RETRY_REASONS}
+
+    def load_previous_results(self, results_path: str) -> bool:
+        """
+        前回の分析結果ファイル（save_results で保存したもの）を読み込み、以降の分析を差分実行にする
+
+        指紋（分析の指示のバージョンと結合テキストのハッシュ）が前回と一致する患者はLLMを呼び出さずに
+        前回の結果と理由を再利用し、新規の患者と記載が追加・変更された患者のみを分析する。
+        ID列は現在の列マッピングで照合するため、set_column_mapping の後に呼び出すこと。
+        """
+        try:
+            previous = self._read_table(results_path)
+        except FileNotFoundError:
+            print(f"エラー: 前回の分析結果 '{results_path}' が見つかりません")
+            return False
+        except Exception as e:
+            print(f"エラー: 前回の分析結果の読み込み中にエラーが発生しました: {str(e)}")
+            return False
+        return self.set_previous_results(previous)
+
+    def set_previous_results(self, previous: pd.DataFrame) -> bool:
+        """
+        読み込み済みの前回の分析結果を設定する（Streamlitのキャッシュなど、ファイル以外から渡す場合に使用）
+
+        Parameters:
+        - previous: get_results_df と同じ形式のデータフレーム（変更されないよう複製して保持する）
+        """
+        id_column = self.column_mapping['id_column']
+        if id_column not in previous.columns:
+            print(f"エラー: 前回の分析結果にID列 '{id_column}' が見つかりません")
+            return False
+        if not any(col.endswith(FINGERPRINT_SUFFIX) for col in previous.columns):
+            print("警告: 前回の分析結果に指紋の列がないため、すべての患者を分析します")
+
+        previous = previous.set_axis(previous[id_column].map(CheckpointJournal.patient_key), axis=0)
+        self.previous_results = previous[~previous.index.duplicated(keep="last")]
+        print(f"前回の分析結果を読み込みました（{len(self.previous_results)}件）")
+        return True
+
+    def _reuse_previous(self, column_name: str, fingerprints: dict) -> dict:
+        """前回の分析結果のうち、指紋が一致する患者の {ID: (結果, 理由)} を返す"""
+        fingerprint_column = f"{column_name}{FINGERPRINT_SUFFIX}"
+        previous = self.previous_results
+        if previous is None or fingerprint_column not in previous.columns or column_name not in previous.columns:
+            return {}
+
+        previous_fingerprints = dict(zip(previous.index, previous[fingerprint_column]))
+        matched = [id_val for id_val, fingerprint in fingerprints.items()
+                   if fingerprint and previous_fingerprints.get(CheckpointJournal.patient_key(id_val)) == fingerprint]
+        reason_column = f"{column_name}_理由"
+        reused = {}
+        for id_val in matched:
+            key = CheckpointJournal.patient_key(id_val)
+            reason = previous.at[key, reason_column] if reason_column in previous.columns else "理由なし"
+            reused[id_val] = (previous.at[key, column_name], reason)
+        print(f"前回の結果を再利用します（{column_name}）: {len(reused)}件 / 新規・変更: {len(fingerprints) - len(reused)}件")
+        return reused
+
+    def analyze_with_llm(self, analysis_type: str = "extract", system_prompt: Optional[str] = None, progress_callback=None, column_name: Optional[str] = None, max_workers: Optional[int] = None, template_key: Optional[str] = None, merge_strategy: Optional[str] = None, schema: Optional[dict] = None) -> bool:
+        """
+        LLMを使用して自由記載を分析し、結果を新しい列として追加
+
+        Parameters:
+        - max_workers: 同時実行数。未指定の場合はインスタンスの設定値を使用する。
+          並列実行時もprogress_callbackは患者ごとの完了時に呼び出され、
+          結果はIDの順序どおりに列へ格納される。
+        - template_key: チェックポイントに記録する際のキー（省略時は列名）
+        - merge_strategy: 長いテキストを分割して抽出した場合の統合方法（latest / first / all）。
+          省略時はシステムプロンプトから判定する
+        - schema: 応答のJSONスキーマ。省略時は分析タイプごとの既定スキーマ（result / reason）を使用する
+        """
         if not self._validate_data():
             return False
 
         # 列名が指定されていない場合はデフォルトの列名を生成
         if column_name is None:
             column_name = f"分析結果_{analysis_type}"
-        default_value = False if analysis_type == "binary" else "N/A"
+        default_value = self._get_default_value(analysis_type)
+        merge_strategy = merge_strategy or infer_merge_strategy(system_prompt)
+        schema = schema or get_template_schema(None, analysis_type)
         
         try:
             combined_texts = self._combine_texts_by_id()
-            results = {}
-            reasons = {}  # 理由を保存する辞書を追加
+            outcomes = {}  # {ID: (結果, 理由)}
             
             total_items = len(combined_texts)
-            for i, (id_val, text) in enumerate(combined_texts.items(), 1):
-                try:
-                    response = self._call_openai_api(text, analysis_type, system_prompt)
-                    
-                    # JSON応答の処理
-                    try:
-                        # デバッグ用に応答を表示
-                        print(f"LLM応答: {response}")
-                        response_dict = json.loads(response)
-                        result = response_dict.get("result", default_value)
-                        reason = response_dict.get("reason", "理由なし")
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析エラー: {str(e)}")
-                        print(f"問題の応答: {response}")
-                        # JSONとして解析できない場合は、LLMの出力をそのまま表示
-                        result = response.strip()
-                        reason = "JSONエラー"
-                    
-                    results[id_val] = result
-                    reasons[id_val] = reason
-                    
-                    if progress_callback:
-                        # int64型をint型に変換してからJSONシリアライズ可能な形式に変換
-                        callback_id = int(id_val) if isinstance(id_val, (np.int64, np.int32)) else id_val
-                        progress_callback(i, total_items, {
-                            "ID": callback_id, 
-                            "結果": result,
-                            "理由": reason
-                        })
-                        
-                    sleep(0.5)  # API制限対策
-                except Exception as e:
-                    print(f"警告: ID {id_val} の分析中にエラーが発生: {str(e)}")
-                    results[id_val] = default_value
-                    reasons[id_val] = "エラーが発生しました"
+            cache_baseline = self._cache_snapshot()
+
+            # チェックポイントに記録済みの患者と、前回の結果から記載が変わっていない患者はスキップする
+            checkpoint_key = template_key or column_name
+            self._metrics_label = checkpoint_key
+            fingerprints = self._fingerprints(
+                self._template_version(analysis_type, system_prompt, schema, merge_strategy),
+                self._text_digests(combined_texts)
+            )
+            outcomes.update(self._reuse_previous(column_name, fingerprints))
+            outcomes.update(self._load_completed(checkpoint_key, combined_texts))
+            pending_texts = {id_val: text for id_val, text in combined_texts.items() if id_val not in outcomes}
+
+            def on_complete(id_val, outcome):
+                outcomes[id_val] = outcome
+                self._record_checkpoint(checkpoint_key, id_val, outcome[0], outcome[1])
+                if progress_callback:
+                    # int64型をint型に変換してからJSONシリアライズ可能な形式に変換
+                    callback_id = int(id_val) if isinstance(id_val, (np.int64, np.int32)) else id_val
+                    progress_callback(len(outcomes), total_items, self._with_cache_progress({
+                        "ID": callback_id, 
+                        "結果": outcome[0],
+                        "理由": outcome[1]
+                    }, cache_baseline))
+
+            if self.backend.native_batch:
+                # 一括推論に対応したバックエンドでは、全患者分を1回の推論にまとめて投入する
+                finished = self._analyze_batch(
+                    pending_texts, analysis_type, system_prompt, default_value, merge_strategy, schema, on_complete
+                )
+            elif self.use_async and self.backend.supports_async:
+                finished = self._dispatch_async(
+                    pending_texts,
+                    lambda id_val, text: self._aanalyze_single(id_val, text, analysis_type, system_prompt, default_value, merge_strategy, schema),
+                    on_complete,
+                    max_workers
+                )
+            else:
+                finished = self._dispatch(
+                    pending_texts,
+                    lambda id_val, text: self._analyze_single(id_val, text, analysis_type, system_prompt, default_value, merge_strategy, schema),
+                    on_complete,
+                    max_workers
+                )
+
+            # 完了順ではなくIDの順序で結果を並べる（予算上限・停止の要求で中止した患者は既定値）
+            unfinished = (default_value, self._unfinished_reason())
+            results = {id_val: outcomes.get(id_val, unfinished)[0] for id_val in combined_texts}
+            reasons = {id_val: outcomes.get(id_val, unfinished)[1] for id_val in combined_texts}
 
-            # 結果と理由を別々の列として追加
-            self.df[column_name] = self.df[self.column_mapping['id_column']].map(results).fillna(default_value)
-            self.df[f"{column_name}_理由"] = self.df[self.column_mapping['id_column']].map(reasons).fillna("理由なし")
+            # 結果と理由を別々の列として追加（差分実行用の指紋も格納する）
+            self._store_results(column_name, results, reasons, default_value,
+                                self._completed_fingerprints(fingerprints, outcomes))
             
+            if not finished:
+                cause = "分析の停止が要求された" if self.cancelled else "予算上限に達した"
+                print(f"{cause}ため分析を中止しました。{len(outcomes)}/{total_items}件の結果を '{column_name}' に格納しました。")
+                return False
             print(f"分析が完了しました。新しい列 '{column_name}' と '{column_name}_理由' が追加されました。")
             return True
 
@@ -339,10 +1159,412 @@ class ExcelAnalyzer:
             print(f"エラー: LLM分析中にエラーが発生しました: {str(e)}")
             return False
 
+    def _analyze_single(self, id_val, text: str, analysis_type: str, system_prompt: Optional[str], default_value, merge_strategy: str = "latest", schema: Optional[dict] = None) -> tuple:
+        """
+        1患者分のテキストを分析し、(結果, 理由) を返す。ワーカースレッドからも呼び出される。
+        テキストが max_input_tokens を超える場合は日付単位のチャンクごとに並列に抽出し、
+        merge_strategy に従って結果を統合する。
+        """
+        try:
+            if self._count_tokens(text) <= self.max_input_tokens:
+                response = self._call_structured(text, analysis_type, system_prompt, schema)
+                return self._parse_response(response, default_value)
+
+            chunks = chunk_text(text, self.max_input_tokens, self._count_tokens)
+            print(f"ID {id_val} のテキストが長いため、{len(chunks)}個のチャンクに分割して分析します")
+
+            def analyze_chunk(chunk: str) -> tuple:
+                try:
+                    return self._parse_response(self._call_structured(chunk, analysis_type, system_prompt, schema), default_value)
+                except _STOP_ERRORS:
+                    raise
+                except Exception as e:
+                    print(f"警告: ID {id_val} のチャンク分析中にエラーが発生: {str(e)}")
+                    return default_value, "エラーが発生しました"
+
+            with ThreadPoolExecutor(max_workers=min(len(chunks), self._effective_workers())) as executor:
+                chunk_outcomes = list(executor.map(analyze_chunk, chunks))
+            return reduce_chunk_results(chunk_outcomes, merge_strategy, default_value)
+        except _STOP_ERRORS:
+            raise
+        except Exception as e:
+            print(f"警告: ID {id_val} の分析中にエラーが発生: {str(e)}")
+            return default_value, "エラーが発生しました"
+
+    async def _aanalyze_single(self, id_val, text: str, analysis_type: str, system_prompt: Optional[str], default_value, merge_strategy: str = "latest", schema: Optional[dict] = None) -> tuple:
+        """_analyze_single の非同期版（チャンクはイベントループ上で並行に分析する）"""
+        try:
+            if self._count_tokens(text) <= self.max_input_tokens:
+                response = await self._acall_structured(text, analysis_type, system_prompt, schema)
+                return self._parse_response(response, default_value)
+
+            chunks = chunk_text(text, self.max_input_tokens, self._count_tokens)
+            print(f"ID {id_val} のテキストが長いため、{len(chunks)}個のチャンクに分割して分析します")
+
+            async def analyze_chunk(chunk: str) -> tuple:
+                try:
+                    return self._parse_response(await self._acall_structured(chunk, analysis_type, system_prompt, schema), default_value)
+                except _STOP_ERRORS:
+                    raise
+                except Exception as e:
+                    print(f"警告: ID {id_val} のチャンク分析中にエラーが発生: {str(e)}")
+                    return default_value, "エラーが発生しました"
+
+            chunk_outcomes = await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks))
+            return reduce_chunk_results(list(chunk_outcomes), merge_strategy, default_value)
+        except _STOP_ERRORS:
+            raise
+        except Exception as e:
+            print(f"警告: ID {id_val} の分析中にエラーが発生: {str(e)}")
+            return default_value, "エラーが発生しました"
+
+    def _analyze_batch(self, combined_texts: dict, analysis_type: str, system_prompt: Optional[str], default_value,
+                       merge_strategy: str, schema: Optional[dict], on_complete) -> bool:
+        """
+        全患者のテキスト（max_input_tokens を超える場合はそのチャンク）をバックエンドの complete_batch に
+        まとめて投入し、患者ごとに (結果, 理由) を統合して on_complete(id_val, 戻り値) を呼び出す。
+        一括推論のため、on_complete は全件の推論が終わってからIDの順に呼び出される
+
+        Returns:
+        - bool: 全患者を処理した場合True。予算上限に達した、または停止が要求されたため中止した場合False
+        """
+        units = []
+        for id_val, text in combined_texts.items():
+            if self._count_tokens(text) <= self.max_input_tokens:
+                units.append((id_val, [text]))
+            else:
+                chunks = chunk_text(text, self.max_input_tokens, self._count_tokens)
+                print(f"ID {id_val} のテキストが長いため、{len(chunks)}個のチャンクに分割して分析します")
+                units.append((id_val, chunks))
+
+        texts = [text for _, chunks in units for text in chunks]
+        try:
+            responses = self._call_structured_batch(texts, analysis_type, system_prompt, schema)
+        except _STOP_ERRORS as e:
+            print(f"警告: {str(e)}。残りの患者の分析を中止します")
+            return False
+        except Exception as e:
+            print(f"警告: 一括推論中にエラーが発生: {str(e)}")
+            responses = [None] * len(texts)
+
+        position = 0
+        for id_val, chunks in units:
+            chunk_outcomes = [
+                self._parse_response(response, default_value) if response is not None else (default_value, "エラーが発生しました")
+                for response in responses[position:position + len(chunks)]
+            ]
+            position += len(chunks)
+            if len(chunk_outcomes) == 1:
+                on_complete(id_val, chunk_outcomes[0])
+            else:
+                on_complete(id_val, reduce_chunk_results(chunk_outcomes, merge_strategy, default_value))
+        return True
+
+    def _count_tokens(self, text: str) -> int:
+        """使用中のプロバイダー・モデルのトークナイザー（なければ概算）でトークン数を数える"""
+        return self.backend.count_tokens(self.model_name, text)
+
+    def estimate_run(self, template_keys: Optional[List[str]] = None, fused: bool = False,
+                     max_workers: Optional[int] = None, expected_output_tokens: int = 150,
+                     latency_sec: Optional[float] = None) -> dict:
+        """
+        実行前に、指定したテンプレートで分析した場合のトークン数・所要時間・料金を見積もる
+        （前回の結果の再利用による省略は考慮し、キャッシュやチェックポイントによる省略は考慮しない）
+
+        Parameters:
+        - template_keys: 見積もるテンプレートキーのリスト（省略時は全テンプレート）
+        - fused: Trueの場合は analyze_with_templates でまとめて実行する場合を見積もる
+        - max_workers: 同時実行数。未指定の場合はインスタンスの設定値を使用する
+        - expected_output_tokens: 1テンプレートあたりの応答の想定トークン数
+        - latency_sec: 1リクエストあたりの応答時間（秒）。未指定の場合は実測の平均値、
+          なければプロバイダーごとの既定値（DEFAULT_LATENCY_SEC）を使用する
+
+        Returns:
+        - dict: patients, requests, input_tokens, output_tokens, max_output_tokens,
+          estimated_seconds, estimated_cost_usd, max_cost_usd（料金が不明なモデルでは料金はNone）
+        """
+        if not self._validate_data():
+            return {}
+        template_keys = [key for key in (template_keys or list(self.templates)) if key in self.templates]
+        combined_texts = self._combine_texts_by_id()
+
+        overhead = self._count_tokens("テキスト: ")
+        prompt_tokens = {key: self._count_tokens(self.templates[key]["system_prompt"]) + overhead for key in template_keys}
+        fused_prompt_tokens = None
+        if fused and len(template_keys) > 1:
+            fused_prompt_tokens = self._count_tokens(self._build_fused_prompt(template_keys)) + overhead
+
+        # 前回の結果を再利用できる患者は、テンプレートごとにLLMの呼び出しから除く
+        reused = {key: set() for key in template_keys}
+        if self.previous_results is not None:
+            digests = self._text_digests(combined_texts)
+            for key in template_keys:
+                reused[key] = set(self._reuse_previous(self._get_column_name(key), self._fingerprints(self._template_key_version(key), digests)))
+
+        requests = input_tokens = output_tokens = max_output_tokens = 0
+        for id_val, text in combined_texts.items():
+            pending_keys = [key for key in template_keys if id_val not in reused[key]]
+            if not pending_keys:
+                continue
+            if fused_prompt_tokens is None:
+                template_keys_to_run = pending_keys
+            else:
+                # まとめて実行する場合は、1テンプレートでも再分析が必要な患者は全テンプレートを分析する
+                template_keys_to_run = template_keys
+            text_tokens = self._count_tokens(text)
+            if fused_prompt_tokens is not None and text_tokens <= self.max_input_tokens:
+                # 複合プロンプトで1回だけ呼び出す
+                requests += 1
+                input_tokens += fused_prompt_tokens + text_tokens
+                output_tokens += expected_output_tokens * len(template_keys)
+                max_output_tokens += self.max_tokens * len(template_keys)
+                continue
+            if text_tokens <= self.max_input_tokens:
+                chunk_tokens = [text_tokens]
+            else:
+                chunk_tokens = [self._count_tokens(chunk) for chunk in chunk_text(text, self.max_input_tokens, self._count_tokens)]
+            for key in template_keys_to_run:
+                requests += len(chunk_tokens)
+                input_tokens += sum(chunk_tokens) + prompt_tokens[key] * len(chunk_tokens)
+                output_tokens += expected_output_tokens * len(chunk_tokens)
+                max_output_tokens += self.max_tokens * len(chunk_tokens)
+
+        # 所要時間は同時実行数とレート制限（リクエスト数/分・トークン数/分）のうち最も厳しいもので決まる
+        concurrency = self._effective_workers(max_workers)
+        latency_sec = latency_sec or self.usage.average_latency() or DEFAULT_LATENCY_SEC.get(self.provider, 3.0)
+        estimated_seconds = requests * latency_sec / concurrency
+        if self.rate_limiter.requests_per_minute:
+            estimated_seconds = max(estimated_seconds, requests / self.rate_limiter.requests_per_minute * 60)
+        if self.rate_limiter.tokens_per_minute:
+            estimated_seconds = max(estimated_seconds, (input_tokens + output_tokens) / self.rate_limiter.tokens_per_minute * 60)
+
+        return {
+            "patients": len(combined_texts),
+            "requests": requests,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "max_output_tokens": max_output_tokens,
+            "estimated_seconds": estimated_seconds,
+            "estimated_cost_usd": estimate_cost(self.provider, self.model_name, input_tokens, output_tokens),
+            "max_cost_usd": estimate_cost(self.provider, self.model_name, input_tokens, max_output_tokens)
+        }
+
+    def _record_usage(self, input_tokens: Optional[int], output_tokens: Optional[int], latency_sec: float,
+                      system_prompt: str, text: str, response: str, cached_input_tokens: Optional[int] = None,
+                      queue_wait_sec: float = 0.0, retries: int = 0):
+        """
+        APIの応答に含まれる使用量（なければトークン数の見積もり）を集計に加算し、呼び出しの計測値を記録する
+        cached_input_tokens は入力のうちプロバイダー側のプロンプトキャッシュから読み込まれたトークン数
+        """
+        if input_tokens is None:
+            input_tokens = self._count_tokens(system_prompt) + self._count_tokens(text)
+        if output_tokens is None:
+            output_tokens = self._count_tokens(response)
+        cached_input_tokens = cached_input_tokens or 0
+        cost = estimate_cost(self.provider, self.model_name, input_tokens, output_tokens, cached_input_tokens)
+        self.usage.record(input_tokens, output_tokens, cost, latency_sec, cached_input_tokens)
+        self.metrics.record_call(self._metrics_label, self.provider, latency_sec, queue_wait_sec,
+                                 input_tokens, output_tokens, cached_input_tokens, retries)
+
+    def _parse_response(self, response: str, default_value) -> tuple:
+        """LLMのJSON応答を (結果, 理由) に変換する"""
+        # 余分な文字を除去
+        response = strip_code_fence(response)
+        try:
+            # 応答には患者情報が含まれうるため、DEBUGレベルでのみ記録する
+            logger.debug("LLM応答: %s", response)
+            response_dict = parse_json(response)
+            return self._to_outcome(response_dict, default_value)
+        except json.JSONDecodeError as e:
+            self.metrics.record_parse_failure(self._metrics_label, self.provider)
+            print(f"JSON解析エラー: {str(e)}")
+            logger.debug("問題の応答: %s", response)
+            # JSONとして解析できない場合は、LLMの出力をそのまま表示
+            return response.strip(), "JSONエラー"
+
+    @staticmethod
+    def _to_outcome(response_dict, default_value) -> tuple:
+        """
+        解析済みの応答を (結果, 理由) に変換する。
+        result を持たない独自スキーマの応答は、オブジェクト全体を結果とする
+        """
+        if not isinstance(response_dict, dict):
+            return response_dict, "理由なし"
+        if "result" not in response_dict:
+            return response_dict, "理由なし"
+        return response_dict.get("result", default_value), response_dict.get("reason", "理由なし")
+
+    def create_batch_backend(self, work_dir: str = ".llm_batch") -> BatchBackend:
+        """
+        プロバイダーに応じたバッチバックエンドを作成する
+
+        OpenAIとClaudeは各社のバッチAPIを使用する。バッチAPIのないプロバイダー（vLLM、Gemini、Deepseek）は
+        通常のAPI呼び出しで順に処理するローカルバックエンドを使用する。
+        """
+        return self.backend.create_batch_backend(
+            self.model_name,
+            work_dir,
+            lambda request: self._call_structured(request["text"], "extract", request["system_prompt"], request.get("schema"), request["max_tokens"])
+        )
+
+    def submit_batch(self, template_keys: List[str], backend: Optional[BatchBackend] = None, work_dir: str = ".llm_batch") -> Optional[str]:
+        """
+        全患者×テンプレートのリクエストをバッチとして投入する
+
+        custom_idと(テンプレートキー, 患者ID, チャンク番号)の対応は work_dir/<バッチID>.manifest.json に保存され、
+        collect_batch で結果を列に戻す際に使用する。テキストが max_input_tokens を超える患者は
+        通常の分析と同じく日付単位のチャンクごとに1件のリクエストとし、collect_batch で結果を統合する。
+        load_previous_results で前回の結果を読み込んでいる場合、指紋が一致する患者はバッチに含めない
+        （collect_batch の前にも同じ前回の結果を読み込んでおくと、その患者の結果が補われる）。
+
+        Returns:
+        - Optional[str]: バッチID（投入に失敗した場合はNone）
+        """
+        template_keys = [key for key in template_keys if key in self.templates]
+        if not template_keys or not self._validate_data():
+            print("エラー: バッチを作成できるテンプレートまたはデータがありません")
+            return None
+
+        backend = backend or self.create_batch_backend(work_dir)
+        combined_texts = self._combine_texts_by_id()
+        digests = self._text_digests(combined_texts)
+        requests_list = []
+        manifest = {}
+        for key in template_keys:
+            system_prompt = self.templates[key]["system_prompt"]
+            schema = get_template_schema(self.templates[key], self.templates[key]["analysis_type"])
+            reused = self._reuse_previous(self._get_column_name(key), self._fingerprints(self._template_key_version(key), digests))
+            for id_val, text in combined_texts.items():
+                if id_val in reused:
+                    continue
+                chunks = [text]
+                if self._count_tokens(text) > self.max_input_tokens:
+                    chunks = chunk_text(text, self.max_input_tokens, self._count_tokens)
+                    print(f"ID {id_val} のテキストが長いため、{len(chunks)}個のチャンクに分割して投入します")
+                for chunk_index, chunk in enumerate(chunks):
+                    # プロバイダーの制約（英数字・64文字以内）に合わせて連番のIDを使用する
+                    custom_id = f"req-{len(requests_list):08d}"
+                    manifest[custom_id] = [key, CheckpointJournal.patient_key(id_val), chunk_index]
+                    requests_list.append({
+                        "custom_id": custom_id,
+                        "system_prompt": system_prompt,
+                        "text": chunk,
+                        "max_tokens": self.max_tokens,
+                        "schema": schema
+                    })
+
+        try:
+            os.makedirs(work_dir, exist_ok=True)
+            batch_id = backend.submit(requests_list, work_dir)
+            with open(os.path.join(work_dir, f"{batch_id}.manifest.json"), "w", encoding="utf-8") as f:
+                json.dump({"template_keys": template_keys, "requests": manifest}, f, ensure_ascii=False)
+            print(f"バッチを投入しました: {batch_id}（{len(requests_list)}件）")
+            return batch_id
+        except Exception as e:
+            print(f"エラー: バッチの投入に失敗しました: {str(e)}")
+            return None
+
+    def collect_batch(self, batch_id: str, backend: Optional[BatchBackend] = None, work_dir: str = ".llm_batch", progress_callback=None) -> Dict[str, dict]:
+        """
+        完了したバッチの結果を取得し、custom_idをもとに分析結果の列に格納する
+
+        Returns:
+        - Dict[str, dict]: {テンプレートキー: analyze_with_template と同じ形式の結果}
+        """
+        backend = backend or self.create_batch_backend(work_dir)
+        with open(os.path.join(work_dir, f"{batch_id}.manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        template_keys = manifest["template_keys"]
+
+        try:
+            responses = backend.fetch_results(batch_id)
+        except Exception as e:
+            print(f"エラー: バッチ結果の取得に失敗しました: {str(e)}")
+            return {key: self._template_summary(key, False) for key in template_keys}
+
+        combined_texts = self._combine_texts_by_id()
+        id_by_key = {CheckpointJournal.patient_key(id_val): id_val for id_val in combined_texts}
+        digests = self._text_digests(combined_texts)
+        fingerprints = {key: self._fingerprints(self._template_key_version(key), digests) for key in template_keys}
+        # {テンプレートキー: {ID: (結果, 理由)}}（バッチに含めなかった患者は前回の結果から補う）
+        outcomes = {key: self._reuse_previous(self._get_column_name(key), fingerprints[key]) for key in template_keys}
+
+        # {(テンプレートキー, 患者IDキー): [(チャンク番号, (結果, 理由))]}（チャンク番号のない旧形式は1チャンクとして扱う）
+        chunk_outcomes = {}
+        for custom_id, (key, patient_key, *chunk_index) in manifest["requests"].items():
+            default_value = self._get_default_value(self.templates[key]["analysis_type"])
+            if custom_id in responses:
+                outcome = self._parse_response(responses[custom_id], default_value)
+            else:
+                outcome = (default_value, "バッチでの応答が得られませんでした")
+            chunk_outcomes.setdefault((key, patient_key), []).append((chunk_index[0] if chunk_index else 0, outcome))
+
+        total_items = len(chunk_outcomes)
+        for i, ((key, patient_key), parts) in enumerate(chunk_outcomes.items(), 1):
+            id_val = id_by_key.get(patient_key)
+            if id_val is None:
+                continue
+            parts = [outcome for _, outcome in sorted(parts, key=lambda part: part[0])]
+            if len(parts) == 1:
+                outcome = parts[0]
+            else:
+                template = self.templates[key]
+                outcome = reduce_chunk_results(parts, infer_merge_strategy(template["system_prompt"], template),
+                                               self._get_default_value(template["analysis_type"]))
+            outcomes[key][id_val] = outcome
+            self._record_checkpoint(key, id_val, outcome[0], outcome[1])
+            if progress_callback:
+                callback_id = int(id_val) if isinstance(id_val, (np.int64, np.int32)) else id_val
+                progress_callback(i, total_items, {"ID": callback_id, "テンプレート": key, "結果": outcome[0], "理由": outcome[1]})
+
+        summary = {}
+        for key in template_keys:
+            default_value = self._get_default_value(self.templates[key]["analysis_type"])
+            results = {id_val: outcome[0] for id_val, outcome in outcomes[key].items()}
+            reasons = {id_val: outcome[1] for id_val, outcome in outcomes[key].items()}
+            self._store_results(self._get_column_name(key), results, reasons, default_value,
+                                self._completed_fingerprints(fingerprints[key], outcomes[key]))
+            summary[key] = self._template_summary(key, True)
+        print(f"バッチ {batch_id} の結果を取り込みました（{len(responses)}/{len(manifest['requests'])}件）")
+        return summary
+
+    def run_batch(self, template_keys: List[str], backend: Optional[BatchBackend] = None, work_dir: str = ".llm_batch",
+                  poll_interval: float = 60.0, timeout: Optional[float] = None, progress_callback=None) -> Dict[str, dict]:
+        """
+        バッチの投入・完了待ち・結果の取り込みをまとめて実行する（夜間の一括抽出向け）
+
+        Parameters:
+        - backend: 使用するバッチバックエンド（省略時はプロバイダーに応じて作成）
+        - poll_interval: 状態確認の間隔（秒）
+        - timeout: 完了を待つ最大時間（秒）。超過した場合はバッチIDを表示して終了する
+        """
+        backend = backend or self.create_batch_backend(work_dir)
+        batch_id = self.submit_batch(template_keys, backend, work_dir)
+        if batch_id is None:
+            return {key: {"success": False, "error": "バッチの投入に失敗しました"} for key in template_keys}
+
+        started = time.monotonic()
+        while True:
+            status = backend.poll(batch_id)
+            if status == BATCH_COMPLETED:
+                break
+            if status == BATCH_FAILED:
+                print(f"エラー: バッチ {batch_id} が失敗しました")
+                return {key: self._template_summary(key, False) for key in template_keys if key in self.templates}
+            if timeout is not None and time.monotonic() - started > timeout:
+                print(f"警告: バッチ {batch_id} が時間内に完了しませんでした。後で collect_batch で取り込んでください")
+                return {key: self._template_summary(key, False) for key in template_keys if key in self.templates}
+            time.sleep(poll_interval)
+
+        return self.collect_batch(batch_id, backend, work_dir, progress_callback)
+
     def _get_default_system_prompt(self, analysis_type: str) -> str:
         """分析タイプに応じたデフォルトのシステムプロンプトを返す"""
         if analysis_type == "binary":
-            return "与えられたテキストに対して質問に答えてください。回答は 'はい' または 'いいえ' でお願いします。"
+            return (
+                "与えられたテキストに対して質問に答えてください。"
+                "回答は {\"result\": true または false, \"reason\": \"判断の根拠となる記載\"} のJSON形式でお願いします。"
+            )
         return """
         与えられたテキストから情報を抽出してください。
         回答は以下のJSON形式で返してください：
@@ -358,64 +1580,295 @@ class ExcelAnalyzer:
         - 複数の情報がある場合は、最新の情報を返してください
         """
 
-    def _call_openai_api(self, text: str, analysis_type: str, system_prompt: Optional[str] = None) -> str:
-        """LLMを呼び出してテキスト分析を実行"""
+    def _request_with_retry(self, send, estimated_tokens: int, stats: Optional[dict] = None):
+        """
+        レート制限の枠を確保してからAPIを呼び出す。
+        429/5xx応答の場合はRetry-After（なければ指数バックオフ）に従って再試行する。
+        stats を指定した場合は、レート制限による待機時間の合計（queue_wait_sec）と再試行回数（retries）を格納する
+        """
+        stats = stats if stats is not None else {}
+        stats.update(queue_wait_sec=0.0, retries=0)
+        for attempt in range(self.max_retries + 1):
+            stats["retries"] = attempt
+            stats["queue_wait_sec"] += self.rate_limiter.acquire(estimated_tokens)
+            try:
+                return send()
+            except Exception as e:
+                delay = get_retry_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                print(f"警告: レート制限またはサーバーエラーのため{delay:.1f}秒後に再試行します（{attempt + 1}/{self.max_retries}）")
+                # 同じプロバイダーを使う他の呼び出しもまとめて待機させる
+                self.rate_limiter.backoff(delay)
+
+    async def _arequest_with_retry(self, send, estimated_tokens: int, stats: Optional[dict] = None):
+        """_request_with_retry の非同期版（send はコルーチンを返す関数）"""
+        stats = stats if stats is not None else {}
+        stats.update(queue_wait_sec=0.0, retries=0)
+        for attempt in range(self.max_retries + 1):
+            stats["retries"] = attempt
+            stats["queue_wait_sec"] += await self.rate_limiter.acquire_async(estimated_tokens)
+            try:
+                return await send()
+            except Exception as e:
+                delay = get_retry_delay(e, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    raise
+                print(f"警告: レート制限またはサーバーエラーのため{delay:.1f}秒後に再試行します（{attempt + 1}/{self.max_retries}）")
+                self.rate_limiter.backoff(delay)
+
+    def _call_structured(self, text: str, analysis_type: str, system_prompt: Optional[str], schema: Optional[dict], max_tokens: Optional[int] = None) -> str:
+        """
+        構造化出力でLLMを呼び出し、応答を返す。
+        応答がスキーマに適合しない場合は、問題点を示して1回だけ修復を依頼する
+        """
+        response = self._call_openai_api(text, analysis_type, system_prompt, max_tokens, schema)
+        if schema is None:
+            return response
+        _, error = check_response(response, schema)
+        if error is None:
+            return response
+        self.metrics.record_parse_failure(self._metrics_label, self.provider)
+        print(f"警告: 応答がスキーマに適合しないため修復を依頼します: {error}")
+        repaired = self._call_openai_api(response, analysis_type, build_repair_prompt(schema, error), max_tokens, schema)
+        _, repair_error = check_response(repaired, schema)
+        if repair_error is not None:
+            print(f"警告: 修復後の応答もスキーマに適合しません: {repair_error}")
+        return repaired
+
+    async def _acall_structured(self, text: str, analysis_type: str, system_prompt: Optional[str], schema: Optional[dict], max_tokens: Optional[int] = None) -> str:
+        """_call_structured の非同期版"""
+        response = await self._acall_openai_api(text, analysis_type, system_prompt, max_tokens, schema)
+        if schema is None:
+            return response
+        _, error = check_response(response, schema)
+        if error is None:
+            return response
+        self.metrics.record_parse_failure(self._metrics_label, self.provider)
+        print(f"警告: 応答がスキーマに適合しないため修復を依頼します: {error}")
+        repaired = await self._acall_openai_api(response, analysis_type, build_repair_prompt(schema, error), max_tokens, schema)
+        _, repair_error = check_response(repaired, schema)
+        if repair_error is not None:
+            print(f"警告: 修復後の応答もスキーマに適合しません: {repair_error}")
+        return repaired
+
+    def _call_structured_batch(self, texts: List[str], analysis_type: str, system_prompt: Optional[str], schema: Optional[dict], max_tokens: Optional[int] = None) -> List[str]:
+        """
+        _call_structured の一括版。全テキストを1回の complete_batch で処理し、
+        スキーマに適合しなかった応答の修復もまとめて1回で依頼する
+        """
+        system_prompt = system_prompt or self._get_default_system_prompt(analysis_type)
+        max_tokens = max_tokens or self.max_tokens
+        responses = self._complete_batch([
+            {"system_prompt": system_prompt, "text": text, "max_tokens": max_tokens, "schema": schema}
+            for text in texts
+        ])
+        if schema is None:
+            return responses
+
+        repairs = {}
+        for index, response in enumerate(responses):
+            _, error = check_response(response, schema)
+            if error is not None:
+                self.metrics.record_parse_failure(self._metrics_label, self.provider)
+                print(f"警告: 応答がスキーマに適合しないため修復を依頼します: {error}")
+                repairs[index] = {"system_prompt": build_repair_prompt(schema, error), "text": response,
+                                  "max_tokens": max_tokens, "schema": schema}
+        if repairs:
+            for index, repaired in zip(repairs, self._complete_batch(list(repairs.values()))):
+                _, repair_error = check_response(repaired, schema)
+                if repair_error is not None:
+                    print(f"警告: 修復後の応答もスキーマに適合しません: {repair_error}")
+                responses[index] = repaired
+        return responses
+
+    def _complete_batch(self, requests: List[dict]) -> List[str]:
+        """
+        リクエスト（system_prompt, text, max_tokens, schema）のうち応答キャッシュにないものを
+        バックエンドの complete_batch でまとめて処理し、全リクエストの応答テキストを同じ順序で返す
+        """
+        self._check_cancelled()
+        responses: List[Optional[str]] = [None] * len(requests)
+        pending = []
+        for index, request in enumerate(requests):
+            cache_key, cached = self._lookup_cache(request["text"], request["system_prompt"], request["max_tokens"], request["schema"])
+            if cached is not None:
+                responses[index] = cached
+            else:
+                pending.append((index, cache_key))
+        if not pending:
+            return responses
+
+        batch = [requests[index] for index, _ in pending]
+        reservation = self._reserve_budget(
+            sum(self._count_tokens(request["system_prompt"]) + self._count_tokens(request["text"]) for request in batch),
+            sum(request["max_tokens"] for request in batch)
+        )
+        try:
+            estimated_tokens = sum(
+                self._count_tokens(request["system_prompt"]) + self._count_tokens(request["text"]) + request["max_tokens"]
+                for request in batch
+            )
+            stats = {}
+            started = time.monotonic()
+            try:
+                results = self._request_with_retry(lambda: self.backend.complete_batch(self.model_name, batch), estimated_tokens, stats)
+            except Exception:
+                self._record_failed_call(time.monotonic() - started, stats)
+                raise
+            # 1件あたりの応答時間は一括推論全体の所要時間を件数で割った値とする（再試行回数は先頭の1件に記録する）
+            elapsed_sec = time.monotonic() - started - stats["queue_wait_sec"]
+            for position, ((index, cache_key), request, result) in enumerate(zip(pending, batch, results)):
+                item_stats = {"queue_wait_sec": stats["queue_wait_sec"], "retries": stats["retries"] if position == 0 else 0}
+                response = self._finish_completion(result, elapsed_sec / len(batch) + stats["queue_wait_sec"], request["system_prompt"],
+                                                   request["text"], item_stats)
+                if cache_key is not None and response:
+                    self.cache.set(cache_key, response)
+                responses[index] = response
+        finally:
+            self.usage.release(reservation)
+        return responses
+
+    def _call_openai_api(self, text: str, analysis_type: str, system_prompt: Optional[str] = None, max_tokens: Optional[int] = None, schema: Optional[dict] = None) -> str:
+        """
+        LLMを呼び出してテキスト分析を実行（キャッシュが有効な場合は保存済みの応答を返す）
+        schema を指定した場合はプロバイダーの構造化出力機能で応答をスキーマに従わせる
+        """
         try:
+            # 停止が要求されている場合は新しい呼び出しを行わない
+            self._check_cancelled()
             system_prompt = system_prompt or self._get_default_system_prompt(analysis_type)
+            max_tokens = max_tokens or self.max_tokens
 
-            # テキストが長すぎる場合は最新部分のみ使用
-            max_length = 4000
-            if len(text) > max_length:
-                text = text[-max_length:]
-                print("警告: テキストが長すぎるため、最新の部分のみを使用します")
-
-            if self.provider in ["vllm", "openai", "deepseek"]:
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"テキスト: {text}"}
-                ]
-                completion = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    temperature=0.1,
-                    max_tokens=512
-                )
-                response = completion.choices[0].message.content.strip()
-                # 余分な文字を除去
-                response = response.replace("```json", "").replace("```", "").strip()
-                return response
-
-            elif self.provider == "gemini":
-                response = self.client.models.generate_content(
-                    model = "gemini-2.0-flash-lite", #モデル名を直接指定している
-                    #model=self.model_name,
-                    contents= text,
-                    config = types.GenerateContentConfig(
-                        system_instruction=system_prompt
-                ))
-                response = response.text.strip()
-                # 余分な文字を除去
-                response = response.replace("```json", "").replace("```", "").strip()
-                return response
-
-            elif self.provider == "claude":
-                completion = self.client.messages.create(
-                    #model="claude-3-5-haiku-latest", #モデル名を直接指定している
-                    model=self.model_name,
-                    max_tokens=512,
-                    system=system_prompt,
-                    messages=[
-                        {"role": "user", "content": f"テキスト: {text}"}
-                    ]
-                )
-                response = completion.content[0].text.strip()
-                # 余分な文字を除去
-                response = response.replace("```json", "").replace("```", "").strip()
-                return response
+            cache_key, cached = self._lookup_cache(text, system_prompt, max_tokens, schema)
+            if cached is not None:
+                return cached
+
+            # キャッシュにない場合のみ料金が発生するため、ここで予算上限を確認して見込み料金を予約する
+            reservation = self._reserve_budget(self._count_tokens(system_prompt) + self._count_tokens(text), max_tokens)
+            try:
+                response = self._call_provider(text, system_prompt, max_tokens, schema)
+            finally:
+                self.usage.release(reservation)
+            if cache_key is not None and response:
+                self.cache.set(cache_key, response)
+            return response
 
+        except _STOP_ERRORS:
+            raise
         except Exception as e:
             raise Exception(f"API呼び出し中にエラーが発生: {str(e)}")
 
+    async def _acall_openai_api(self, text: str, analysis_type: str, system_prompt: Optional[str] = None, max_tokens: Optional[int] = None, schema: Optional[dict] = None) -> str:
+        """_call_openai_api の非同期版"""
+        try:
+            self._check_cancelled()
+            system_prompt = system_prompt or self._get_default_system_prompt(analysis_type)
+            max_tokens = max_tokens or self.max_tokens
+
+            cache_key, cached = self._lookup_cache(text, system_prompt, max_tokens, schema)
+            if cached is not None:
+                return cached
+
+            reservation = self._reserve_budget(self._count_tokens(system_prompt) + self._count_tokens(text), max_tokens)
+            try:
+                response = await self._acall_provider(text, system_prompt, max_tokens, schema)
+            finally:
+                self.usage.release(reservation)
+            if cache_key is not None and response:
+                self.cache.set(cache_key, response)
+            return response
+
+        except _STOP_ERRORS:
+            raise
+        except Exception as e:
+            raise Exception(f"API呼び出し中にエラーが発生: {str(e)}")
+
+    def _reserve_budget(self, input_tokens: int, max_output_tokens: int) -> float:
+        """
+        予算上限を確認し、呼び出しの見込み料金（出力は最大トークン数で計算）を予約して予約額を返す
+        （上限に達している場合は BudgetExceededError）。予約額は呼び出しの終了後に usage.release に渡す
+        """
+        if self.usage.budget_usd is None:
+            return 0.0
+        return self.usage.reserve(estimate_cost(self.provider, self.model_name, input_tokens, max_output_tokens))
+
+    def _warn_unpriced_budget(self):
+        """予算上限が指定されているが、モデルの料金が不明で上限が機能しない場合に警告を表示する"""
+        if self.usage.budget_usd is not None and get_pricing(self.provider, self.model_name) is None:
+            print(f"警告: モデル '{self.model_name}' の料金が不明なため、予算上限（${self.usage.budget_usd:.2f}）による中止は機能しません。"
+                  f"usage.MODEL_PRICING に料金を追加してください")
+
+    def _lookup_cache(self, text: str, system_prompt: str, max_tokens: int, schema: Optional[dict]) -> tuple:
+        """応答キャッシュを参照し、(キャッシュキー, 保存済みの応答) を返す（キャッシュ無効時は (None, None)）"""
+        if self.cache is None:
+            return None, None
+        cache_key = ResponseCache.make_key(
+            provider=self.provider,
+            model=self.model_name,
+            system_prompt=system_prompt,
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+            schema=schema,
+            text=text
+        )
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.metrics.record_cache_hit(self._metrics_label, self.provider)
+        return cache_key, cached
+
+    def _call_provider(self, text: str, system_prompt: str, max_tokens: int, schema: Optional[dict] = None) -> str:
+        """
+        バックエンドを通じてプロバイダーのAPIを呼び出し、応答テキストを返す
+        schema を指定した場合は、OpenAIはStructured Outputs、vLLMはguided_json、DeepseekはJSONモード、
+        Geminiはresponse_schema、Claudeはツール呼び出しで応答をJSONに制約する
+        """
+        # トークン数/分の制限用に入力と最大出力のトークン数を見積もる
+        estimated_tokens = self._count_tokens(system_prompt) + self._count_tokens(text) + max_tokens
+        stats = {}
+        started = time.monotonic()
+        try:
+            result = self._request_with_retry(
+                lambda: self.backend.complete(self.model_name, system_prompt, text, max_tokens, schema), estimated_tokens, stats
+            )
+        except Exception:
+            self._record_failed_call(time.monotonic() - started, stats)
+            raise
+        return self._finish_completion(result, time.monotonic() - started, system_prompt, text, stats)
+
+    async def _acall_provider(self, text: str, system_prompt: str, max_tokens: int, schema: Optional[dict] = None) -> str:
+        """_call_provider の非同期版（プロセス内で共有される非同期クライアントを使用する）"""
+        estimated_tokens = self._count_tokens(system_prompt) + self._count_tokens(text) + max_tokens
+        stats = {}
+        started = time.monotonic()
+        try:
+            result = await self._arequest_with_retry(
+                lambda: self.backend.acomplete(self.model_name, system_prompt, text, max_tokens, schema), estimated_tokens, stats
+            )
+        except Exception:
+            self._record_failed_call(time.monotonic() - started, stats)
+            raise
+        return self._finish_completion(result, time.monotonic() - started, system_prompt, text, stats)
+
+    def _finish_completion(self, result, elapsed_sec: float, system_prompt: str, text: str, stats: Optional[dict] = None) -> str:
+        """
+        バックエンドの応答（CompletionResult）の使用量と計測値を集計し、応答テキストを返す
+        elapsed_sec はレート制限の待機を含む所要時間で、応答時間は待機時間（stats）を除いて記録する
+        """
+        stats = stats or {}
+        queue_wait_sec = stats.get("queue_wait_sec", 0.0)
+        response = result.text
+        self._record_usage(result.input_tokens, result.output_tokens, max(0.0, elapsed_sec - queue_wait_sec), system_prompt,
+                           text, response, result.cached_input_tokens, queue_wait_sec, stats.get("retries", 0))
+        # 構造化出力・ツール呼び出しの応答はそのまま使い、それ以外の応答を囲むコードフェンスのみ除去する
+        return strip_code_fence(response)
+
+    def _record_failed_call(self, elapsed_sec: float, stats: dict):
+        """失敗したAPI呼び出し（再試行を含む）の計測値を記録する"""
+        queue_wait_sec = stats.get("queue_wait_sec", 0.0)
+        self.metrics.record_call(self._metrics_label, self.provider, max(0.0, elapsed_sec - queue_wait_sec), queue_wait_sec,
+                                 retries=stats.get("retries", 0), error=True)
+
     def _parse_llm_response(self, response: str) -> bool:
         """LLMの応答をブール値に変換"""
         return response.lower().startswith('はい')
@@ -431,16 +1884,53 @@ class ExcelAnalyzer:
 
         return self.df[self.df[column_name] == True]
 
+    def get_results_df(self) -> pd.DataFrame:
+        """
+        保存用の結果データフレーム（ID、結合テキスト、分析結果の列）を作成する
+
+        Returns:
+        - pd.DataFrame: 1患者1行のデータフレーム。分析結果の列がない場合は空のデータフレーム
+        """
+        if not self._validate_data():
+            return pd.DataFrame()
+
+        # 分析結果の列を特定
+        analysis_columns = [col for col in self.df.columns if col.startswith('分析結果_')]
+        if not analysis_columns:
+            return pd.DataFrame()
+
+        # IDごとに結合したテキストを取得
+        combined_texts = self._combine_texts_by_id()
+        
+        # 新しいデータフレームを作成（ID、結合テキスト、分析結果のみ）
+        result_df = pd.DataFrame()
+        result_df[self.column_mapping['id_column']] = list(combined_texts.keys())
+        result_df['text'] = [combined_texts[id_val] for id_val in result_df[self.column_mapping['id_column']]]
+        
+        # 分析結果の列を追加（各IDの最初の行の値を1回の重複削除でまとめて取得）
+        first_rows = self.df.drop_duplicates(subset=self.column_mapping['id_column']).set_index(self.column_mapping['id_column'])
+        first_values = first_rows[analysis_columns].reindex(result_df[self.column_mapping['id_column']])
+        for col in analysis_columns:
+            result_df[col] = first_values[col].to_numpy()
+        return result_df
+
     def save_results(self, output_path: str = None) -> bool:
-        """分析結果をExcelファイルとして保存"""
+        """
+        分析結果をファイルとして保存
+
+        出力形式は拡張子から判定する（.parquet / .feather / .csv / それ以外はExcel）。
+        output_pathを省略した場合、入力がParquet・Feather・CSVであれば同じ形式、それ以外はExcelで保存する。
+        """
         if not self._validate_data():
             return False
 
         try:
             # 出力パスの設定
             if output_path is None:
-                file_name = self.file_path.rsplit('.', 1)[0]
-                output_path = f"{file_name}_analyzed.xlsx"
+                file_name, extension = os.path.splitext(self.file_path)
+                if self._detect_format(self.file_path) == "excel":
+                    extension = ".xlsx"
+                output_path = f"{file_name}_analyzed{extension}"
 
             # 分析結果の列を特定
             analysis_columns = [col for col in self.df.columns if col.startswith('分析結果_')]
@@ -448,32 +1938,129 @@ class ExcelAnalyzer:
                 print("警告: 分析結果の列が見つかりません")
                 return False
 
-            # IDごとに結合したテキストを取得
-            combined_texts = self._combine_texts_by_id()
-            
-            # 新しいデータフレームを作成（ID、結合テキスト、分析結果のみ）
-            result_df = pd.DataFrame()
-            result_df[self.column_mapping['id_column']] = list(combined_texts.keys())
-            result_df['text'] = [combined_texts[id_val] for id_val in result_df[self.column_mapping['id_column']]]
-            
-            # 分析結果の列を追加
-            for col in analysis_columns:
-                # 各IDに対応する分析結果を取得（最初の行の値を使用）
-                result_df[col] = result_df[self.column_mapping['id_column']].apply(
-                    lambda id_val: self.df[self.df[self.column_mapping['id_column']] == id_val][col].iloc[0] 
-                    if not self.df[self.df[self.column_mapping['id_column']] == id_val][col].empty else None
-                )
+            result_df = self.get_results_df()
             
             # 保存と結果表示
-            result_df.to_excel(output_path, index=False)
+            self._write_table(result_df, output_path)
             print(f"分析結果を '{output_path}' に保存しました")
-            self._display_analysis_summary(analysis_columns)
+            self._display_analysis_summary([col for col in analysis_columns if not col.endswith(FINGERPRINT_SUFFIX)])
             return True
 
         except Exception as e:
             print(f"エラー: ファイルの保存中にエラーが発生しました: {str(e)}")
             return False
 
+    @classmethod
+    def merge_results(cls, partial_paths: List[str], output_path: str, id_column: Optional[str] = None) -> bool:
+        """
+        シャードごとの部分結果ファイルを1つの分析結果ファイルにまとめる
+
+        Parameters:
+        - partial_paths: 部分結果ファイルのパスのリスト（save_results で保存したもの）
+        - output_path: まとめた結果の保存先（形式は拡張子から判定する）
+        - id_column: 指定した場合はID列で並べ替え、シャード間でIDが重複していないかを確認する
+        """
+        if not partial_paths:
+            print("エラー: まとめる部分結果ファイルがありません")
+            return False
+        try:
+            merged = pd.concat([cls._read_table(path) for path in partial_paths], ignore_index=True)
+            if id_column is not None:
+                if id_column not in merged.columns:
+                    print(f"エラー: 部分結果にID列 '{id_column}' が見つかりません")
+                    return False
+                duplicated = merged[id_column].duplicated().sum()
+                if duplicated:
+                    print(f"警告: {duplicated}件のIDが複数のシャードに含まれています（シャード数の異なる部分結果が混在していないか確認してください）")
+                try:
+                    merged = merged.sort_values(id_column, kind="stable").reset_index(drop=True)
+                except TypeError:
+                    # 型の混在したIDは並べ替えずにシャードの順序のまま保存する
+                    pass
+            cls._write_table(merged, output_path)
+            print(f"{len(partial_paths)}件の部分結果（{len(merged)}件の患者）を '{output_path}' にまとめました")
+            return True
+        except Exception as e:
+            print(f"エラー: 部分結果のまとめ中にエラーが発生しました: {str(e)}")
+            return False
+
+    @classmethod
+    def read_results(cls, file_path: str) -> pd.DataFrame:
+        """
+        save_results で保存した分析結果を読み込む（Parquet/Featherで型が混在する列は元の型に戻す）
+        """
+        return cls._read_table(file_path)
+
+    @classmethod
+    def _read_table(cls, file_path: str) -> pd.DataFrame:
+        """拡張子に応じた形式でファイル全体を読み込む"""
+        file_format = cls._detect_format(file_path)
+        if file_format == "csv":
+            return pd.read_csv(file_path, sep="\t" if file_path.lower().endswith(".tsv") else ",")
+        if file_format == "parquet":
+            return cls._from_columnar(pd.read_parquet(file_path))
+        if file_format == "feather":
+            return cls._from_columnar(pd.read_feather(file_path))
+        return pd.read_excel(file_path)
+
+    @classmethod
+    def _write_table(cls, df: pd.DataFrame, output_path: str):
+        """
+        拡張子に応じた形式でデータフレームを書き出す。
+        同じディレクトリの一時ファイルに書き出してから置き換えるため、書き込み中に中断しても
+        output_path に途中までのファイルが残らない（部分結果の有無で完了を判定するシャードの再開のため）
+        """
+        file_format = cls._detect_format(output_path)
+        base, extension = os.path.splitext(output_path)
+        # 形式の判定に使う拡張子は残し、部分結果ファイル名の形式には一致しない名前にする
+        temporary_path = f"{base}.tmp-{os.getpid()}-{threading.get_ident()}{extension}"
+        try:
+            if file_format in ("parquet", "feather"):
+                df = cls._to_columnar(df)
+                if file_format == "parquet":
+                    df.to_parquet(temporary_path, index=False)
+                else:
+                    df.reset_index(drop=True).to_feather(temporary_path)
+            elif file_format == "csv":
+                df.to_csv(temporary_path, index=False, sep="\t" if output_path.lower().endswith(".tsv") else ",")
+            else:
+                df.to_excel(temporary_path, index=False)
+            os.replace(temporary_path, output_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @staticmethod
+    def _to_columnar(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        列指向形式で保存できるよう、型が混在するobject列（例: 既定値Falseと文字列の結果、
+        JSONとして返された辞書やリスト）の値をJSON文字列に変換する。
+        変換した列は attrs[JSON_COLUMNS_ATTR] に記録し、_from_columnar で元の型に戻す
+        （前回の結果を再利用した行が、新たに分析した行と同じ型になるようにする）
+        """
+        df = df.copy()
+        json_columns = []
+        for col in df.columns:
+            if df[col].dtype != object:
+                continue
+            values = df[col].dropna()
+            if values.map(lambda value: isinstance(value, (dict, list))).any() or values.map(type).nunique() > 1:
+                df[col] = df[col].map(
+                    lambda value: json.dumps(value, ensure_ascii=False, default=_json_default)
+                    if isinstance(value, (dict, list)) or not pd.isna(value) else value
+                )
+                json_columns.append(col)
+        df.attrs[JSON_COLUMNS_ATTR] = json_columns
+        return df
+
+    @staticmethod
+    def _from_columnar(df: pd.DataFrame) -> pd.DataFrame:
+        """_to_columnar でJSON文字列に変換した列を元の型に戻す"""
+        for col in df.attrs.pop(JSON_COLUMNS_ATTR, None) or []:
+            if col in df.columns:
+                df[col] = df[col].map(lambda value: json.loads(value) if isinstance(value, str) else value).astype(object)
+        return df
+
     def _display_analysis_summary(self, analysis_columns: List[str]):
         """分析結果の概要を表示"""
         print("\n分析結果の概要:")
@@ -496,6 +2083,27 @@ class ExcelAnalyzer:
                     for value, count in value_counts.head(5).items():
                         print(f"    - {value}: {count}件")
 
+    def export_metrics(self, output_path: str, format: str = "json") -> bool:
+        """
+        LLM呼び出しの計測値をテンプレート・プロバイダーごとに集計し、ファイルに出力する
+
+        Parameters:
+        - output_path: 出力先のパス
+        - format: "json" または "prometheus"（Prometheusのテキスト形式。node_exporterのtextfileコレクターなどで読み込める）
+        """
+        if format not in ("json", "prometheus"):
+            print(f"エラー: 未対応の出力形式です: {format}")
+            return False
+        try:
+            content = self.metrics.to_json() if format == "json" else self.metrics.to_prometheus()
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            print(f"計測値を '{output_path}' に出力しました")
+            return True
+        except Exception as e:
+            print(f"エラー: 計測値の出力中にエラーが発生しました: {str(e)}")
+            return False
+
     def get_available_models(self) -> List[str]:
         """
         LLMサーバーで利用可能なモデル一覧を取得する
@@ -504,19 +2112,7 @@ class ExcelAnalyzer:
             List[str]: 利用可能なモデル名のリスト
         """
         try:
-            if self.provider == "vllm":
-                response = self.client.models.list()
-                return [model.id for model in response.data]
-            elif self.provider == "openai":
-                response = self.client.models.list()
-                return [model.id for model in response.data]
-            elif self.provider == "gemini":
-                return ["gemini-2.0-flash-lite"]
-            elif self.provider == "claude":
-                return ["claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"]
-            elif self.provider == "deepseek":
-                return ["deepseek-chat", "deepseek-coder"]
-            return []
+            return self.backend.list_models()
         except Exception as e:
             print(f"モデル一覧の取得に失敗しました: {str(e)}")
             return []
@@ -528,4 +2124,5 @@ class ExcelAnalyzer:
         Parameters:
             model_name (str): 使用するモデルの名前
         """
-        self.model_name = model_name
\ No newline at end of file
+        self.model_name = model_name
+        self._warn_unpriced_budget()
\ No newline at end of file
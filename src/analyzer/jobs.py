@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+分析をバックグラウンドのスレッドで実行し、協調的に停止するためのモジュール。
+
+CancellationToken を ExcelAnalyzer.cancel_token に設定すると、分析は患者の間と各API呼び出しの前で
+停止の要求を確認し、実行中の呼び出しが終わった時点で残りの患者の分析を中止する。
+AnalysisJob はStreamlitのスクリプト実行とは別のスレッドで分析を実行し、画面は session_state に保存した
+ジョブの状態（snapshot）を定期的に参照して進捗を表示する。
+"""
+import threading
+import time
+import traceback
+from typing import Any, Callable, Optional
+
+# ジョブの状態
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+
+
+class AnalysisCancelledError(Exception):
+    """分析の停止が要求されたことを表す例外"""
+
+
+class CancellationToken:
+    """分析の停止要求を伝えるトークン（スレッド間で共有される）"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """停止を要求する"""
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """停止が要求されているかを返す"""
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        """停止が要求されている場合は AnalysisCancelledError を送出する"""
+        if self._event.is_set():
+            raise AnalysisCancelledError("分析の停止が要求されました")
+
+
+class AnalysisJob:
+    """
+    分析処理をバックグラウンドのスレッドで実行するジョブ
+
+    Parameters:
+    - target: 実行する関数。target(job) の形で呼び出され、戻り値は result に保存される。
+      関数内では job.token で停止要求を確認し、job.update_progress で進捗を報告する
+    - name: ジョブの表示名
+    """
+
+    def __init__(self, target: Callable[["AnalysisJob"], Any], name: str = "分析"):
+        self.target = target
+        self.name = name
+        self.token = CancellationToken()
+        self.state = JOB_PENDING
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._progress: dict = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "AnalysisJob":
+        """ジョブを開始する"""
+        with self._lock:
+            if self._thread is not None:
+                return self
+            self.state = JOB_RUNNING
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name=f"AnalysisJob-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            result = self.target(self)
+            state = JOB_CANCELLED if self.token.cancelled else JOB_COMPLETED
+            error = None
+        except AnalysisCancelledError:
+            result, state, error = None, JOB_CANCELLED, None
+        except Exception as e:
+            traceback.print_exc()
+            result, state, error = None, JOB_FAILED, str(e)
+        with self._lock:
+            self.result = result
+            self.state = state
+            self.error = error
+            self.finished_at = time.time()
+
+    def cancel(self):
+        """停止を要求する（実行中のAPI呼び出しが終わった時点で停止する）"""
+        self.token.cancel()
+
+    @property
+    def running(self) -> bool:
+        """実行中かを返す"""
+        with self._lock:
+            return self.state == JOB_RUNNING
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ジョブの終了を待ち、終了した場合はTrueを返す"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.running
+
+    def update_progress(self, **progress):
+        """進捗を更新する（ワーカースレッドから呼び出される）"""
+        with self._lock:
+            self._progress.update(progress)
+
+    def snapshot(self) -> dict:
+        """ジョブの状態と進捗の写しを返す（画面の更新用）"""
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "name": self.name,
+                "state": self.state,
+                "cancel_requested": self.token.cancelled,
+                "error": self.error,
+                "elapsed_sec": (end - self.started_at) if self.started_at else 0.0,
+                **self._progress
+            }
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+複数のvLLMサーバー（レプリカ）にリクエストを振り分けるモジュール。
+
+振り分け方は、処理中のリクエスト数が最も少ないサーバーを選ぶ least_outstanding（重みで割った値で比較）と、
+重みの比率で順番に割り当てる weighted（平滑化重み付きラウンドロビン）から選ぶ。
+接続エラーや5xx応答を返したサーバーは一定時間振り分け対象から外し、残りのサーバーで再送する（フェイルオーバー）。
+外したサーバーは models.list() によるヘルスチェックで復帰を確認するか、待機時間の経過後に再び使用する。
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import httpx
+
+from .rate_limiter import _get_status_code
+
+ROUTING_POLICIES = ("least_outstanding", "weighted")
+
+EndpointSpec = Union[None, str, Sequence, Dict[str, float]]
+
+
+def parse_endpoints(spec: EndpointSpec) -> Tuple[Tuple[Optional[str], float], ...]:
+    """
+    接続先の指定を ((URL, 重み), ...) に変換する
+
+    以下の形式を受け付ける（重みの既定値は1）:
+    - "http://a:8000/v1" または "http://a:8000/v1,http://b:8000/v1"（カンマ・改行区切り）
+    - 各行を "URL 重み" とした文字列（例: "http://a:8000/v1 2"）
+    - URLのリスト、(URL, 重み) のリスト、{URL: 重み} の辞書
+    """
+    if spec is None:
+        return ((None, 1.0),)
+    if isinstance(spec, dict):
+        items: Iterable = spec.items()
+    elif isinstance(spec, str):
+        items = [line.split() for line in spec.replace(",", "\n").splitlines() if line.strip()]
+    else:
+        items = [[item] if isinstance(item, str) else item for item in spec]
+    endpoints = []
+    for item in items:
+        url, weight = (item[0], item[1]) if len(item) > 1 else (item[0], 1.0)
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError(f"接続先の重みは正の値で指定してください: {url} {weight}")
+        endpoints.append((url.strip(), weight))
+    if not endpoints:
+        raise ValueError("接続先のURLが指定されていません")
+    return tuple(endpoints)
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """サーバー側の障害（接続エラー・タイムアウト・5xx応答）で、別のサーバーへ再送すべき例外かを判定する"""
+    if isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    # OpenAI SDKの APIConnectionError / APITimeoutError
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return True
+    status_code = _get_status_code(error)
+    return status_code is not None and status_code >= 500
+
+
+class Endpoint:
+    """振り分け先の1台のサーバーの状態"""
+
+    def __init__(self, url: Optional[str], weight: float = 1.0):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.served = 0
+        self.healthy = True
+        self.failures = 0
+        # 障害時に振り分け対象から外す期限（time.monotonic）
+        self.retry_at = 0.0
+        # 平滑化重み付きラウンドロビンの現在値
+        self.current_weight = 0.0
+
+    def __repr__(self) -> str:
+        state = "正常" if self.healthy else "停止"
+        return f"Endpoint({self.url}, 重み={self.weight}, 処理中={self.outstanding}, {state})"
+
+
+class EndpointPool:
+    """
+    複数の接続先への振り分け・障害の記録・ヘルスチェックを行う（スレッド・コルーチンから共有される）
+
+    Parameters:
+    - endpoints: ((URL, 重み), ...)
+    - routing: 振り分け方（least_outstanding / weighted）
+    - cooldown_sec: 障害を検知したサーバーを外す時間（連続した障害ごとに倍にし、max_cooldown_sec を上限とする）
+    - health_check_interval: ヘルスチェックの間隔（秒）
+    """
+
+    def __init__(self, endpoints: Sequence[Tuple[Optional[str], float]], routing: str = "least_outstanding",
+                 cooldown_sec: float = 5.0, max_cooldown_sec: float = 120.0, health_check_interval: float = 30.0):
+        if routing not in ROUTING_POLICIES:
+            raise ValueError(f"未対応の振り分け方です: {routing}（{' / '.join(ROUTING_POLICIES)}）")
+        self.endpoints = [Endpoint(url, weight) for url, weight in endpoints]
+        self.routing = routing
+        self.cooldown_sec = cooldown_sec
+        self.max_cooldown_sec = max_cooldown_sec
+        self.health_check_interval = health_check_interval
+        self._last_health_check = time.monotonic()
+        self._health_check_running = False
+        self._lock = threading.Lock()
+
+    def select(self, exclude: Iterable[Endpoint] = ()) -> Optional[Endpoint]:
+        """
+        次に使用するサーバーを選ぶ。exclude（この呼び出しで既に失敗したサーバー）は除く。
+        正常なサーバーがない場合は、待機時間を過ぎた停止中のサーバー、それもなければ最も早く復帰するサーバーを返す
+        """
+        excluded = {id(endpoint) for endpoint in exclude}
+        now = time.monotonic()
+        with self._lock:
+            remaining = [endpoint for endpoint in self.endpoints if id(endpoint) not in excluded]
+            if not remaining:
+                return None
+            candidates = ([endpoint for endpoint in remaining if endpoint.healthy]
+                          or [endpoint for endpoint in remaining if endpoint.retry_at <= now]
+                          or [min(remaining, key=lambda endpoint: endpoint.retry_at)])
+            if self.routing == "weighted":
+                total = sum(endpoint.weight for endpoint in candidates)
+                for endpoint in candidates:
+                    endpoint.current_weight += endpoint.weight
+                chosen = max(candidates, key=lambda endpoint: endpoint.current_weight)
+                chosen.current_weight -= total
+            else:
+                chosen = min(candidates, key=lambda endpoint: (endpoint.outstanding / endpoint.weight, endpoint.served / endpoint.weight))
+            chosen.outstanding += 1
+            chosen.served += 1
+            return chosen
+
+    def release(self, endpoint: Endpoint):
+        """select で選んだサーバーのリクエストが終わったことを記録する"""
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    @contextmanager
+    def track(self, endpoint: Endpoint):
+        """with 文の間、サーバーの処理中のリクエストとして数える"""
+        try:
+            yield endpoint
+        finally:
+            self.release(endpoint)
+
+    def mark_success(self, endpoint: Endpoint):
+        """サーバーが応答したことを記録する（停止中であれば復帰させる）"""
+        with self._lock:
+            if not endpoint.healthy and len(self.endpoints) > 1:
+                print(f"vLLMサーバー {endpoint.url} が復帰しました")
+            endpoint.healthy = True
+            endpoint.failures = 0
+
+    def mark_failure(self, endpoint: Endpoint, error: Optional[Exception] = None):
+        """サーバーの障害を記録し、一定時間振り分け対象から外す"""
+        with self._lock:
+            endpoint.failures += 1
+            cooldown = min(self.max_cooldown_sec, self.cooldown_sec * (2 ** (endpoint.failures - 1)))
+            endpoint.retry_at = time.monotonic() + cooldown
+            if endpoint.healthy and len(self.endpoints) > 1:
+                print(f"警告: vLLMサーバー {endpoint.url} で障害が発生したため{cooldown:.0f}秒間振り分けを停止します: {str(error)}")
+            endpoint.healthy = False
+
+    def claim_health_check(self) -> bool:
+        """
+        ヘルスチェックの実施時期であれば、呼び出し元が実施する権利を得てTrueを返す
+        （同時に複数のスレッドが実施しないようにする）。実施後は finish_health_check を呼び出すこと
+        """
+        with self._lock:
+            if len(self.endpoints) < 2 or self._health_check_running:
+                return False
+            if time.monotonic() - self._last_health_check < self.health_check_interval:
+                return False
+            self._health_check_running = True
+            return True
+
+    def finish_health_check(self):
+        """ヘルスチェックの終了を記録する"""
+        with self._lock:
+            self._health_check_running = False
+            self._last_health_check = time.monotonic()
+
+    def record_health(self, endpoint: Endpoint, ok: bool, error: Optional[Exception] = None):
+        """ヘルスチェックの結果を記録する"""
+        if ok:
+            self.mark_success(endpoint)
+        else:
+            self.mark_failure(endpoint, error)
+
+    def status(self) -> List[dict]:
+        """各サーバーの状態を返す"""
+        with self._lock:
+            return [
+                {"url": endpoint.url, "weight": endpoint.weight, "healthy": endpoint.healthy,
+                 "outstanding": endpoint.outstanding, "served": endpoint.served, "failures": endpoint.failures}
+                for endpoint in self.endpoints
+            ]
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+LLM呼び出しごとの計測値を集計し、JSONまたはPrometheusのテキスト形式で出力するモジュール。
+
+呼び出しごとに待機時間（レート制限の待ち）・応答時間・入出力トークン数・再試行回数・エラーを記録し、
+応答キャッシュのヒットとJSON解析の失敗も数える。これらをテンプレートとプロバイダーの組ごとに集計し、
+p50/p95/p99 の応答時間とスループットを求める。計測値には患者のテキストや応答の内容を含めない。
+"""
+import json
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 集計で求める分位点
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Prometheusのメトリクス名の接頭辞
+METRIC_PREFIX = "llmatch_llm"
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """値の分位点を線形補間で求める（値がない場合はNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class _GroupStats:
+    """テンプレート・プロバイダーの組ごとの計測値"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.parse_failures = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_input_tokens = 0
+        self.latencies: List[float] = []
+        self.queue_waits: List[float] = []
+        # スループットの計算に使う最初の呼び出しの開始時刻と最後の呼び出しの終了時刻（time.monotonic）
+        self.first_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+
+    def observe_period(self, started: float, finished: float):
+        if self.first_started is None or started < self.first_started:
+            self.first_started = started
+        if self.last_finished is None or finished > self.last_finished:
+            self.last_finished = finished
+
+    def summary(self) -> dict:
+        elapsed = (self.last_finished - self.first_started) if self.first_started is not None else 0.0
+        completed = self.calls - self.errors + self.cache_hits
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "cache_hits": self.cache_hits,
+            "parse_failures": self.parse_failures,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_input_tokens": self.cached_input_tokens,
+            "latency_sec": _distribution(self.latencies),
+            "queue_wait_sec": _distribution(self.queue_waits),
+            "elapsed_sec": round(elapsed, 3),
+            # 1秒あたりに完了したリクエスト数（キャッシュのヒットを含む）
+            "throughput_per_sec": round(completed / elapsed, 3) if elapsed > 0 else None
+        }
+
+
+def _distribution(values: List[float]) -> dict:
+    """値の件数・合計・平均・最大と分位点を返す"""
+    result = {
+        "count": len(values),
+        "sum": round(sum(values), 6),
+        "mean": round(sum(values) / len(values), 6) if values else None,
+        "max": round(max(values), 6) if values else None
+    }
+    for q in QUANTILES:
+        value = percentile(values, q)
+        result[f"p{int(q * 100)}"] = round(value, 6) if value is not None else None
+    return result
+
+
+class MetricsCollector:
+    """LLM呼び出しの計測値を記録・集計する（ワーカースレッド・コルーチンから共有される）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """計測値を初期化する"""
+        with self._lock:
+            self._groups: Dict[Tuple[str, str], _GroupStats] = {}
+
+    def _group(self, template: Optional[str], provider: str) -> _GroupStats:
+        key = (template or "-", provider)
+        if key not in self._groups:
+            self._groups[key] = _GroupStats()
+        return self._groups[key]
+
+    def record_call(self, template: Optional[str], provider: str, latency_sec: float, queue_wait_sec: float = 0.0,
+                    input_tokens: Optional[int] = None, output_tokens: Optional[int] = None,
+                    cached_input_tokens: Optional[int] = None, retries: int = 0, error: bool = False):
+        """1回のAPI呼び出し（再試行を含む）の計測値を記録する"""
+        finished = time.monotonic()
+        with self._lock:
+            group = self._group(template, provider)
+            group.calls += 1
+            group.errors += int(error)
+            group.retries += retries
+            group.input_tokens += int(input_tokens or 0)
+            group.output_tokens += int(output_tokens or 0)
+            group.cached_input_tokens += int(cached_input_tokens or 0)
+            group.latencies.append(latency_sec)
+            group.queue_waits.append(queue_wait_sec)
+            group.observe_period(finished - latency_sec - queue_wait_sec, finished)
+
+    def record_cache_hit(self, template: Optional[str], provider: str):
+        """応答キャッシュのヒットを記録する"""
+        now = time.monotonic()
+        with self._lock:
+            group = self._group(template, provider)
+            group.cache_hits += 1
+            group.observe_period(now, now)
+
+    def record_parse_failure(self, template: Optional[str], provider: str):
+        """応答のJSON解析またはスキーマ検証の失敗を記録する"""
+        with self._lock:
+            self._group(template, provider).parse_failures += 1
+
+    def summary(self) -> List[dict]:
+        """テンプレート・プロバイダーの組ごとの集計値のリストを返す"""
+        with self._lock:
+            return [
+                {"template": template, "provider": provider, **group.summary()}
+                for (template, provider), group in sorted(self._groups.items())
+            ]
+
+    def to_json(self) -> str:
+        """集計値をJSON文字列で返す"""
+        return json.dumps({"groups": self.summary()}, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self) -> str:
+        """集計値をPrometheusのテキスト形式（exposition format）で返す"""
+        groups = self.summary()
+        lines: List[str] = []
+
+        counters = [
+            ("calls_total", "calls", "LLM API呼び出し回数"),
+            ("errors_total", "errors", "失敗したLLM API呼び出しの回数"),
+            ("retries_total", "retries", "LLM API呼び出しの再試行回数"),
+            ("cache_hits_total", "cache_hits", "応答キャッシュのヒット数"),
+            ("parse_failures_total", "parse_failures", "応答のJSON解析・スキーマ検証の失敗数"),
+            ("input_tokens_total", "input_tokens", "入力トークン数"),
+            ("output_tokens_total", "output_tokens", "出力トークン数"),
+            ("cached_input_tokens_total", "cached_input_tokens", "プロンプトキャッシュから読み込まれた入力トークン数"),
+        ]
+        for name, field, help_text in counters:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+            for group in groups:
+                lines.append(f"{METRIC_PREFIX}_{name}{_labels(group)} {group[field]}")
+
+        summaries = [
+            ("latency_seconds", "latency_sec", "LLM API呼び出しの応答時間（秒）"),
+            ("queue_wait_seconds", "queue_wait_sec", "レート制限による呼び出し前の待機時間（秒）"),
+        ]
+        for name, field, help_text in summaries:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} summary")
+            for group in groups:
+                distribution = group[field]
+                for q in QUANTILES:
+                    value = distribution[f"p{int(q * 100)}"]
+                    lines.append(f"{METRIC_PREFIX}_{name}{_labels(group, quantile=str(q))} {_number(value)}")
+                lines.append(f"{METRIC_PREFIX}_{name}_sum{_labels(group)} {distribution['sum']}")
+                lines.append(f"{METRIC_PREFIX}_{name}_count{_labels(group)} {distribution['count']}")
+
+        lines.append(f"# HELP {METRIC_PREFIX}_throughput_per_second 1秒あたりに完了したリクエスト数")
+        lines.append(f"# TYPE {METRIC_PREFIX}_throughput_per_second gauge")
+        for group in groups:
+            lines.append(f"{METRIC_PREFIX}_throughput_per_second{_labels(group)} {_number(group['throughput_per_sec'])}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(group: dict, **extra: str) -> str:
+    """Prometheusのラベル部分を作成する"""
+    labels = {"template": group["template"], "provider": group["provider"], **extra}
+    escaped = [
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _number(value: Optional[float]) -> str:
+    """Prometheusの値の表記（値がない場合はNaN）"""
+    return "NaN" if value is None else str(value)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+LLMプロバイダーごとのレート制限を行うモジュール。
+リクエスト数/分とトークン数/分のトークンバケットで呼び出しを平準化し、
+429/5xx応答時はRetry-Afterに従って全スレッドの呼び出しを一時停止する。
+"""
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+# 再試行の対象とするHTTPステータスコード（529はAnthropicの過負荷応答）
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """
+    1分あたりの補充量で定義されるトークンバケット。
+    不足分は予約として負の残量で表し、呼び出し側はその分だけ待機する。
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """amount分を予約し、利用可能になるまでの待機秒数を返す"""
+        # バケット容量を超える要求は容量分として扱う（永久に待たないため）
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class RateLimiter:
+    """
+    リクエスト数/分とトークン数/分の2つのバケットを組み合わせたレートリミッター。
+    上限がNoneの場合はその制限を行わない（vLLMなどのローカルサーバー向け）。
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0) -> float:
+        """呼び出し枠を確保するまで待機し、待機した秒数を返す"""
+        waited = 0.0
+        with self._lock:
+            blocked = self._blocked_until - time.monotonic()
+        if blocked > 0:
+            time.sleep(blocked)
+            waited += blocked
+
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """acquire の非同期版（イベントループを止めずに待機する）"""
+        waited = 0.0
+        with self._lock:
+            blocked = self._blocked_until - time.monotonic()
+        if blocked > 0:
+            await asyncio.sleep(blocked)
+            waited += blocked
+
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+    def _reserve(self, tokens: int) -> float:
+        """リクエスト1件とトークン数分の枠を予約し、必要な待機秒数を返す"""
+        wait = 0.0
+        if self._request_bucket:
+            wait = max(wait, self._request_bucket.reserve(1))
+        if self._token_bucket and tokens:
+            wait = max(wait, self._token_bucket.reserve(tokens))
+        return wait
+
+    def backoff(self, delay: float):
+        """delay秒間、このリミッターを使う全ての呼び出しを停止する"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str,
+                     requests_per_minute: Optional[float] = None,
+                     tokens_per_minute: Optional[float] = None) -> RateLimiter:
+    """
+    プロバイダー単位で共有されるレートリミッターを取得する。
+    同じAPIキーの枠を複数のExcelAnalyzerインスタンスで分け合うため、プロセス内で共有する。
+    設定値が変わった場合は新しいリミッターに置き換える。
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if (limiter is None
+                or limiter.requests_per_minute != requests_per_minute
+                or limiter.tokens_per_minute != tokens_per_minute):
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _limiters[provider] = limiter
+        return limiter
+
+
+def _get_status_code(error: Exception) -> Optional[int]:
+    """SDKごとに異なる例外からHTTPステータスコードを取り出す"""
+    for attr in ("status_code", "code", "status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def _parse_retry_after(error: Exception) -> Optional[float]:
+    """Retry-After（秒数またはHTTP日付）およびretry-after-msヘッダーを解釈する"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return float(retry_after_ms) / 1000.0
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def get_retry_delay(error: Exception, attempt: int, base_delay: float = 1.0, max_delay: float = 60.0) -> Optional[float]:
+    """
+    再試行までの待機秒数を返す。再試行すべきでない例外の場合はNoneを返す。
+
+    Parameters:
+    - error: API呼び出しで発生した例外
+    - attempt: これまでの再試行回数（0始まり）
+    """
+    status_code = _get_status_code(error)
+    if status_code not in RETRYABLE_STATUS_CODES:
+        return None
+    retry_after = _parse_retry_after(error)
+    if retry_after is not None:
+        return min(retry_after, max_delay)
+    # Retry-Afterがない場合はジッター付きの指数バックオフ
+    return min(max_delay, base_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
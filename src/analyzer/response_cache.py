@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+LLM応答をディスクに保存する永続キャッシュ。
+プロバイダー・モデル・プロンプト・生成パラメータ・入力テキストのハッシュをキーとして
+SQLiteに保存し、同じ内容の再実行ではAPIを呼び出さずに応答を返す。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+class ResponseCache:
+    """
+    内容アドレス方式のLLM応答キャッシュ。
+
+    Parameters:
+    - path: SQLiteファイルのパス
+    - max_entries: 保持する最大件数（超過分は最終参照が古いものから削除）
+    - max_age_days: 保持期間（日）。これより古い応答は削除される
+    - timeout: 他のプロセスが書き込み中の場合に待つ最大時間（秒）
+    - journal_mode: SQLiteのジャーナルモード。WALはネットワークファイルシステムでは使用できないため、
+      共有ファイルシステム上に置く場合は "DELETE" を指定する
+
+    キャッシュはAPI呼び出しの省略のためのものなので、読み書きの失敗（他のプロセスによるロックなど）は
+    警告を表示してキャッシュなしとして扱い、例外は送出しない。
+    """
+
+    # 何件書き込むごとに削除処理を行うか
+    EVICT_INTERVAL = 1000
+    # 最終参照時刻を更新する間隔（秒）。読み込みのたびに書き込みが発生しないよう、これより新しい場合は更新しない
+    ACCESS_UPDATE_INTERVAL_SEC = 3600
+
+    def __init__(self, path: str, max_entries: int = 100_000, max_age_days: float = 30, timeout: float = 30.0,
+                 journal_mode: str = "WAL"):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # ワーカースレッドからも利用するため、接続はロックで保護して共有する
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(f"PRAGMA journal_mode={journal_mode}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)")
+            self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        """キーとなる要素からSHA-256ハッシュを作成する"""
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュされた応答を返す。存在しない・期限切れ・読み込みに失敗した場合はNone"""
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT response, created, accessed FROM responses WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                self._warn("読み込み", e)
+                self.misses += 1
+                return None
+            if row is None or (self.max_age_days and now - row[1] > self.max_age_days * 86400):
+                self.misses += 1
+                return None
+            if now - row[2] > self.ACCESS_UPDATE_INTERVAL_SEC:
+                try:
+                    self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    # 最終参照時刻は削除の順序にのみ使用するため、更新できなくても応答は返す
+                    self._rollback()
+                    self._warn("最終参照時刻の更新", e)
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, response: str):
+        """応答を保存する（保存に失敗した場合は警告のみ表示する）"""
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, response, now, now)
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._rollback()
+                self._warn("保存", e)
+                return
+            self._writes += 1
+            should_evict = self._writes % self.EVICT_INTERVAL == 0
+        if should_evict:
+            self.evict()
+
+    def _rollback(self):
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            pass
+
+    def _warn(self, operation: str, error: Exception):
+        """読み書きの失敗を警告として表示する（ロック保持中に呼び出す）"""
+        self.errors += 1
+        print(f"警告: LLM応答キャッシュ '{self.path}' の{operation}に失敗しました（キャッシュなしで続行します）: {str(error)}")
+
+    def evict(self):
+        """期限切れの応答と、上限件数を超えた古い応答を削除する（失敗した場合は次の機会に行う）"""
+        with self._lock:
+            try:
+                if self.max_age_days:
+                    self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_days * 86400,))
+                if self.max_entries:
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE key IN ("
+                        "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                        (self.max_entries,)
+                    )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._rollback()
+                self._warn("古い応答の削除", e)
+
+    def clear(self):
+        """全ての応答を削除する"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """ヒット数・ミス数・読み書きの失敗数・保存件数を返す"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "errors": self.errors, "entries": entries}
+
+    def close(self):
+        """データベース接続を閉じる"""
+        with self._lock:
+            self._conn.close()
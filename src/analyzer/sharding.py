@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+患者をシャード（分割単位）に振り分け、複数のプロセス・ノードで分析するためのモジュール。
+
+患者IDのハッシュでシャードを決めるため、入力ファイルの行の順序や読み込むプロセスによらず
+同じ患者は常に同じシャードに入る。各シャードは独立に分析されて部分結果ファイルに保存され、
+全シャードの部分結果を ExcelAnalyzer.merge_results で1つの分析結果にまとめる。
+部分結果は共有ファイルシステム上の同じディレクトリに書き出すことで、複数のマシンで分担できる。
+"""
+import glob
+import hashlib
+import os
+import re
+from typing import Dict, List, Optional
+
+from .checkpoint import CheckpointJournal
+
+# 部分結果ファイル名の形式（part-<シャード番号>-of-<シャード数>.parquet）。
+# 書き込み中の一時ファイル（part-...-of-....tmp-<プロセスID>-....parquet）は一致しない
+PARTIAL_RESULT_PATTERN = re.compile(r"^part-(\d+)-of-(\d+)\.parquet$")
+
+
+def shard_of(patient_id, num_shards: int) -> int:
+    """
+    患者IDのシャード番号（0 〜 num_shards-1）を返す
+
+    Pythonの hash() はプロセスごとに異なるため使用せず、患者IDキー（チェックポイントと同じ文字列表現）の
+    SHA-1で決める。Excel由来の整数IDとCSV由来の文字列IDのように型が異なっても同じシャードになる。
+    """
+    if num_shards < 1:
+        raise ValueError(f"シャード数は1以上で指定してください: {num_shards}")
+    digest = hashlib.sha1(CheckpointJournal.patient_key(patient_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def validate_shard(shard_index: int, num_shards: int):
+    """シャード番号とシャード数の組を検証する（不正な場合はValueError）"""
+    if num_shards < 1:
+        raise ValueError(f"シャード数は1以上で指定してください: {num_shards}")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"シャード番号は0〜{num_shards - 1}で指定してください: {shard_index}")
+
+
+def partial_result_path(parts_dir: str, shard_index: int, num_shards: int) -> str:
+    """シャードの部分結果ファイルのパスを返す"""
+    validate_shard(shard_index, num_shards)
+    return os.path.join(parts_dir, f"part-{shard_index:05d}-of-{num_shards:05d}.parquet")
+
+
+def find_partial_results(parts_dir: str, num_shards: Optional[int] = None) -> Dict[int, str]:
+    """
+    ディレクトリ内の部分結果ファイルを探し、{シャード番号: パス} を返す
+
+    Parameters:
+    - num_shards: 指定した場合はこのシャード数で作成された部分結果のみを対象とする
+    """
+    found = {}
+    for path in sorted(glob.glob(os.path.join(parts_dir, "part-*-of-*.parquet"))):
+        match = PARTIAL_RESULT_PATTERN.search(os.path.basename(path))
+        if match is None:
+            continue
+        shard_index, shard_count = int(match.group(1)), int(match.group(2))
+        if num_shards is not None and shard_count != num_shards:
+            continue
+        found[shard_index] = path
+    return found
+
+
+def missing_shards(parts_dir: str, num_shards: int) -> List[int]:
+    """
+    部分結果ファイルがまだないシャード番号のリストを返す
+    （部分結果は全テンプレートの分析が完了したシャードのみ、書き込みの完了後に最終的な名前で保存される）
+    """
+    found = find_partial_results(parts_dir, num_shards)
+    return [shard_index for shard_index in range(num_shards) if shard_index not in found]
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+LLMの構造化出力（JSONスキーマ）に関する処理。
+
+テンプレートは "schema" に出力のJSONスキーマを定義できる（未定義の場合は result / reason の既定スキーマ）。
+各プロバイダーの構造化出力機能でスキーマに従わせ、それでも適合しない応答は1回だけ修復を依頼する。
+"""
+import copy
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+# 抽出（extract など）の既定スキーマ
+DEFAULT_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "result": {"type": "string"},
+        "reason": {"type": "string"}
+    },
+    "required": ["result", "reason"],
+    "additionalProperties": False
+}
+
+# 二値分析（binary）の既定スキーマ
+BINARY_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "result": {"type": "boolean"},
+        "reason": {"type": "string"}
+    },
+    "required": ["result", "reason"],
+    "additionalProperties": False
+}
+
+# Claudeのツール呼び出しで結果を受け取る際のツール名
+RESULT_TOOL_NAME = "record_result"
+
+# 応答の先頭・末尾のコードフェンス（```json など）
+_LEADING_FENCE = re.compile(r"\A```[\w-]*[ \t]*\n?")
+_TRAILING_FENCE = re.compile(r"\n?[ \t]*```\Z")
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "null": type(None)
+}
+
+
+def get_template_schema(template: Optional[dict], analysis_type: str = "extract") -> dict:
+    """テンプレートの出力スキーマを返す（未定義の場合は分析タイプごとの既定スキーマ）"""
+    if template and isinstance(template.get("schema"), dict):
+        return template["schema"]
+    return BINARY_RESULT_SCHEMA if analysis_type == "binary" else DEFAULT_RESULT_SCHEMA
+
+
+def build_fused_schema(schemas: Dict[str, dict]) -> dict:
+    """テンプレートキーごとのスキーマを、キーをプロパティとする1つのスキーマにまとめる"""
+    return {
+        "type": "object",
+        "properties": dict(schemas),
+        "required": list(schemas),
+        "additionalProperties": False
+    }
+
+
+def is_strict_compatible(schema: dict) -> bool:
+    """
+    OpenAIのStructured Outputs（strict）で使用できるスキーマかを判定する
+    （全てのオブジェクトで additionalProperties が false かつ全プロパティが必須であること）
+    """
+    if not isinstance(schema, dict):
+        return True
+    if schema.get("type") == "object" or "properties" in schema:
+        properties = schema.get("properties", {})
+        if schema.get("additionalProperties", True) is not False:
+            return False
+        if set(schema.get("required", [])) != set(properties):
+            return False
+        if not all(is_strict_compatible(value) for value in properties.values()):
+            return False
+    if "items" in schema and not is_strict_compatible(schema["items"]):
+        return False
+    return all(is_strict_compatible(option) for option in schema.get("anyOf", []))
+
+
+def strip_code_fence(response: str) -> str:
+    """
+    応答の先頭と末尾にある ```json などのコードフェンスをそれぞれ1つだけ除去する
+    （構造化出力の応答にはフェンスがないためそのまま返り、JSONの値に含まれる ``` も変更しない）
+    """
+    text = _LEADING_FENCE.sub("", response.strip(), count=1)
+    return _TRAILING_FENCE.sub("", text, count=1).strip()
+
+
+def parse_json(response: str):
+    """
+    応答をJSONとして解析する。前後に説明文が付いている場合は最初の { から最後の } までを解析する
+
+    Raises:
+    - json.JSONDecodeError: JSONとして解析できない場合
+    """
+    text = strip_code_fence(response)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end <= start:
+            raise
+        return json.loads(text[start:end + 1])
+
+
+def validate(value, schema: dict, path: str = "$") -> List[str]:
+    """
+    値がスキーマに適合するかを確認し、適合しない箇所の説明のリストを返す（空なら適合）
+    type / properties / required / additionalProperties / items / enum のみを確認する簡易的な検証
+    """
+    errors: List[str] = []
+    expected = schema.get("type")
+    if expected is not None:
+        types = expected if isinstance(expected, list) else [expected]
+        python_types = []
+        for name in types:
+            python_type = _JSON_TYPES.get(name, object)
+            python_types.extend(python_type if isinstance(python_type, tuple) else (python_type,))
+        python_types = tuple(python_types)
+        # bool は int のサブクラスのため、数値型として扱わない
+        if isinstance(value, bool) and "boolean" not in types:
+            return [f"{path}: {'/'.join(types)} であるべき値が真偽値です"]
+        if not isinstance(value, python_types):
+            return [f"{path}: {'/'.join(types)} であるべき値が {type(value).__name__} です"]
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {schema['enum']} のいずれかである必要があります")
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key}: 必須の項目がありません")
+        for key, item in value.items():
+            if key in properties:
+                errors.extend(validate(item, properties[key], f"{path}.{key}"))
+            elif schema.get("additionalProperties") is False:
+                errors.append(f"{path}.{key}: スキーマにない項目です")
+    if isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for index, item in enumerate(value):
+            errors.extend(validate(item, schema["items"], f"{path}[{index}]"))
+    return errors
+
+
+def check_response(response: str, schema: dict) -> Tuple[Optional[object], Optional[str]]:
+    """応答を解析してスキーマに照合し、(解析結果, エラー内容) を返す（適合する場合はエラー内容がNone）"""
+    try:
+        value = parse_json(response)
+    except json.JSONDecodeError as e:
+        return None, f"JSONとして解析できません（{str(e)}）"
+    errors = validate(value, schema)
+    if errors:
+        return value, "; ".join(errors[:5])
+    return value, None
+
+
+def build_repair_prompt(schema: dict, error: str) -> str:
+    """スキーマに適合しなかった応答の修復を依頼するシステムプロンプトを作成する"""
+    return "\n".join([
+        "あなたはJSONの修復を行うアシスタントです。",
+        "与えられたテキストは、以下のJSONスキーマに従うべきLLMの出力ですが、次の問題があります。",
+        f"問題: {error}",
+        "",
+        "JSONスキーマ:",
+        json.dumps(schema, ensure_ascii=False),
+        "",
+        "内容は変えずに、スキーマに適合するJSONのみを返してください。説明や追加のコメントは不要です。"
+    ])
+
+
+def to_gemini_schema(schema: dict) -> dict:
+    """
+    Geminiの response_schema（OpenAPIのサブセット）で使用できない指定を取り除く
+    （additionalProperties の削除と、型のリストを nullable への変換）
+    """
+    converted = copy.deepcopy(schema)
+
+    def convert(node):
+        if isinstance(node, dict):
+            node.pop("additionalProperties", None)
+            if isinstance(node.get("type"), list):
+                types = [t for t in node["type"] if t != "null"]
+                if len(types) < len(node["type"]):
+                    node["nullable"] = True
+                node["type"] = types[0] if types else "string"
+            for value in node.values():
+                convert(value)
+        elif isinstance(node, list):
+            for item in node:
+                convert(item)
+
+    convert(converted)
+    return converted
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+トークン数の計測・料金の見積もり・使用量の集計を行うモジュール。
+
+トークン数は tiktoken がインストールされていればそのトークナイザーで数え、
+なければ文字種ごとの概算（日本語は1文字≒1トークン、英数字は4文字≒1トークン）で見積もる。
+"""
+import threading
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+
+# モデルごとの料金（USD / 100万トークン、(入力, 出力)）。モデル名の前方一致で参照する
+# 2025年初時点の公開価格。ローカルで動作するプロバイダー（LOCAL_PROVIDERS）は0として扱う
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "claude-3-5-haiku": (0.80, 4.00),
+    "claude-3-haiku": (0.25, 1.25),
+    "claude-3-5-sonnet": (3.00, 15.00),
+    "claude-3-sonnet": (3.00, 15.00),
+    "claude-3-opus": (15.00, 75.00),
+    "deepseek-chat": (0.27, 1.10),
+    "deepseek-coder": (0.27, 1.10),
+}
+
+# プロバイダー側のプロンプトキャッシュから読み込まれた入力トークンの料金（通常の入力料金に対する比率）
+CACHED_INPUT_PRICE_RATIO = {
+    "openai": 0.5,
+    "gemini": 0.25,
+    "claude": 0.1,
+    "deepseek": 0.26,
+}
+
+# 実測値がない場合に見積もりで使用する1リクエストあたりの応答時間（秒）
+DEFAULT_LATENCY_SEC = {
+    "vllm": 3.0,
+    "openai": 2.0,
+    "gemini": 1.5,
+    "claude": 3.0,
+    "deepseek": 4.0,
+}
+
+# 料金が発生しないローカルのプロバイダー
+LOCAL_PROVIDERS = {"vllm", "vllm_offline"}
+
+# tiktoken で数えるプロバイダー（OpenAI系のトークナイザーに近いもの）
+_TIKTOKEN_PROVIDERS = {"openai", "vllm", "vllm_offline", "deepseek"}
+
+
+class BudgetExceededError(Exception):
+    """使用料金が予算上限に達したことを表す例外"""
+
+
+def count_tokens_heuristic(text: str) -> int:
+    """トークナイザーを使用せずにトークン数を見積もる（日本語は1文字≒1トークン、ASCIIは4文字≒1トークン）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(provider: str, model_name: str) -> Callable[[str], int]:
+    """
+    プロバイダーとモデルに応じたトークン数の計測関数を返す
+
+    OpenAI互換のプロバイダーでは tiktoken（未インストールの場合は概算）を使用する。
+    Gemini・Claudeのトークナイザーはローカルで利用できないため概算とする。
+    """
+    if provider in _TIKTOKEN_PROVIDERS:
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+            return lambda text: len(encoding.encode(text or "", disallowed_special=()))
+        except Exception:
+            # tiktoken が未インストール、またはエンコーディングを取得できない場合
+            pass
+    return count_tokens_heuristic
+
+
+def get_pricing(provider: str, model_name: str) -> Optional[Tuple[float, float]]:
+    """モデルの料金 (入力, 出力)（USD / 100万トークン）を返す。不明な場合はNone"""
+    if provider in LOCAL_PROVIDERS:
+        return 0.0, 0.0
+    matches = [prefix for prefix in MODEL_PRICING if (model_name or "").startswith(prefix)]
+    if not matches:
+        return None
+    return MODEL_PRICING[max(matches, key=len)]
+
+
+def estimate_cost(provider: str, model_name: str, input_tokens: int, output_tokens: int,
+                  cached_input_tokens: int = 0) -> Optional[float]:
+    """
+    トークン数から料金（USD）を計算する。料金が不明なモデルではNone
+
+    cached_input_tokens は input_tokens のうちプロンプトキャッシュから読み込まれた分で、
+    プロバイダーごとの割引率（CACHED_INPUT_PRICE_RATIO）を適用する。
+    """
+    pricing = get_pricing(provider, model_name)
+    if pricing is None:
+        return None
+    cached_input_tokens = min(cached_input_tokens or 0, input_tokens)
+    ratio = CACHED_INPUT_PRICE_RATIO.get(provider, 1.0)
+    input_cost = (input_tokens - cached_input_tokens + cached_input_tokens * ratio) * pricing[0]
+    return (input_cost + output_tokens * pricing[1]) / 1_000_000
+
+
+class UsageTracker:
+    """
+    実行中のトークン使用量と料金を集計する（ワーカースレッドから共有される）
+
+    Parameters:
+    - budget_usd: 料金の上限（USD）。超えた後の呼び出しは BudgetExceededError になる
+
+    同時実行中の呼び出しで上限を大きく超えないよう、呼び出し前に reserve で見込み料金（最大出力トークン数で計算）を
+    予約し、使用額と予約額の合計が上限に達した後の呼び出しは開始しない。料金が不明なモデルでは見込み料金も
+    使用額も0となるため、上限は機能しない（ExcelAnalyzer は作成時・モデル変更時に警告を表示する）。
+    """
+
+    def __init__(self, budget_usd: Optional[float] = None):
+        self.budget_usd = budget_usd
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """集計値を初期化する"""
+        with self._lock:
+            self.requests = 0
+            self.input_tokens = 0
+            self.output_tokens = 0
+            self.cached_input_tokens = 0
+            self.cost_usd = 0.0
+            self.latency_sec = 0.0
+            # 実行中の呼び出しの見込み料金の合計
+            self.reserved_usd = 0.0
+            # 予約が上限に達したため呼び出しを開始しなかったか
+            self.reservation_refused = False
+
+    def record(self, input_tokens: int, output_tokens: int, cost_usd: Optional[float], latency_sec: float = 0.0,
+               cached_input_tokens: int = 0):
+        """1回の呼び出しの使用量を加算する（cached_input_tokens は input_tokens のうちキャッシュから読み込まれた分）"""
+        with self._lock:
+            self.requests += 1
+            self.input_tokens += int(input_tokens or 0)
+            self.output_tokens += int(output_tokens or 0)
+            self.cached_input_tokens += int(cached_input_tokens or 0)
+            self.cost_usd += cost_usd or 0.0
+            self.latency_sec += latency_sec
+
+    def budget_exceeded(self) -> bool:
+        """予算上限に達している（または予約が上限に達したため呼び出しを中止した）かを返す"""
+        return self.budget_usd is not None and (self.cost_usd >= self.budget_usd or self.reservation_refused)
+
+    def check_budget(self):
+        """予算上限に達している場合は BudgetExceededError を送出する"""
+        if self.budget_exceeded():
+            raise BudgetExceededError(
+                f"予算上限（${self.budget_usd:.4f}）に達しました（使用額: ${self.cost_usd:.4f}）"
+            )
+
+    def reserve(self, cost_usd: Optional[float]) -> float:
+        """
+        予算上限を確認したうえで、これから行う呼び出しの見込み料金を予約する
+
+        使用額と実行中の呼び出しの予約額の合計が上限に達している場合は BudgetExceededError を送出する。
+        戻り値の予約額は、呼び出しの終了後（使用量の記録後）に release に渡すこと。
+        """
+        with self._lock:
+            if self.budget_usd is not None and self.cost_usd + self.reserved_usd >= self.budget_usd:
+                self.reservation_refused = True
+                raise BudgetExceededError(
+                    f"予算上限（${self.budget_usd:.4f}）に達しました"
+                    f"（使用額: ${self.cost_usd:.4f}、実行中の呼び出しの見込み額: ${self.reserved_usd:.4f}）"
+                )
+            amount = cost_usd or 0.0
+            self.reserved_usd += amount
+            return amount
+
+    def release(self, amount: float):
+        """reserve で予約した見込み料金を解放する"""
+        with self._lock:
+            self.reserved_usd = max(0.0, self.reserved_usd - amount)
+
+    def average_latency(self) -> Optional[float]:
+        """実測した1リクエストあたりの平均応答時間（秒）。未計測の場合はNone"""
+        with self._lock:
+            return self.latency_sec / self.requests if self.requests else None
+
+    def summary(self) -> dict:
+        """集計値を辞書で返す"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cached_input_tokens": self.cached_input_tokens,
+                "cost_usd": round(self.cost_usd, 6),
+                "budget_usd": self.budget_usd
+            }
@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import random
 from datetime import datetime, timedelta
@@ -132,8 +133,25 @@ class MedicalDataGenerator:
 
         return pd.DataFrame(records)
 
+    def save(self, filename="sample_data.parquet", num_patients=50):
+        """生成したデータを拡張子に応じた形式（.parquet / .feather / .csv / .xlsx）で保存"""
+        df = self.generate_patient_records(num_patients)
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in (".parquet", ".pq"):
+            df.to_parquet(filename, index=False)
+        elif extension in (".feather", ".arrow", ".ipc"):
+            df.to_feather(filename)
+        elif extension == ".csv":
+            df.to_csv(filename, index=False)
+        else:
+            df.to_excel(filename, index=False)
+        print(f"{len(df)}件のダミーデータを{filename}に保存しました")
+        return df
+
+    def save_to_parquet(self, filename="sample_data.parquet", num_patients=50):
+        """生成したデータをParquetファイルに保存"""
+        return self.save(filename, num_patients)
+
     def save_to_excel(self, filename="sample_data.xlsx", num_patients=50):
         """生成したデータをExcelファイルに保存"""
-        df = self.generate_patient_records(num_patients)
-        df.to_excel(filename, index=False)
-        print(f"{len(df)}件のダミーデータを{filename}に保存しました") 
\ No newline at end of file
+        return self.save(filename, num_patients) 
\ No newline at end of file
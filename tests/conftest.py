@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+テスト共通の設定とフィクスチャ
+
+LLMの呼び出しは応答を入力テキストから決まる値で返す偽のクライアントに置き換え、
+ネットワークやAPIキーなしで分析の経路を実行する。
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+from analyzer import ExcelAnalyzer  # noqa: E402
+
+TEMPLATE_PATH = os.path.join(ROOT_DIR, 'templates', 'prompt_templates.json')
+
+
+class FakeCompletions:
+    """
+    OpenAI互換の chat.completions.create を模した呼び出し（呼び出し回数・入力・同時実行数を記録する）
+
+    - fail_on: この文字列を含む入力では例外を送出する（再試行されない接続エラーとして扱われる）
+    - delay: 応答までの秒数（並列実行の確認用）
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.fail_on = set()
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create(self, model, messages, **kwargs):
+        text = messages[-1]["content"]
+        with self._lock:
+            self.calls.append(text)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if any(marker in text for marker in self.fail_on):
+                raise ConnectionError("接続できませんでした")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        # 結果は入力テキストの末尾の記載から決める（同じ入力には常に同じ応答を返す）
+        outcome = {"result": text.strip().splitlines()[-1], "reason": "テスト"}
+        # 複数テンプレートをまとめた呼び出し（guided_json のスキーマがテンプレートキーごとの項目を持つ）
+        schema = kwargs.get("extra_body", {}).get("guided_json") or {}
+        keys = [key for key in schema.get("properties", {}) if key not in outcome]
+        content = json.dumps({key: outcome for key in keys} if keys else outcome, ensure_ascii=False)
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class FakeClient:
+    """LLMクライアントの代わりに使う偽のクライアント"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=FakeCompletions())
+        self.models = SimpleNamespace(list=lambda: SimpleNamespace(data=[SimpleNamespace(id="fake-model")]))
+
+    @property
+    def calls(self):
+        return self.chat.completions.calls
+
+
+class FakeAsyncClient:
+    """偽のクライアントの応答を非同期で返す非同期クライアント（close の呼び出しを記録する）"""
+
+    def __init__(self, completions: FakeCompletions):
+        self.closed = False
+
+        async def create(**kwargs):
+            await asyncio.sleep(0)
+            return completions.create(**kwargs)
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+    async def close(self):
+        self.closed = True
+
+
+def make_records(num_patients: int, days=(1, 2, 3)) -> pd.DataFrame:
+    """患者ごとに複数日の記載を持つ、行の順序を並べ替えたデータを作成する"""
+    rows = [{"ID": f"P{i:03d}", "day": f"2023-01-{day:02d}", "text": f"記載{i}-{day}"}
+            for i in range(num_patients) for day in days]
+    return pd.DataFrame(rows).sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient()
+
+
+@pytest.fixture
+def make_analyzer(fake_client):
+    """偽のクライアントを設定した ExcelAnalyzer を作成する関数を返す"""
+
+    def factory(df: pd.DataFrame = None, **kwargs) -> ExcelAnalyzer:
+        analyzer = ExcelAnalyzer(template_path=TEMPLATE_PATH, **kwargs)
+        analyzer.client = fake_client
+        # 非同期の経路でも同じ偽のクライアントに送る
+        analyzer.backend.create_async_client = lambda: FakeAsyncClient(fake_client.chat.completions)
+        if df is not None:
+            analyzer.df = df.copy()
+        return analyzer
+
+    return factory
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""プロバイダーのバックエンド（レジストリとリクエストの組み立て）のテスト"""
+import json
+
+import pytest
+
+from analyzer import ExcelAnalyzer
+from analyzer.backends import (
+    BACKENDS, ClaudeBackend, CompletionResult, DeepseekBackend, GeminiBackend, OpenAIBackend, ProviderBackend, VLLMBackend,
+    create_backend, get_backend_class, register_backend
+)
+from analyzer.structured_output import DEFAULT_RESULT_SCHEMA, RESULT_TOOL_NAME
+from conftest import TEMPLATE_PATH, make_records
+
+SYSTEM_PROMPT = "がんのステージを抽出してください。"
+
+
+@pytest.fixture
+def echo_backend():
+    """入力テキストの末尾の記載を結果として返すバックエンドを登録する"""
+
+    @register_backend("echo")
+    class EchoBackend(ProviderBackend):
+        default_model = "echo-model"
+
+        def complete(self, model, system_prompt, text, max_tokens, schema=None):
+            outcome = {"result": text.strip().splitlines()[-1], "reason": model}
+            return CompletionResult(json.dumps(outcome, ensure_ascii=False), 10, 5)
+
+    yield EchoBackend
+    BACKENDS.pop("echo", None)
+
+
+def test_registered_backend_is_used_by_provider_name(echo_backend):
+    assert get_backend_class("echo") is echo_backend
+    analyzer = ExcelAnalyzer(template_path=TEMPLATE_PATH, provider="echo")
+    assert isinstance(analyzer.backend, echo_backend)
+    assert analyzer.model_name == "echo-model"
+
+    analyzer.df = make_records(3)
+    assert analyzer.analyze_with_template("cancer_stage")["success"]
+    results = analyzer.get_results_df().set_index("ID")
+    assert results.at["P001", "分析結果_cancer_stage_extract"] == "記載1-3"
+    assert results["分析結果_cancer_stage_extract_理由"].eq("echo-model").all()
+    assert analyzer.usage.input_tokens == 30
+
+
+def test_unknown_provider_is_rejected():
+    with pytest.raises(ValueError, match="未対応のプロバイダー"):
+        get_backend_class("unknown")
+    with pytest.raises(ValueError, match="未対応のプロバイダー"):
+        ExcelAnalyzer(provider="unknown")
+
+
+def test_api_key_is_required_by_hosted_backends():
+    with pytest.raises(ValueError):
+        create_backend("openai")
+    assert isinstance(create_backend("openai", api_key="x"), OpenAIBackend)
+
+
+def test_capabilities():
+    assert VLLMBackend.capabilities()["async"]
+    assert OpenAIBackend.capabilities()["batch_api"]
+    assert not DeepseekBackend.capabilities()["batch_api"]
+    assert BACKENDS["vllm_offline"].capabilities() == {
+        "async": False, "batch_api": False, "native_batch": True, "max_concurrency": 1
+    }
+
+
+def test_openai_compatible_structured_options():
+    openai = OpenAIBackend(api_key="x", temperature=0.3).build_request("gpt-4o-mini", SYSTEM_PROMPT, "記載", 100, DEFAULT_RESULT_SCHEMA)
+    assert openai["temperature"] == 0.3
+    assert openai["max_tokens"] == 100
+    assert openai["response_format"]["json_schema"]["schema"] == DEFAULT_RESULT_SCHEMA
+    assert openai["response_format"]["json_schema"]["strict"]
+
+    deepseek = DeepseekBackend(api_key="x").build_request("deepseek-chat", SYSTEM_PROMPT, "記載", 100, DEFAULT_RESULT_SCHEMA)
+    assert deepseek["response_format"] == {"type": "json_object"}
+
+    vllm = VLLMBackend(base_url="http://localhost:8000/v1").build_request("model", SYSTEM_PROMPT, "記載", 100, DEFAULT_RESULT_SCHEMA)
+    assert vllm["extra_body"] == {"guided_json": DEFAULT_RESULT_SCHEMA}
+    assert "response_format" not in vllm
+
+
+@pytest.mark.parametrize("cached_content", ["", "cachedContents/1"])
+def test_gemini_passes_generation_parameters(cached_content):
+    backend = GeminiBackend(api_key="x", temperature=0.3)
+    request = backend.build_request("gemini-2.0-flash", SYSTEM_PROMPT, "記載", 256, DEFAULT_RESULT_SCHEMA, cached_content)
+    config = request["config"]
+    assert config.max_output_tokens == 256
+    assert config.temperature == 0.3
+    assert config.response_mime_type == "application/json"
+    assert "additionalProperties" not in config.response_schema
+
+
+def test_claude_forces_result_tool_for_schema():
+    request = ClaudeBackend(api_key="x", temperature=0.3).build_request(
+        "claude-3-5-haiku-latest", SYSTEM_PROMPT, "記載", 256, DEFAULT_RESULT_SCHEMA
+    )
+    assert request["max_tokens"] == 256
+    assert request["temperature"] == 0.3
+    assert request["tools"][0]["input_schema"] == DEFAULT_RESULT_SCHEMA
+    assert request["tool_choice"] == {"type": "tool", "name": RESULT_TOOL_NAME}
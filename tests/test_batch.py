@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""バッチ推論（投入・結果の取り込み・別プロセスからの取り込み）のテスト"""
+import json
+
+from analyzer.batch import BATCH_COMPLETED, LocalBatchBackend
+from conftest import make_records
+
+TEMPLATE_KEYS = ["cancer_stage", "cancer_diagnosis"]
+
+
+def column(template_key: str, analyzer) -> str:
+    return analyzer._get_column_name(template_key)
+
+
+def test_run_batch_stores_results_for_each_template(tmp_path, make_analyzer, fake_client):
+    analyzer = make_analyzer(make_records(5))
+    summary = analyzer.run_batch(TEMPLATE_KEYS, work_dir=str(tmp_path), poll_interval=0)
+
+    assert all(result["success"] for result in summary.values())
+    # バッチAPIのないプロバイダーでは通常の呼び出しで1件ずつ処理する
+    assert len(fake_client.calls) == 5 * len(TEMPLATE_KEYS)
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")
+    for key in TEMPLATE_KEYS:
+        assert results.at["P003", column(key, analyzer)] == "記載3-3"
+        assert results[f"{column(key, analyzer)}_理由"].eq("テスト").all()
+
+
+def test_batch_is_collected_by_another_instance(tmp_path, make_analyzer):
+    work_dir = str(tmp_path)
+    df = make_records(4)
+    submitter = make_analyzer(df)
+    batch_id = submitter.submit_batch(TEMPLATE_KEYS, work_dir=work_dir)
+    assert batch_id is not None
+    with open(tmp_path / f"{batch_id}.manifest.json", encoding="utf-8") as f:
+        manifest = json.load(f)
+    assert manifest["template_keys"] == TEMPLATE_KEYS
+    assert len(manifest["requests"]) == 8
+
+    # 投入したプロセスとは別のインスタンスから、作業ディレクトリのバッチを参照して取り込む
+    collector = make_analyzer(df)
+    backend = collector.create_batch_backend(work_dir)
+    assert backend.poll(batch_id) == BATCH_COMPLETED
+    summary = collector.collect_batch(batch_id, backend, work_dir)
+    assert all(result["success"] for result in summary.values())
+    assert collector.df[column("cancer_stage", collector)].notna().all()
+
+
+def test_missing_batch_responses_are_marked_for_retry(tmp_path, make_analyzer):
+    def responder(request):
+        if "記載2-" in request["text"]:
+            raise RuntimeError("リクエストが失敗しました")
+        return json.dumps({"result": "T1", "reason": "ローカル"}, ensure_ascii=False)
+
+    analyzer = make_analyzer(make_records(3))
+    backend = LocalBatchBackend(responder=responder)
+    assert all(result["success"] for result in analyzer.run_batch(["cancer_stage"], backend, str(tmp_path), poll_interval=0).values())
+
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")
+    col = column("cancer_stage", analyzer)
+    assert results.at["P002", col] == "N/A"
+    assert results.at["P002", f"{col}_理由"] == "バッチでの応答が得られませんでした"
+    assert results.at["P001", col] == "T1"
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""CheckpointJournal と中断した実行の再開のテスト"""
+import json
+
+import numpy as np
+import pytest
+
+from analyzer.checkpoint import CheckpointJournal
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def test_load_filters_by_run_and_template(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal" / "checkpoint.jsonl"))
+    journal.record("run-1", TEMPLATE_KEY, np.int64(1), "T1", "理由1")
+    journal.record("run-1", "cancer_diagnosis", 1, "肺がん", "理由2")
+    journal.record("run-2", TEMPLATE_KEY, 2, "T2", "理由3")
+
+    assert journal.completed("run-1", TEMPLATE_KEY) == {"1": ("T1", "理由1")}
+    assert set(journal.load("run-1")) == {TEMPLATE_KEY, "cancer_diagnosis"}
+    assert journal.completed("run-3", TEMPLATE_KEY) == {}
+
+
+def test_last_record_wins_and_truncated_line_is_ignored(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    journal = CheckpointJournal(str(path))
+    journal.record("run-1", TEMPLATE_KEY, "P1", "T1", "初回")
+    journal.record("run-1", TEMPLATE_KEY, "P1", "T2", "再分析")
+    # 書き込み途中で終了した最終行
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"run_id": "run-1", "template_key": TEMPLATE_KEY})[:20])
+
+    assert journal.completed("run-1", TEMPLATE_KEY) == {"P1": ("T2", "再分析")}
+
+
+def test_record_after_truncated_line_is_not_lost(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    CheckpointJournal(str(path)).record("run-1", TEMPLATE_KEY, "P1", "T1", "初回")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"run_id": "run-1", "templ')
+
+    # 再開後のプロセスでの最初の記録は、壊れた行と連結されずに読み込める
+    resumed = CheckpointJournal(str(path))
+    resumed.record("run-1", TEMPLATE_KEY, "P2", "T2", "再開後")
+    resumed.record("run-1", TEMPLATE_KEY, "P3", "T3", "再開後")
+    assert resumed.completed("run-1", TEMPLATE_KEY) == {
+        "P1": ("T1", "初回"), "P2": ("T2", "再開後"), "P3": ("T3", "再開後")
+    }
+    assert path.read_text(encoding="utf-8").count("\n") == 4
+
+
+def test_missing_journal_is_empty(tmp_path):
+    assert CheckpointJournal(str(tmp_path / "none.jsonl")).load("run-1") == {}
+
+
+def test_resume_skips_recorded_patients(tmp_path, make_analyzer, fake_client):
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    df = make_records(6)
+    patients = sorted(df["ID"].unique())
+    recorded = patients[:4]
+
+    # 中断前の実行で4人分が記録済みの状態を作る
+    journal = CheckpointJournal(checkpoint_path)
+    for id_val in recorded:
+        journal.record("run-1", TEMPLATE_KEY, id_val, f"記録済み-{id_val}", "チェックポイント")
+
+    analyzer = make_analyzer(df, checkpoint_path=checkpoint_path)
+    summary = analyzer.resume_run("run-1", [TEMPLATE_KEY])
+
+    assert summary[TEMPLATE_KEY]["success"]
+    # 記録済みの患者はLLMを呼び出さない
+    assert len(fake_client.calls) == len(patients) - len(recorded)
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")[COLUMN]
+    for id_val in recorded:
+        assert results[id_val] == f"記録済み-{id_val}"
+    for id_val in patients[4:]:
+        assert results[id_val] == f"記載{int(id_val[1:])}-3"
+
+    # 再開後は全患者が記録され、もう一度再開してもLLMを呼び出さない
+    assert set(journal.completed("run-1", TEMPLATE_KEY)) == set(patients)
+    fake_client.calls.clear()
+    rerun = make_analyzer(df, checkpoint_path=checkpoint_path)
+    rerun.resume_run("run-1", [TEMPLATE_KEY])
+    assert fake_client.calls == []
+    assert rerun.df[COLUMN].tolist() == analyzer.df[COLUMN].tolist()
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_failed_patient_is_retried_on_resume(tmp_path, make_analyzer, fake_client, fused):
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    df = make_records(4)
+    fake_client.chat.completions.fail_on.add("記載2-")
+
+    analyzer = make_analyzer(df, checkpoint_path=checkpoint_path, max_retries=0)
+    run_id = analyzer.start_run()
+    if fused:
+        analyzer.analyze_with_templates([TEMPLATE_KEY, "cancer_diagnosis"])
+    else:
+        analyzer.analyze_with_template(TEMPLATE_KEY)
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")
+    assert results.at["P002", f"{COLUMN}_理由"] == "エラーが発生しました"
+    # 一時的な失敗はチェックポイントに完了として記録しない
+    assert "P002" not in analyzer.checkpoint.completed(run_id, TEMPLATE_KEY)
+    assert len(analyzer.checkpoint.completed(run_id, TEMPLATE_KEY)) == 3
+
+    # 障害が解消した後に再開すると、失敗した患者のみを再分析する
+    fake_client.chat.completions.fail_on.clear()
+    fake_client.calls.clear()
+    resumed = make_analyzer(df, checkpoint_path=checkpoint_path)
+    templates = [TEMPLATE_KEY, "cancer_diagnosis"] if fused else [TEMPLATE_KEY]
+    summary = resumed.resume_run(run_id, templates, fused=fused)
+    assert all(result["success"] for result in summary.values())
+    assert len(fake_client.calls) == 1 and "記載2-" in fake_client.calls[0]
+    results = resumed.df.drop_duplicates("ID").set_index("ID")
+    assert results.at["P002", COLUMN] == "記載2-3"
+    assert set(resumed.checkpoint.completed(run_id, TEMPLATE_KEY)) == {"P000", "P001", "P002", "P003"}
+
+
+def test_failures_recorded_by_older_versions_are_retried(tmp_path, make_analyzer, fake_client):
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    journal = CheckpointJournal(checkpoint_path)
+    journal.record("run-1", TEMPLATE_KEY, "P000", "記録済み", "チェックポイント")
+    journal.record("run-1", TEMPLATE_KEY, "P001", "N/A", "エラーが発生しました")
+
+    analyzer = make_analyzer(make_records(2), checkpoint_path=checkpoint_path)
+    analyzer.resume_run("run-1", [TEMPLATE_KEY])
+    assert len(fake_client.calls) == 1 and "記載1-" in fake_client.calls[0]
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")[COLUMN]
+    assert results["P000"] == "記録済み"
+    assert results["P001"] == "記載1-3"
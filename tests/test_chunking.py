@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""chunk_text・reduce_chunk_results と統合方法の決定のテスト"""
+import json
+
+import pandas as pd
+import pytest
+
+from analyzer.chunking import MERGE_STRATEGIES, chunk_text, infer_merge_strategy, reduce_chunk_results, split_dated_entries
+from conftest import TEMPLATE_PATH
+
+
+def count_chars(text: str) -> int:
+    """1文字を1トークンとして数える（境界の計算を確認しやすくするため）"""
+    return len(text)
+
+
+def combined_text(entries):
+    return "\n\n".join(f"[2023-01-{day:02d}]\n{body}" for day, body in entries)
+
+
+class TestChunkText:
+    def test_short_text_is_single_chunk(self):
+        text = combined_text([(1, "所見A"), (2, "所見B")])
+        assert chunk_text(text, 1000, count_chars) == [text]
+
+    def test_splits_only_on_date_boundaries(self):
+        entries = [(day, "あ" * 20) for day in range(1, 11)]
+        text = combined_text(entries)
+        chunks = chunk_text(text, 70, count_chars)
+
+        assert len(chunks) > 1
+        assert all(count_chars(chunk) <= 70 for chunk in chunks)
+        # 各チャンクは日付見出しで始まり、つなげ直すと元のテキストになる
+        assert all(chunk.startswith("[2023-01-") for chunk in chunks)
+        assert "\n\n".join(chunks) == text
+        assert sum(len(split_dated_entries(chunk)) for chunk in chunks) == len(entries)
+
+    def test_long_entry_is_split_with_date_header(self):
+        text = combined_text([(1, "短い"), (2, "い" * 200), (3, "短い")])
+        chunks = chunk_text(text, 50, count_chars)
+
+        assert all(count_chars(chunk) <= 50 for chunk in chunks)
+        long_pieces = [chunk for chunk in chunks if chunk.startswith("[2023-01-02]")]
+        assert len(long_pieces) > 1
+        assert "".join(piece.partition("\n")[2] for piece in long_pieces) == "い" * 200
+        assert chunks[0] == "[2023-01-01]\n短い"
+        assert chunks[-1] == "[2023-01-03]\n短い"
+
+    def test_default_counter(self):
+        text = combined_text([(day, "経過観察中。" * 100) for day in range(1, 31)])
+        chunks = chunk_text(text, 1000)
+        assert len(chunks) > 1
+        assert "\n\n".join(chunks) == text
+
+
+class TestReduceChunkResults:
+    outcomes = [("記載なし", "該当なし"), ("T1N0M0", "初回"), ("", "空"), ("T2N1M0", "再評価")]
+
+    def test_latest(self):
+        assert reduce_chunk_results(self.outcomes, "latest", "") == ("T2N1M0", "再評価")
+
+    def test_first(self):
+        assert reduce_chunk_results(self.outcomes, "first", "") == ("T1N0M0", "初回")
+
+    def test_all_joins_unique_results(self):
+        outcomes = self.outcomes + [("T1N0M0", "初回")]
+        assert reduce_chunk_results(outcomes, "all", "") == ("T1N0M0 / T2N1M0", "初回 / 再評価")
+
+    def test_all_with_single_result_keeps_original_type(self):
+        outcomes = [({"stage": 2}, "a"), (None, "b"), ({"stage": 2}, "c")]
+        assert reduce_chunk_results(outcomes, "all", None) == ({"stage": 2}, "a / c")
+
+    def test_binary_is_true_if_any_chunk_matches(self):
+        outcomes = [(False, "なし"), (True, "あり"), (False, "なし")]
+        assert reduce_chunk_results(outcomes, "first", False) == (True, "あり")
+
+    def test_nothing_found_returns_last_outcome(self):
+        outcomes = [("N/A", "一つ目"), ("記載なし", "二つ目")]
+        assert reduce_chunk_results(outcomes, "latest", "") == ("記載なし", "二つ目")
+
+    def test_no_outcomes(self):
+        assert reduce_chunk_results([], "latest", "") == ("", "理由なし")
+
+    @pytest.mark.parametrize("prompt, template, expected", [
+        ("最初の治療を抽出してください", None, "first"),
+        ("初回治療を抽出してください", None, "first"),
+        ("最新のステージを抽出してください", None, "latest"),
+        ("特記事項を抽出してください", None, "all"),
+        ("最新のステージを抽出してください", {"merge": "all"}, "all"),
+    ])
+    def test_infer_merge_strategy(self, prompt, template, expected):
+        assert infer_merge_strategy(prompt, template) == expected
+
+
+def test_templates_declare_merge_strategy():
+    with open(TEMPLATE_PATH, encoding="utf-8") as f:
+        templates = json.load(f)
+    for key, template in templates.items():
+        assert template.get("merge") in MERGE_STRATEGIES, key
+
+
+def test_explicit_merge_ignores_prompt_wording(capsys):
+    template = {"name": "ステージ", "merge": "latest"}
+    # プロンプトの言い回しを変えても統合方法は変わらず、警告も表示しない
+    assert infer_merge_strategy("最初に記載されたステージを抽出", template) == "latest"
+    assert capsys.readouterr().out == ""
+
+
+def test_inferred_merge_warns_once_per_template(capsys):
+    template = {"name": "統合方法の指定がないテンプレート"}
+    for _ in range(3):
+        assert infer_merge_strategy("初回の治療を抽出", template) == "first"
+    output = capsys.readouterr().out
+    assert output.count("警告") == 1
+    assert "統合方法の指定がないテンプレート" in output
+
+    assert infer_merge_strategy("最新の治療を抽出", {"name": "不正な指定", "merge": "newest"}) == "latest"
+    assert "'newest'" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("merge, expected", [("latest", "記載0-30"), ("first", None)])
+def test_long_text_is_chunked_and_merged_by_template(make_analyzer, fake_client, merge, expected):
+    rows = [{"ID": "P000", "day": f"2023-01-{day:02d}", "text": f"経過観察。{'所見' * 40}\n記載0-{day}"} for day in range(1, 31)]
+    analyzer = make_analyzer(pd.DataFrame(rows), max_input_tokens=300)
+    analyzer.templates["cancer_stage"]["merge"] = merge
+
+    assert analyzer.analyze_with_template("cancer_stage")["success"]
+    assert len(fake_client.calls) > 1
+    # 偽のクライアントは各チャンクの最後の記載を結果として返す
+    first_chunk_result = fake_client.calls[0].strip().splitlines()[-1]
+    assert analyzer.df["分析結果_cancer_stage_extract"].iloc[0] == (expected or first_chunk_result)
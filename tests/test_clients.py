@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""プロセス内で共有するクライアントと、非同期クライアントのイベントループごとの作成・終了のテスト"""
+import asyncio
+
+from analyzer import clients
+from conftest import FakeAsyncClient, make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def test_sync_clients_are_shared_per_key():
+    created = []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+
+    key = ("test", "key", "http://shared")
+    try:
+        assert clients.get_client(key, factory) is clients.get_client(key, factory)
+        assert len(created) == 1
+    finally:
+        clients._clients.pop(key, None)
+
+
+def test_async_clients_are_closed_when_each_run_ends(make_analyzer, fake_client):
+    created = []
+
+    def create_async_client():
+        created.append(FakeAsyncClient(fake_client.chat.completions))
+        return created[-1]
+
+    analyzer = make_analyzer(make_records(6), max_workers=3, use_async=True)
+    analyzer.backend.create_async_client = create_async_client
+
+    for _ in range(2):
+        assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+
+    # 実行（イベントループ）ごとに1つ作成し、ループの終了前に閉じて登録から外す
+    assert len(created) == 2
+    assert all(client.closed for client in created)
+    assert not clients._async_clients
+    assert len(fake_client.calls) == 12
+    assert analyzer.df[COLUMN].tolist() == [f"記載{int(id_val[1:])}-3" for id_val in analyzer.df["ID"]]
+
+
+def test_clients_owned_elsewhere_are_not_closed():
+    owned, borrowed = FakeAsyncClient(None), FakeAsyncClient(None)
+
+    async def run():
+        clients.get_async_client(("test", "owned"), lambda: owned)
+        clients.get_async_client(("test", "borrowed"), lambda: borrowed, owned=False)
+        await clients.aclose_async_clients()
+
+    asyncio.run(run())
+    assert owned.closed
+    assert not borrowed.closed
+    assert not clients._async_clients
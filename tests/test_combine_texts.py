@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""_combine_texts_by_id（IDごとのテキスト結合）のテスト"""
+import numpy as np
+import pandas as pd
+import pytest
+
+COLUMN_MAPPING = {"id_column": "ID", "date_column": "day", "text_column": "text"}
+
+
+def legacy_combine_texts_by_id(df: pd.DataFrame, column_mapping: dict) -> dict:
+    """最適化前の実装（IDごとのブールマスクと iterrows）"""
+    df[column_mapping['date_column']] = pd.to_datetime(df[column_mapping['date_column']])
+    combined_texts = {}
+    for id_val in df[column_mapping['id_column']].unique():
+        group = df[df[column_mapping['id_column']] == id_val].sort_values(column_mapping['date_column'])
+        texts = [f"[{row[column_mapping['date_column']].strftime('%Y-%m-%d')}]\n{row[column_mapping['text_column']]}"
+                 for _, row in group.iterrows()]
+        combined_texts[id_val] = "\n\n".join(texts)
+    return combined_texts
+
+
+def random_records(seed: int, num_rows: int, id_values) -> pd.DataFrame:
+    """IDと日付の順序がばらばらなデータ（同じ患者の日付は重複しない）"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for id_val in id_values:
+        days = rng.choice(365, size=rng.integers(1, 8), replace=False)
+        rows.extend({"ID": id_val, "day": (pd.Timestamp("2023-01-01") + pd.Timedelta(days=int(day))).strftime("%Y-%m-%d"),
+                     "text": f"記載 {id_val} {int(day)}"} for day in days)
+    return pd.DataFrame(rows).sample(n=len(rows), random_state=seed).head(num_rows).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("id_values", [
+    [f"P{i}" for i in range(50)],
+    list(range(50, 0, -1)),
+    [3, "3", 7, "A"],
+])
+def test_combine_texts_matches_legacy(make_analyzer, id_values):
+    df = random_records(0, 1000, id_values)
+    analyzer = make_analyzer(df)
+
+    combined = analyzer._combine_texts_by_id()
+    expected = legacy_combine_texts_by_id(df.copy(), COLUMN_MAPPING)
+    # 値だけでなく、IDの順序（初出順）も従来と同じ
+    assert list(combined.items()) == list(expected.items())
+
+
+def test_combine_texts_with_missing_ids_matches_legacy(make_analyzer):
+    df = random_records(1, 1000, ["A", "B", "C"])
+    df.loc[[0, 5], "ID"] = None
+    analyzer = make_analyzer(df)
+
+    combined = analyzer._combine_texts_by_id()
+    expected = legacy_combine_texts_by_id(df.copy(), COLUMN_MAPPING)
+    # 欠損IDは従来どおり空文字列として出現順に含まれる
+    assert list(combined.items()) == list(expected.items())
+    assert [text for id_val, text in combined.items() if pd.isna(id_val)] == [""]
+
+
+def test_combine_texts_accepts_parsed_dates(make_analyzer):
+    df = random_records(2, 200, ["A", "B"])
+    expected = legacy_combine_texts_by_id(df.copy(), COLUMN_MAPPING)
+    df["day"] = pd.to_datetime(df["day"])
+    assert make_analyzer(df)._combine_texts_by_id() == expected
+
+
+def test_combined_texts_are_memoized_until_data_changes(make_analyzer):
+    analyzer = make_analyzer(random_records(3, 100, ["A", "B"]))
+    first = analyzer._combine_texts_by_id()
+    assert analyzer._combine_texts_by_id() is first
+    assert analyzer.get_combined_texts() == first
+
+    # 同じ列マッピングの再設定では作り直さず、データを差し替えると作り直す
+    analyzer.set_column_mapping("ID", "day", "text")
+    assert analyzer._combine_texts_by_id() is first
+    analyzer.df = analyzer.df.head(1)
+    assert analyzer._combine_texts_by_id() is not first
+
+
+def test_set_data_reuses_prepared_texts(make_analyzer):
+    df = random_records(4, 100, ["A", "B", "C"])
+    source = make_analyzer(df)
+    texts = dict(source.combined_texts)
+
+    # 再実行ごとに作成されるインスタンスに、作成済みの結合テキストを渡すと結合を省略する
+    analyzer = make_analyzer()
+    analyzer.set_data(source.df.copy(), texts)
+    assert analyzer._combined_texts_cache == texts
+    assert analyzer._combined_texts_cache is not texts
+    assert analyzer.get_results_df().empty  # 分析結果の列がない場合
+    analyzer.set_data(df.copy())
+    assert analyzer._combined_texts_cache is None
+    assert dict(analyzer.combined_texts) == texts
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""analyze_with_llm の患者ごとの並列実行のテスト"""
+import threading
+
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def expected_results(df):
+    """偽のクライアントは各患者の最後の記載をそのまま結果として返す"""
+    return {id_val: f"記載{int(id_val[1:])}-3" for id_val in df["ID"].unique()}
+
+
+def test_parallel_results_follow_id_order(make_analyzer, fake_client):
+    df = make_records(24)
+    fake_client.chat.completions.delay = 0.02
+    analyzer = make_analyzer(df, max_workers=8)
+
+    progress = []
+    callback_threads = set()
+
+    def on_progress(done, total, payload):
+        progress.append((done, total, payload["ID"]))
+        callback_threads.add(threading.get_ident())
+
+    assert analyzer.analyze_with_template(TEMPLATE_KEY, progress_callback=on_progress)["success"]
+
+    # 実際に並列に呼び出され、各患者は1回ずつ呼び出される
+    assert fake_client.chat.completions.max_in_flight > 1
+    assert len(fake_client.calls) == 24
+    # 完了順によらず、結果は各行のIDに対応する
+    expected = expected_results(df)
+    assert analyzer.df[COLUMN].tolist() == [expected[id_val] for id_val in analyzer.df["ID"]]
+    # 進捗は患者ごとに1回、呼び出し元のスレッドで通知される
+    assert [done for done, _, _ in progress] == list(range(1, 25))
+    assert {id_val for _, _, id_val in progress} == set(expected)
+    assert callback_threads == {threading.get_ident()}
+
+
+def test_parallel_matches_sequential(make_analyzer):
+    df = make_records(10)
+    sequential = make_analyzer(df, max_workers=1)
+    parallel = make_analyzer(df, max_workers=4)
+    assert sequential.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert parallel.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert parallel.df[COLUMN].tolist() == sequential.df[COLUMN].tolist()
+    assert parallel.df[f"{COLUMN}_理由"].tolist() == sequential.df[f"{COLUMN}_理由"].tolist()
+
+
+def test_failed_patient_does_not_stop_others(make_analyzer, fake_client):
+    df = make_records(6)
+    fake_client.chat.completions.fail_on.add("記載2-")
+    analyzer = make_analyzer(df, max_workers=3, max_retries=0)
+
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")
+    assert results.at["P002", COLUMN] == "N/A"
+    assert results.at["P002", f"{COLUMN}_理由"] == "エラーが発生しました"
+    assert results.at["P003", COLUMN] == "記載3-3"
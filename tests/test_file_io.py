@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""入力ファイルの読み込みと分析結果の保存（Excel・CSV・Parquet・Feather）のテスト"""
+import pandas as pd
+import pytest
+
+from conftest import make_records
+
+
+@pytest.fixture
+def records():
+    df = make_records(7)
+    df["memo"] = "不要な列"
+    return df
+
+
+def write_input(df: pd.DataFrame, path: str):
+    if path.endswith(".xlsx"):
+        df.to_excel(path, index=False)
+    elif path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    elif path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+
+
+@pytest.mark.parametrize("extension", [".xlsx", ".csv"])
+def test_streaming_load_matches_full_load(tmp_path, make_analyzer, records, extension):
+    path = str(tmp_path / f"input{extension}")
+    write_input(records, path)
+
+    full = make_analyzer()
+    assert full.load_excel(path)
+    streamed = make_analyzer()
+    # 1チャンクの行数を小さくして、複数チャンクの結合を確認する
+    assert streamed.load_excel(path, mapped_columns_only=True, chunk_size=4)
+
+    assert list(streamed.df.columns) == ["ID", "day", "text"]
+    assert len(streamed.df) == len(records)
+    assert pd.api.types.is_datetime64_any_dtype(streamed.df["day"])
+    assert streamed.combined_texts == full.combined_texts
+
+
+@pytest.mark.parametrize("extension", [".xlsx", ".csv"])
+def test_streaming_load_reports_missing_columns(tmp_path, make_analyzer, records, extension, capsys):
+    path = str(tmp_path / f"input{extension}")
+    write_input(records.drop(columns="text"), path)
+
+    analyzer = make_analyzer()
+    assert not analyzer.load_excel(path, mapped_columns_only=True)
+    assert "text" in capsys.readouterr().out
+    assert analyzer.df is None
+
+
+def test_read_columns_reads_header_only(tmp_path, make_analyzer, records):
+    path = str(tmp_path / "input.xlsx")
+    write_input(records, path)
+    assert make_analyzer().read_columns(path) == ["ID", "day", "text", "memo"]
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".feather"])
+def test_columnar_input(tmp_path, make_analyzer, records, extension):
+    path = str(tmp_path / f"input{extension}")
+    write_input(records, path)
+    reference = str(tmp_path / "input.csv")
+    write_input(records, reference)
+
+    expected = make_analyzer()
+    assert expected.load_excel(reference)
+    for mapped_columns_only in (False, True):
+        analyzer = make_analyzer()
+        assert analyzer.load_excel(path, mapped_columns_only=mapped_columns_only, chunk_size=4)
+        assert analyzer.combined_texts == expected.combined_texts
+    assert analyzer.read_columns(path) == ["ID", "day", "text", "memo"]
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".feather", ".csv", ".xlsx"])
+def test_results_round_trip(tmp_path, make_analyzer, records, extension):
+    analyzer = make_analyzer(records)
+    assert analyzer.analyze_with_template("cancer_stage")["success"]
+    path = str(tmp_path / f"results{extension}")
+    assert analyzer.save_results(path)
+
+    saved = analyzer.read_results(path)
+    expected = analyzer.get_results_df()
+    assert saved["ID"].tolist() == expected["ID"].tolist()
+    assert saved["分析結果_cancer_stage_extract"].tolist() == expected["分析結果_cancer_stage_extract"].tolist()
+
+
+def test_default_output_follows_input_format(tmp_path, make_analyzer, records):
+    path = str(tmp_path / "cohort.parquet")
+    write_input(records, path)
+    analyzer = make_analyzer()
+    assert analyzer.load_excel(path, mapped_columns_only=True)
+    assert analyzer.analyze_with_template("cancer_stage")["success"]
+    assert analyzer.save_results()
+    assert (tmp_path / "cohort_analyzed.parquet").exists()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""複数テンプレートを患者ごとに1回の呼び出しでまとめて分析する analyze_with_templates のテスト"""
+import json
+from types import SimpleNamespace
+
+from conftest import make_records
+
+TEMPLATE_KEYS = ["cancer_stage", "cancer_diagnosis", "surgery_type"]
+
+
+def test_one_call_per_patient_matches_single_template_results(make_analyzer, fake_client):
+    df = make_records(5)
+    fused = make_analyzer(df)
+    summary = fused.analyze_with_templates(TEMPLATE_KEYS)
+
+    assert all(summary[key]["success"] for key in TEMPLATE_KEYS)
+    assert len(fake_client.calls) == 5
+
+    single = make_analyzer(df)
+    for key in TEMPLATE_KEYS:
+        assert single.analyze_with_template(key)["success"]
+        column = fused._get_column_name(key)
+        assert fused.df[column].tolist() == single.df[column].tolist()
+        assert fused.df[f"{column}_理由"].tolist() == single.df[f"{column}_理由"].tolist()
+
+
+def test_missing_templates_are_reanalyzed_individually(make_analyzer, fake_client):
+    create = fake_client.chat.completions.create
+
+    def drop_last_template(model, messages, **kwargs):
+        completion = create(model, messages, **kwargs)
+        content = json.loads(completion.choices[0].message.content)
+        # まとめた呼び出しの応答から最後のテンプレートの結果を欠落させる
+        content.pop(TEMPLATE_KEYS[-1], None)
+        completion.choices[0].message = SimpleNamespace(content=json.dumps(content, ensure_ascii=False))
+        return completion
+
+    fake_client.chat.completions.create = drop_last_template
+    analyzer = make_analyzer(make_records(3), max_retries=0)
+    summary = analyzer.analyze_with_templates(TEMPLATE_KEYS)
+
+    assert all(summary[key]["success"] for key in TEMPLATE_KEYS)
+    # 患者ごとに、まとめた呼び出し・スキーマに適合しない応答の修復・欠落したテンプレートの個別の呼び出しの3回
+    assert len(fake_client.calls) == 9
+    column = analyzer._get_column_name(TEMPLATE_KEYS[-1])
+    assert analyzer.df[column].notna().all()
+    assert analyzer.df[f"{column}_理由"].eq("テスト").all()
+
+
+def test_unknown_template_is_reported(make_analyzer, capsys):
+    analyzer = make_analyzer(make_records(2))
+    summary = analyzer.analyze_with_templates(["cancer_stage", "unknown"])
+    assert summary["cancer_stage"]["success"]
+    assert not summary["unknown"]["success"]
+    assert "unknown" in capsys.readouterr().out
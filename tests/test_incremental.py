@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""前回の分析結果を再利用する差分実行（指紋の計算・照合と結果の型の保存）のテスト"""
+import pandas as pd
+import pytest
+
+from analyzer import ExcelAnalyzer
+from analyzer.excel_analyzer import FINGERPRINT_SUFFIX
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def test_reuse_previous_matches_fingerprints(make_analyzer):
+    analyzer = make_analyzer(make_records(4))
+    fingerprints = ExcelAnalyzer._fingerprints("v1", {"P000": "a", "P001": "b", "P002": "c", "P003": "d"})
+    previous = pd.DataFrame({
+        "ID": ["P000", "P001", "P002", "P099"],
+        COLUMN: ["T1", "T2", "T3", "T9"],
+        f"{COLUMN}_理由": ["理由1", "理由2", "理由3", "理由9"],
+        f"{COLUMN}{FINGERPRINT_SUFFIX}": [fingerprints["P000"], fingerprints["P001"], "changed", "x"],
+    })
+    assert analyzer.set_previous_results(previous)
+
+    reused = analyzer._reuse_previous(COLUMN, fingerprints)
+    # 指紋が一致した患者のみ再利用し、記載が変わった患者と新規の患者は含めない
+    assert reused == {"P000": ("T1", "理由1"), "P001": ("T2", "理由2")}
+
+
+def test_reuse_previous_without_fingerprints(make_analyzer):
+    analyzer = make_analyzer(make_records(2))
+    assert analyzer._reuse_previous(COLUMN, {"P000": "abc"}) == {}
+    assert analyzer.set_previous_results(pd.DataFrame({"ID": ["P000"], COLUMN: ["T1"]}))
+    assert analyzer._reuse_previous(COLUMN, {"P000": "abc"}) == {}
+
+
+def test_fingerprints_change_with_version_and_text():
+    digests = ExcelAnalyzer._text_digests({"P1": "記載A", "P2": "記載B"})
+    fingerprints = ExcelAnalyzer._fingerprints("v1", digests)
+    assert fingerprints == ExcelAnalyzer._fingerprints("v1", ExcelAnalyzer._text_digests({"P1": "記載A", "P2": "記載B"}))
+    assert fingerprints["P1"] != ExcelAnalyzer._fingerprints("v2", digests)["P1"]
+    assert fingerprints["P1"] != ExcelAnalyzer._fingerprints("v1", ExcelAnalyzer._text_digests({"P1": "記載A2"}))["P1"]
+
+
+def test_incremental_run_only_analyzes_new_and_changed_patients(tmp_path, make_analyzer, fake_client):
+    df = make_records(6)
+    first = make_analyzer(df)
+    assert first.analyze_with_template(TEMPLATE_KEY)["success"]
+    previous_path = str(tmp_path / "previous.parquet")
+    assert first.save_results(previous_path)
+
+    # 1人に記載を追加し、1人を新規に追加する
+    new_rows = pd.DataFrame([
+        {"ID": "P000", "day": "2023-02-01", "text": "追加の記載"},
+        {"ID": "P100", "day": "2023-01-01", "text": "新規の患者"},
+    ])
+    fake_client.calls.clear()
+    second = make_analyzer(pd.concat([df, new_rows], ignore_index=True))
+    assert second.load_previous_results(previous_path)
+    assert second.analyze_with_template(TEMPLATE_KEY)["success"]
+
+    combined = second._combine_texts_by_id()
+    assert len(fake_client.calls) == 2
+    assert all(any(call.endswith(combined[id_val]) for call in fake_client.calls) for id_val in ("P000", "P100"))
+    results = second.df.drop_duplicates("ID").set_index("ID")[COLUMN]
+    assert results["P000"] == "追加の記載"
+    assert results["P100"] == "新規の患者"
+    previous = first.df.drop_duplicates("ID").set_index("ID")[COLUMN]
+    for id_val in ("P001", "P002", "P003", "P004", "P005"):
+        assert results[id_val] == previous[id_val]
+
+
+@pytest.mark.parametrize("change", ["temperature", "max_tokens", "model_name", "provider", "template"])
+def test_template_version_covers_generation_settings(make_analyzer, change):
+    analyzer = make_analyzer()
+    before = analyzer._template_key_version(TEMPLATE_KEY)
+    if change == "temperature":
+        analyzer.temperature = 0.7
+    elif change == "max_tokens":
+        analyzer.max_tokens = 1024
+    elif change == "model_name":
+        analyzer.model_name = "other-model"
+    elif change == "provider":
+        analyzer = make_analyzer(provider="vllm_offline")
+        analyzer.model_name = make_analyzer().model_name
+    else:
+        analyzer.templates[TEMPLATE_KEY] = {**analyzer.templates[TEMPLATE_KEY], "system_prompt": "変更したプロンプト"}
+    assert analyzer._template_key_version(TEMPLATE_KEY) != before
+
+
+def test_changed_temperature_reanalyzes_all_patients(tmp_path, make_analyzer, fake_client):
+    df = make_records(4)
+    first = make_analyzer(df)
+    assert first.analyze_with_template(TEMPLATE_KEY)["success"]
+    previous_path = str(tmp_path / "previous.parquet")
+    assert first.save_results(previous_path)
+
+    fake_client.calls.clear()
+    second = make_analyzer(df)
+    second.temperature = 0.7
+    assert second.load_previous_results(previous_path)
+    assert second.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert len(fake_client.calls) == 4
+
+
+def test_reused_results_keep_their_types(tmp_path, make_analyzer):
+    df = make_records(3)
+    first = make_analyzer(df)
+    assert first.analyze_with_template(TEMPLATE_KEY)["success"]
+    # 既定値（False）・文字列・JSONのオブジェクトが混在する結果
+    values = {"P000": False, "P001": "T2N0M0", "P002": {"T": "T2", "N": ["N0", "N1"]}}
+    first.df[COLUMN] = first.df["ID"].map(values).astype(object)
+    previous_path = str(tmp_path / "previous.parquet")
+    assert first.save_results(previous_path)
+
+    saved = ExcelAnalyzer.read_results(previous_path).set_index("ID")[COLUMN]
+    assert saved.to_dict() == values
+    assert saved["P000"] is False
+
+    second = make_analyzer(df)
+    assert second.load_previous_results(previous_path)
+    assert second.analyze_with_template(TEMPLATE_KEY)["success"]
+    reused = second.df.drop_duplicates("ID").set_index("ID")[COLUMN]
+    assert reused.to_dict() == values
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""バックグラウンドのジョブと、停止要求による分析の中止のテスト"""
+import threading
+
+import pytest
+
+from analyzer.jobs import (
+    JOB_CANCELLED, JOB_COMPLETED, JOB_FAILED, AnalysisCancelledError, AnalysisJob, CancellationToken
+)
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def test_cancellation_token():
+    token = CancellationToken()
+    token.raise_if_cancelled()
+    token.cancel()
+    assert token.cancelled
+    with pytest.raises(AnalysisCancelledError):
+        token.raise_if_cancelled()
+
+
+def test_job_runs_in_background_and_reports_progress():
+    release = threading.Event()
+
+    def target(job):
+        job.update_progress(done=1, total=2)
+        release.wait(5)
+        return "完了"
+
+    job = AnalysisJob(target, name="テスト").start()
+    assert job.running
+    release.set()
+    assert job.wait(5)
+
+    snapshot = job.snapshot()
+    assert (snapshot["state"], snapshot["done"], snapshot["total"]) == (JOB_COMPLETED, 1, 2)
+    assert job.result == "完了"
+    # 2回目の start では再実行しない
+    assert job.start() is job
+
+
+def test_job_records_failure(capsys):
+    def target(job):
+        raise RuntimeError("読み込みに失敗")
+
+    job = AnalysisJob(target).start()
+    assert job.wait(5)
+    assert job.state == JOB_FAILED
+    assert job.snapshot()["error"] == "読み込みに失敗"
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_cancel_stops_remaining_patients(make_analyzer, fake_client, use_async):
+    fake_client.chat.completions.delay = 0.01
+    analyzer = make_analyzer(make_records(30), max_workers=2, use_async=use_async)
+
+    def target(job):
+        analyzer.cancel_token = job.token
+
+        def on_progress(done, total, payload):
+            job.update_progress(done=done, total=total)
+            if done == 3:
+                job.cancel()
+
+        return analyzer.analyze_with_template(TEMPLATE_KEY, progress_callback=on_progress)
+
+    job = AnalysisJob(target).start()
+    assert job.wait(10)
+
+    assert job.state == JOB_CANCELLED
+    assert not job.result["success"]
+    # 停止の要求後は新しい呼び出しを開始しない（実行中の呼び出しの完了は待つ）
+    calls = len(fake_client.calls)
+    assert 3 <= calls < 30
+    reasons = analyzer.df.drop_duplicates("ID")[f"{COLUMN}_理由"]
+    assert reasons.eq("テスト").sum() == calls
+    assert reasons.eq("分析を停止したため未分析").sum() == 30 - calls
+
+
+def test_cancelled_run_resumes_remaining_patients(tmp_path, make_analyzer, fake_client):
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    df = make_records(10)
+    analyzer = make_analyzer(df, checkpoint_path=checkpoint_path)
+    run_id = analyzer.start_run()
+    analyzer.cancel_token = CancellationToken()
+
+    def on_progress(done, total, payload):
+        if done == 4:
+            analyzer.cancel_token.cancel()
+
+    assert not analyzer.analyze_with_template(TEMPLATE_KEY, progress_callback=on_progress)["success"]
+    assert len(fake_client.calls) == 4
+
+    # 停止した実行を再開すると、未分析の患者のみを分析する
+    resumed = make_analyzer(df, checkpoint_path=checkpoint_path)
+    assert resumed.resume_run(run_id, [TEMPLATE_KEY])[TEMPLATE_KEY]["success"]
+    assert len(fake_client.calls) == 10
+    assert resumed.df[f"{COLUMN}_理由"].eq("テスト").all()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""複数のvLLMサーバーへの振り分けとフェイルオーバーのテスト"""
+from collections import Counter
+
+import pytest
+
+from analyzer.backends import VLLMBackend
+from analyzer.load_balancer import EndpointPool, is_endpoint_failure, parse_endpoints
+from conftest import FakeClient, make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+class ServerError(Exception):
+    """HTTPステータスコードを持つSDKの例外を模したもの"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def test_parse_endpoints():
+    assert parse_endpoints(None) == ((None, 1.0),)
+    assert parse_endpoints("http://a/v1, http://b/v1") == (("http://a/v1", 1.0), ("http://b/v1", 1.0))
+    assert parse_endpoints("http://a/v1 2\nhttp://b/v1") == (("http://a/v1", 2.0), ("http://b/v1", 1.0))
+    assert parse_endpoints({"http://a/v1": 3}) == (("http://a/v1", 3.0),)
+    assert parse_endpoints(["http://a/v1", ("http://b/v1", 2)]) == (("http://a/v1", 1.0), ("http://b/v1", 2.0))
+    with pytest.raises(ValueError):
+        parse_endpoints({"http://a/v1": 0})
+    with pytest.raises(ValueError):
+        parse_endpoints("")
+
+
+def test_endpoint_failures_are_server_side_errors():
+    assert is_endpoint_failure(ConnectionError())
+    assert is_endpoint_failure(TimeoutError())
+    assert is_endpoint_failure(ServerError(503))
+    # 429や4xxはサーバーの障害ではないため、別のサーバーへは再送しない
+    assert not is_endpoint_failure(ServerError(429))
+    assert not is_endpoint_failure(ServerError(400))
+    assert not is_endpoint_failure(ValueError())
+
+
+def test_weighted_routing_follows_weights():
+    pool = EndpointPool((("a", 2.0), ("b", 1.0)), routing="weighted")
+    chosen = []
+    for _ in range(30):
+        endpoint = pool.select()
+        pool.release(endpoint)
+        chosen.append(endpoint.url)
+    assert Counter(chosen) == {"a": 20, "b": 10}
+    # 平滑化により同じサーバーに連続して偏らない
+    assert "aaa" not in "".join(chosen)
+
+
+def test_least_outstanding_prefers_idle_endpoints():
+    pool = EndpointPool((("a", 1.0), ("b", 1.0), ("c", 2.0)))
+    busy = [pool.select() for _ in range(4)]
+    # 重みで割った処理中の件数が均等になるように選ぶ
+    assert Counter(endpoint.url for endpoint in busy) == {"a": 1, "b": 1, "c": 2}
+    pool.release(busy[0])
+    assert pool.select() is busy[0]
+
+
+def test_failed_endpoint_is_skipped_until_it_recovers(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("analyzer.load_balancer.time.monotonic", lambda: now[0])
+    pool = EndpointPool((("a", 1.0), ("b", 1.0)), cooldown_sec=5.0)
+    a, b = pool.endpoints
+
+    pool.mark_failure(a, ConnectionError())
+    assert all(pool.select() is b for _ in range(3))
+    # 全てのサーバーが停止中の場合は、最も早く復帰するサーバーを使う
+    pool.mark_failure(b, ConnectionError())
+    assert pool.select() is a
+    pool.mark_success(a)
+    assert pool.status()[0]["healthy"]
+
+
+def backend_with_servers(urls, servers, **kwargs) -> VLLMBackend:
+    """接続先ごとの偽のクライアントを使うvLLMバックエンドを作成する"""
+    backend = VLLMBackend(base_url=list(urls), **kwargs)
+    backend.endpoint_client = lambda endpoint: servers[endpoint.url]
+    return backend
+
+
+def test_requests_fail_over_to_healthy_endpoints():
+    urls = ["http://failover-a/v1", "http://failover-b/v1"]
+    servers = {url: FakeClient() for url in urls}
+    servers[urls[0]].chat.completions.fail_on.add("記載")
+    backend = backend_with_servers(urls, servers)
+
+    for index in range(4):
+        result = backend.complete("model", "システム", f"記載{index}", 100)
+        assert result.text
+    # 最初のサーバーは1回失敗した後は振り分け対象から外れ、全ての応答は2台目が返す
+    assert len(servers[urls[0]].calls) == 1
+    assert len(servers[urls[1]].calls) == 4
+    assert [status["healthy"] for status in backend.pool.status()] == [False, True]
+
+
+def test_client_errors_are_not_failed_over():
+    urls = ["http://client-error-a/v1", "http://client-error-b/v1"]
+    servers = {url: FakeClient() for url in urls}
+    backend = backend_with_servers(urls, servers)
+
+    def reject(**kwargs):
+        raise ServerError(400)
+
+    for server in servers.values():
+        server.chat.completions.create = reject
+    with pytest.raises(ServerError):
+        backend.complete("model", "システム", "記載", 100)
+    assert all(status["healthy"] for status in backend.pool.status())
+
+
+def test_analysis_completes_when_one_server_is_down(make_analyzer):
+    urls = ["http://analysis-a/v1", "http://analysis-b/v1", "http://analysis-c/v1"]
+    servers = {url: FakeClient() for url in urls}
+    servers[urls[1]].chat.completions.fail_on.add("記載")
+    analyzer = make_analyzer(make_records(12), llm_server_url=urls, max_workers=4, max_retries=0)
+    analyzer.backend.client = None
+    analyzer.backend.endpoint_client = lambda endpoint: servers[endpoint.url]
+
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert analyzer.df[f"{COLUMN}_理由"].eq("テスト").all()
+    served = {url: len(server.calls) for url, server in servers.items()}
+    assert served[urls[0]] + served[urls[2]] == 12
+    assert served[urls[0]] and served[urls[2]]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""LLM呼び出しの計測値の集計と、JSON・Prometheus形式での出力のテスト"""
+import json
+
+import pytest
+
+from analyzer.metrics import METRIC_PREFIX, MetricsCollector, percentile
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+
+
+def test_percentile_interpolates():
+    assert percentile([], 0.5) is None
+    assert percentile([3.0], 0.99) == 3.0
+    assert percentile([4.0, 1.0, 3.0, 2.0], 0.5) == 2.5
+    assert percentile(list(range(101)), 0.95) == 95
+
+
+def test_collector_groups_by_template_and_provider():
+    collector = MetricsCollector()
+    for latency in (0.1, 0.2, 0.3):
+        collector.record_call("a", "openai", latency, queue_wait_sec=0.05, input_tokens=100, output_tokens=10, retries=1)
+    collector.record_call("a", "openai", 0.4, error=True)
+    collector.record_cache_hit("a", "openai")
+    collector.record_parse_failure("b", "openai")
+
+    groups = {group["template"]: group for group in collector.summary()}
+    assert set(groups) == {"a", "b"}
+    a = groups["a"]
+    assert (a["calls"], a["errors"], a["retries"], a["cache_hits"]) == (4, 1, 3, 1)
+    assert a["input_tokens"] == 300
+    assert a["latency_sec"]["count"] == 4
+    assert a["latency_sec"]["p50"] == pytest.approx(0.25)
+    assert a["queue_wait_sec"]["max"] == pytest.approx(0.05)
+    assert groups["b"]["parse_failures"] == 1
+
+
+def test_prometheus_exposition_format():
+    collector = MetricsCollector()
+    collector.record_call('テンプレート"1"', "vllm", 0.5, input_tokens=20)
+    text = collector.to_prometheus()
+
+    assert text.endswith("\n")
+    assert f"# TYPE {METRIC_PREFIX}_calls_total counter" in text
+    assert f'{METRIC_PREFIX}_calls_total{{template="テンプレート\\"1\\"",provider="vllm"}} 1' in text
+    assert f'{METRIC_PREFIX}_latency_seconds{{template="テンプレート\\"1\\"",provider="vllm",quantile="0.95"}} 0.5' in text
+    assert f'{METRIC_PREFIX}_latency_seconds_count{{template="テンプレート\\"1\\"",provider="vllm"}} 1' in text
+    # コメント以外の各行は「メトリクス名{ラベル} 値」の形式
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            assert name.startswith(METRIC_PREFIX)
+            float(value)
+
+
+def test_export_metrics_after_analysis(tmp_path, make_analyzer, fake_client):
+    fake_client.chat.completions.fail_on.add("記載1-")
+    df = make_records(4)
+    analyzer = make_analyzer(df, max_retries=0, cache_path=str(tmp_path / "cache.sqlite"))
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    # 2回目は成功した患者の応答がキャッシュから返る
+    analyzer.df = df.copy()
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+
+    json_path = tmp_path / "metrics.json"
+    assert analyzer.export_metrics(str(json_path))
+    content = json_path.read_text(encoding="utf-8")
+    (group,) = json.loads(content)["groups"]
+    assert (group["template"], group["provider"]) == (TEMPLATE_KEY, "vllm")
+    assert group["calls"] == 5
+    assert group["errors"] == 2
+    assert group["cache_hits"] == 3
+    # 計測値には患者のテキストを含めない
+    assert "記載" not in content
+
+    prometheus_path = tmp_path / "metrics.prom"
+    assert analyzer.export_metrics(str(prometheus_path), format="prometheus")
+    assert f'{METRIC_PREFIX}_cache_hits_total{{template="{TEMPLATE_KEY}",provider="vllm"}} 3' in prometheus_path.read_text(encoding="utf-8")
+
+
+def test_export_metrics_rejects_unknown_format(tmp_path, make_analyzer, capsys):
+    assert not make_analyzer().export_metrics(str(tmp_path / "metrics.txt"), format="csv")
+    assert "未対応の出力形式" in capsys.readouterr().out
+    assert not (tmp_path / "metrics.txt").exists()
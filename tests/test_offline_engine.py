@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""vLLMオフライン推論エンジンのバックエンド（vllm_offline）のテスト（エンジンは偽のものに置き換える）"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from analyzer import ExcelAnalyzer
+from conftest import TEMPLATE_PATH, make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+class FakeEngine:
+    """vllm.LLM.chat を模した推論エンジン（1回の chat に渡された会話の件数を記録する）"""
+
+    def __init__(self):
+        self.batches = []
+
+    def chat(self, conversations, params, use_tqdm=False):
+        self.batches.append(len(conversations))
+        outputs = []
+        for conversation in conversations:
+            outcome = {"result": conversation[-1]["content"].splitlines()[-1], "reason": "オフライン"}
+            completion = SimpleNamespace(text=json.dumps(outcome, ensure_ascii=False), token_ids=[0] * 3)
+            outputs.append(SimpleNamespace(prompt_token_ids=[0] * 10, outputs=[completion], num_cached_tokens=4))
+        return outputs
+
+
+@pytest.fixture
+def offline_analyzer():
+    analyzer = ExcelAnalyzer(template_path=TEMPLATE_PATH, provider="vllm_offline")
+    engine = FakeEngine()
+    analyzer.backend.engine = lambda model: engine
+    # vllm がインストールされていない環境でも動作するよう、生成パラメータはそのまま渡す
+    analyzer.backend.sampling_params = lambda max_tokens, schema=None: {"max_tokens": max_tokens, "schema": schema}
+    return analyzer, engine
+
+
+def test_all_patients_are_generated_in_one_engine_call(offline_analyzer):
+    analyzer, engine = offline_analyzer
+    analyzer.df = make_records(6)
+
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert engine.batches == [6]
+    results = analyzer.df.drop_duplicates("ID").set_index("ID")
+    assert results.at["P004", COLUMN] == "記載4-3"
+    assert results[f"{COLUMN}_理由"].eq("オフライン").all()
+    summary = analyzer.usage.summary()
+    assert (summary["requests"], summary["input_tokens"], summary["cached_input_tokens"]) == (6, 60, 24)
+    assert summary["cost_usd"] == 0
+
+
+def test_single_completion_uses_same_engine(offline_analyzer):
+    analyzer, engine = offline_analyzer
+    result = analyzer.backend.complete("model", "システム", "記載", 64)
+    assert json.loads(result.text)["result"] == "テキスト: 記載"
+    assert engine.batches == [1]
+    assert analyzer.backend.complete_batch("model", []) == []
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""プロバイダーのプロンプトキャッシュ（キャッシュ可能なプレフィックスの指定とキャッシュ読み込み分の集計）のテスト"""
+from types import SimpleNamespace
+
+import pytest
+
+from analyzer.backends import ClaudeBackend, DeepseekBackend, GeminiBackend, OpenAIBackend
+from conftest import make_records
+
+SYSTEM_PROMPT = "あなたは医療記録から情報を抽出する専門家です。"
+
+
+def test_openai_request_keeps_system_prompt_as_prefix():
+    backend = OpenAIBackend(api_key="x")
+    first = backend.build_request("gpt-4o-mini", SYSTEM_PROMPT, "記載1", 100)
+    second = backend.build_request("gpt-4o-mini", SYSTEM_PROMPT, "記載2", 100)
+    # 患者ごとに変わるテキストは後ろに置き、先頭（システムプロンプト）は呼び出し間で一致する
+    assert first["messages"][0] == second["messages"][0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert first["messages"][1]["content"].endswith("記載1")
+
+
+@pytest.mark.parametrize("backend_class, usage", [
+    (OpenAIBackend, SimpleNamespace(prompt_tokens=1200, completion_tokens=30,
+                                    prompt_tokens_details=SimpleNamespace(cached_tokens=1024))),
+    (DeepseekBackend, SimpleNamespace(prompt_tokens=1200, completion_tokens=30, prompt_cache_hit_tokens=1024)),
+])
+def test_openai_compatible_parse_reads_cached_tokens(backend_class, usage):
+    completion = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" {} "))], usage=usage)
+    result = backend_class(api_key="x").parse(completion)
+    assert result == ("{}", 1200, 30, 1024)
+
+
+def test_claude_marks_system_prompt_for_caching():
+    request = ClaudeBackend(api_key="x").build_request("claude-3-5-haiku-latest", SYSTEM_PROMPT, "記載", 100)
+    assert request["system"] == [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+
+def test_claude_input_tokens_include_cache_reads_and_writes():
+    usage = SimpleNamespace(input_tokens=50, output_tokens=20, cache_read_input_tokens=1000, cache_creation_input_tokens=200)
+    completion = SimpleNamespace(content=[SimpleNamespace(type="text", text="{}")], usage=usage)
+    result = ClaudeBackend(api_key="x").parse(completion)
+    assert result.input_tokens == 1250
+    assert result.cached_input_tokens == 1000
+
+
+class FakeCaches:
+    """Geminiの caches.create を模した呼び出し"""
+
+    def __init__(self, fail: bool = False):
+        self.created = []
+        self.fail = fail
+
+    def create(self, model, config):
+        self.created.append((model, config.system_instruction))
+        if self.fail:
+            raise RuntimeError("最小トークン数に満たないためキャッシュできません")
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+
+def gemini_backend(caches: FakeCaches) -> GeminiBackend:
+    backend = GeminiBackend(api_key="x")
+    backend.client = SimpleNamespace(caches=caches)
+    return backend
+
+
+def test_gemini_reuses_cached_content_per_prompt():
+    caches = FakeCaches()
+    backend = gemini_backend(caches)
+
+    first = backend.build_request("gemini-2.0-flash", SYSTEM_PROMPT, "記載1", 100)
+    second = backend.build_request("gemini-2.0-flash", SYSTEM_PROMPT, "記載2", 100)
+    other = backend.build_request("gemini-2.0-flash", "別のプロンプト", "記載3", 100)
+
+    assert first["config"].cached_content == second["config"].cached_content == "cachedContents/1"
+    assert first["config"].system_instruction is None
+    assert other["config"].cached_content == "cachedContents/2"
+    assert len(caches.created) == 2
+
+
+def test_gemini_falls_back_to_system_instruction(capsys):
+    caches = FakeCaches(fail=True)
+    backend = gemini_backend(caches)
+
+    for text in ("記載1", "記載2"):
+        request = backend.build_request("gemini-2.0-flash", SYSTEM_PROMPT, text, 100)
+        assert request["config"].cached_content is None
+        assert request["config"].system_instruction == SYSTEM_PROMPT
+    # 作成できなかったプロンプトは再作成を試みない
+    assert len(caches.created) == 1
+    assert "コンテキストキャッシュを作成できない" in capsys.readouterr().out
+
+
+def test_gemini_recreates_expired_cached_content(monkeypatch):
+    caches = FakeCaches()
+    backend = gemini_backend(caches)
+    assert backend.get_cached_content("gemini-2.0-flash", SYSTEM_PROMPT) == "cachedContents/1"
+
+    name, expires_at = backend._cached_contents[("gemini-2.0-flash", SYSTEM_PROMPT)]
+    monkeypatch.setattr("analyzer.backends.time.time", lambda: expires_at + 1)
+    assert backend.get_cached_content("gemini-2.0-flash", SYSTEM_PROMPT) == "cachedContents/2"
+
+
+def test_usage_tracks_cached_input_tokens(make_analyzer, fake_client):
+    usage = SimpleNamespace(prompt_tokens=1200, completion_tokens=30,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    create = fake_client.chat.completions.create
+
+    def create_with_usage(*args, **kwargs):
+        completion = create(*args, **kwargs)
+        completion.usage = usage
+        return completion
+
+    fake_client.chat.completions.create = create_with_usage
+    analyzer = make_analyzer(make_records(3))
+    assert analyzer.analyze_with_template("cancer_stage")["success"]
+    assert analyzer.usage.input_tokens == 3 * 1200
+    assert analyzer.usage.cached_input_tokens == 3 * 1024
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""TokenBucket・RateLimiter と get_retry_delay のテスト"""
+from types import SimpleNamespace
+
+import pytest
+
+from analyzer import rate_limiter
+from analyzer.rate_limiter import TokenBucket, get_retry_delay
+from conftest import make_records
+
+
+class FakeClock:
+    """time.monotonic の代わりに使う、手動で進める時計"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", fake)
+    return fake
+
+
+def api_error(status_code=None, headers=None):
+    """SDKの例外を模したオブジェクト（status_code と response.headers を持つ）"""
+    error = Exception("api error")
+    if status_code is not None:
+        error.status_code = status_code
+    error.response = SimpleNamespace(headers=headers or {})
+    return error
+
+
+class TestTokenBucket:
+    def test_burst_within_capacity_does_not_wait(self, clock):
+        bucket = TokenBucket(per_minute=60)
+        assert [bucket.reserve() for _ in range(60)] == [0.0] * 60
+
+    def test_wait_grows_with_deficit(self, clock):
+        bucket = TokenBucket(per_minute=60)  # 1秒に1トークン
+        for _ in range(60):
+            bucket.reserve()
+        assert bucket.reserve() == pytest.approx(1.0)
+        assert bucket.reserve() == pytest.approx(2.0)
+
+    def test_refills_over_time_up_to_capacity(self, clock):
+        bucket = TokenBucket(per_minute=60, capacity=10)
+        for _ in range(10):
+            bucket.reserve()
+        clock.now += 5
+        assert bucket.reserve(5) == 0.0
+        assert bucket.reserve() == pytest.approx(1.0)
+
+        # 長時間経過しても容量を超えて溜まらない
+        clock.now += 3600
+        assert bucket.reserve(10) == 0.0
+        assert bucket.reserve() > 0
+
+    def test_request_larger_than_capacity_is_clamped(self, clock):
+        bucket = TokenBucket(per_minute=600)
+        assert bucket.reserve(10_000) == 0.0
+        assert bucket.reserve(600) == pytest.approx(60.0)
+
+
+class TestGetRetryDelay:
+    @pytest.mark.parametrize("status_code", [400, 401, 404, 422])
+    def test_client_errors_are_not_retried(self, status_code):
+        assert get_retry_delay(api_error(status_code), attempt=0) is None
+
+    def test_errors_without_status_are_not_retried(self):
+        assert get_retry_delay(ValueError("invalid"), attempt=0) is None
+
+    @pytest.mark.parametrize("status_code", sorted(rate_limiter.RETRYABLE_STATUS_CODES))
+    def test_backoff_with_jitter(self, status_code):
+        for attempt in range(4):
+            delay = get_retry_delay(api_error(status_code), attempt=attempt, base_delay=1.0, max_delay=60.0)
+            assert 0.5 * 2 ** attempt <= delay <= 2 ** attempt
+
+    def test_backoff_is_capped(self):
+        assert get_retry_delay(api_error(429), attempt=20, base_delay=1.0, max_delay=8.0) <= 8.0
+
+    def test_retry_after_seconds(self):
+        assert get_retry_delay(api_error(429, {"retry-after": "7"}), attempt=0) == 7.0
+
+    def test_retry_after_ms_takes_precedence(self):
+        error = api_error(429, {"retry-after-ms": "1500", "retry-after": "7"})
+        assert get_retry_delay(error, attempt=0) == 1.5
+
+    def test_retry_after_http_date(self):
+        delay = get_retry_delay(api_error(503, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}), attempt=0)
+        assert delay == 0.0  # 過去の日時は待たない
+
+    def test_retry_after_is_capped(self):
+        assert get_retry_delay(api_error(429, {"retry-after": "3600"}), attempt=0, max_delay=60.0) == 60.0
+
+    def test_status_code_from_response(self):
+        error = Exception("overloaded")
+        error.response = SimpleNamespace(status_code=529, headers={"retry-after": "2"})
+        assert get_retry_delay(error, attempt=0) == 2.0
+
+
+class TestRateLimiter:
+    def test_backoff_pauses_all_callers(self, clock, monkeypatch):
+        slept = []
+        monkeypatch.setattr(rate_limiter.time, "sleep", slept.append)
+        limiter = rate_limiter.RateLimiter(requests_per_minute=None, tokens_per_minute=None)
+        assert limiter.acquire() == 0.0
+
+        limiter.backoff(5.0)
+        limiter.backoff(2.0)  # 短い待機で上書きしない
+        assert limiter.acquire() == pytest.approx(5.0)
+        assert slept == [pytest.approx(5.0)]
+
+    def test_token_budget_per_minute(self, clock, monkeypatch):
+        monkeypatch.setattr(rate_limiter.time, "sleep", lambda seconds: None)
+        limiter = rate_limiter.RateLimiter(requests_per_minute=600, tokens_per_minute=6000)
+        assert limiter.acquire(tokens=6000) == 0.0
+        assert limiter.acquire(tokens=600) == pytest.approx(6.0)
+
+
+def test_analyzer_retries_rate_limited_calls(make_analyzer, fake_client, monkeypatch):
+    monkeypatch.setattr(rate_limiter.time, "sleep", lambda seconds: None)
+    create = fake_client.chat.completions.create
+    attempts = []
+
+    def rate_limited_once(model, messages, **kwargs):
+        attempts.append(messages[-1]["content"])
+        if len(attempts) == 1:
+            raise api_error(429, {"retry-after": "0"})
+        return create(model, messages, **kwargs)
+
+    fake_client.chat.completions.create = rate_limited_once
+    analyzer = make_analyzer(make_records(1))
+    assert analyzer.analyze_with_template("cancer_stage")["success"]
+    assert len(attempts) == 2
+    assert analyzer.df["分析結果_cancer_stage_extract"].iloc[0] == "記載0-3"
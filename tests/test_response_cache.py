@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""ResponseCache のテスト"""
+import sqlite3
+
+import pytest
+
+from analyzer import response_cache
+from analyzer.response_cache import ResponseCache
+from conftest import make_records
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache" / "responses.sqlite"))
+    yield cache
+    cache.close()
+
+
+def test_make_key_is_order_independent_and_content_addressed():
+    key = ResponseCache.make_key(provider="openai", model="gpt-4o-mini", text="所見")
+    assert key == ResponseCache.make_key(text="所見", model="gpt-4o-mini", provider="openai")
+    assert key != ResponseCache.make_key(provider="openai", model="gpt-4o-mini", text="所見2")
+
+
+def test_set_and_get(cache):
+    assert cache.get("missing") is None
+    cache.set("key", '{"result": "T1"}')
+    assert cache.get("key") == '{"result": "T1"}'
+    cache.set("key", '{"result": "T2"}')
+    assert cache.get("key") == '{"result": "T2"}'
+    assert cache.stats() == {"hits": 2, "misses": 1, "errors": 0, "entries": 1}
+
+
+def test_persists_across_connections(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    first = ResponseCache(path)
+    first.set("key", "応答")
+    first.close()
+
+    second = ResponseCache(path)
+    assert second.get("key") == "応答"
+    second.close()
+
+
+def test_expired_entries_are_misses_and_evicted(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_age_days=1)
+    now = 1_700_000_000.0
+    monkeypatch.setattr(response_cache.time, "time", lambda: now)
+    cache.set("old", "古い応答")
+
+    now += 2 * 86400
+    assert cache.get("old") is None
+    cache.evict()
+    assert cache.stats()["entries"] == 0
+    cache.close()
+
+
+def test_evict_keeps_most_recently_accessed(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_entries=2, max_age_days=0)
+    now = 1_700_000_000.0
+    monkeypatch.setattr(response_cache.time, "time", lambda: now)
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+        now += 10
+
+    # 最終参照時刻の更新間隔より後に参照した "a" は残る
+    now += ResponseCache.ACCESS_UPDATE_INTERVAL_SEC + 1
+    assert cache.get("a") == "a"
+    cache.evict()
+
+    assert cache.stats()["entries"] == 2
+    assert cache.get("a") == "a"
+    assert cache.get("b") is None
+    assert cache.get("c") == "c"
+    cache.close()
+
+
+def test_locked_database_is_not_fatal(tmp_path, capsys):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path, timeout=0.1, journal_mode="DELETE")
+    cache.set("key", "応答")
+
+    # 別の接続が書き込みロックを保持している間は、保存に失敗しても例外を送出しない
+    other = sqlite3.connect(path)
+    other.execute("BEGIN EXCLUSIVE")
+    cache.set("other", "応答")
+    assert cache.get("key") is None
+    other.rollback()
+    other.close()
+
+    assert cache.errors == 2
+    assert "警告" in capsys.readouterr().out
+    assert cache.get("key") == "応答"
+    cache.close()
+
+
+def test_rerun_is_served_from_cache(tmp_path, make_analyzer, fake_client):
+    cache_path = str(tmp_path / "responses.sqlite")
+    df = make_records(5)
+    first = make_analyzer(df, cache_path=cache_path)
+    assert first.analyze_with_template("cancer_stage")["success"]
+    assert len(fake_client.calls) == 5
+
+    fake_client.calls.clear()
+    second = make_analyzer(df, cache_path=cache_path)
+    assert second.analyze_with_template("cancer_stage")["success"]
+    assert fake_client.calls == []
+    assert second.cache.stats()["hits"] == 5
+    column = "分析結果_cancer_stage_extract"
+    assert second.df[column].tolist() == first.df[column].tolist()
+
+    # モデルを変更するとキーが変わり、キャッシュは使われない
+    third = make_analyzer(df, cache_path=cache_path)
+    third.set_model("other-model")
+    assert third.analyze_with_template("cancer_stage")["success"]
+    assert len(fake_client.calls) == 5
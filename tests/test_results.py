@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""分析結果のデータフレームの作成と保存のテスト"""
+import pandas as pd
+
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def test_results_df_has_one_row_per_patient(make_analyzer):
+    df = make_records(5)
+    analyzer = make_analyzer(df)
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+
+    results = analyzer.get_results_df()
+    combined = analyzer.combined_texts
+    assert results["ID"].tolist() == list(combined)
+    assert results["text"].tolist() == list(combined.values())
+    assert results[COLUMN].tolist() == [f"記載{int(id_val[1:])}-3" for id_val in results["ID"]]
+    assert results[f"{COLUMN}_理由"].eq("テスト").all()
+
+
+def test_results_df_uses_first_row_of_each_patient(make_analyzer):
+    analyzer = make_analyzer(make_records(3))
+    analyzer.df[COLUMN] = range(len(analyzer.df))
+    first_rows = analyzer.df.drop_duplicates("ID").set_index("ID")[COLUMN]
+
+    results = analyzer.get_results_df().set_index("ID")[COLUMN]
+    pd.testing.assert_series_equal(results, first_rows.reindex(results.index), check_names=False)
+
+
+def test_results_df_without_analysis_columns(tmp_path, make_analyzer, capsys):
+    analyzer = make_analyzer(make_records(2))
+    assert analyzer.get_results_df().empty
+    assert not analyzer.save_results(str(tmp_path / "results.xlsx"))
+    assert "分析結果の列が見つかりません" in capsys.readouterr().out
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""シャードへの分割・部分結果の保存とまとめ・一括分析CLIの再開のテスト"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+from analyzer import ExcelAnalyzer
+from analyzer.jobs import CancellationToken
+from analyzer.sharding import find_partial_results, missing_shards, partial_result_path, shard_of
+from conftest import ROOT_DIR, TEMPLATE_PATH, make_records
+
+sys.path.insert(0, ROOT_DIR)
+import analyze_medical_records as cli  # noqa: E402
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def test_shards_partition_patients_and_merge_round_trip(tmp_path, make_analyzer):
+    df = make_records(40)
+    num_shards = 3
+
+    full = make_analyzer(df)
+    assert full.analyze_with_template(TEMPLATE_KEY)["success"]
+    expected = full.get_results_df().sort_values("ID").reset_index(drop=True)
+
+    partial_paths = []
+    shard_patients = []
+    for shard_index in range(num_shards):
+        analyzer = make_analyzer(df)
+        assert analyzer.select_shard(shard_index, num_shards)
+        patients = set(analyzer.df["ID"])
+        assert all(shard_of(id_val, num_shards) == shard_index for id_val in patients)
+        shard_patients.append(patients)
+        if analyzer.df.empty:
+            continue
+        assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+        path = str(tmp_path / f"part-{shard_index}.parquet")
+        assert analyzer.save_results(path)
+        partial_paths.append(path)
+
+    # 各患者はちょうど1つのシャードに入る
+    assert sum(len(patients) for patients in shard_patients) == df["ID"].nunique()
+    assert set().union(*shard_patients) == set(df["ID"])
+
+    output_path = str(tmp_path / "merged.parquet")
+    assert ExcelAnalyzer.merge_results(partial_paths, output_path, id_column="ID")
+    merged = ExcelAnalyzer.read_results(output_path).reset_index(drop=True)
+    pd.testing.assert_frame_equal(merged[expected.columns], expected, check_dtype=False)
+
+
+def test_select_shard_rejects_invalid_index(make_analyzer):
+    analyzer = make_analyzer(make_records(3))
+    assert not analyzer.select_shard(3, 3)
+    assert len(analyzer.df) == 9
+
+
+
+def test_partial_results_ignore_temporary_files(tmp_path):
+    parts_dir = str(tmp_path)
+    complete = partial_result_path(parts_dir, 0, 2)
+    pd.DataFrame({"ID": ["P000"]}).to_parquet(complete)
+    # 書き込み中（または書き込み中に中断した）一時ファイルは完了した部分結果として扱わない
+    (tmp_path / "part-00001-of-00002.tmp-123-456.parquet").write_bytes(b"")
+    (tmp_path / "part-00001-of-00003.parquet").write_bytes(b"")
+
+    assert find_partial_results(parts_dir, 2) == {0: complete}
+    assert missing_shards(parts_dir, 2) == [1]
+
+
+def test_interrupted_write_leaves_no_file(tmp_path, make_analyzer, monkeypatch):
+    analyzer = make_analyzer(make_records(3))
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+
+    def broken_to_parquet(df, path, **kwargs):
+        with open(path, "wb") as f:
+            f.write(b"PAR1")
+        raise OSError("ディスクがいっぱいです")
+
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", broken_to_parquet)
+    path = partial_result_path(str(tmp_path), 0, 1)
+    assert not analyzer.save_results(path)
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.fixture
+def cli_run(tmp_path, fake_client, monkeypatch):
+    """偽のクライアントで一括分析CLIを実行する関数を返す（interrupted のシャードは分析の途中で停止させる）"""
+    input_path = str(tmp_path / "input.csv")
+    make_records(30).to_csv(input_path, index=False)
+    output_path = str(tmp_path / "merged.parquet")
+    state = {"interrupted": set(), "analyzed": []}
+    create_analyzer = cli.create_analyzer
+
+    def create_fake_analyzer(args, processes=1, shard_index=None):
+        analyzer = create_analyzer(args, processes, shard_index)
+        analyzer.client = fake_client
+        state["analyzed"].append(shard_index)
+        if shard_index in state["interrupted"]:
+            analyzer.cancel_token = CancellationToken()
+            analyzer.cancel_token.cancel()
+        return analyzer
+
+    monkeypatch.setattr(cli, "create_analyzer", create_fake_analyzer)
+
+    def run(*extra):
+        return cli.main(["run", "--input", input_path, "--output", output_path, "--template-path", TEMPLATE_PATH,
+                         "--templates", TEMPLATE_KEY, "--cache-path", "", "--num-shards", "3", *extra])
+
+    return run, state, output_path
+
+
+def test_incomplete_shard_is_not_saved_and_rerun(cli_run, capsys):
+    run, state, output_path = cli_run
+    parts_dir = cli.default_parts_dir(output_path)
+    state["interrupted"].add(1)
+
+    assert run() == 1
+    # 分析が完了しなかったシャードの部分結果は保存せず、まとめも行わない
+    assert sorted(find_partial_results(parts_dir, 3)) == [0, 2]
+    assert "部分結果を保存しません" in capsys.readouterr().out
+    assert cli.main(["merge", "--output", output_path, "--num-shards", "3"]) == 1
+    assert not os.path.exists(output_path)
+
+    # 再開すると未完了のシャードのみを分析してまとめる
+    state["interrupted"].clear()
+    state["analyzed"].clear()
+    assert run("--skip-existing") == 0
+    assert state["analyzed"] == [1]
+    merged = ExcelAnalyzer.read_results(output_path)
+    assert sorted(merged["ID"]) == [f"P{i:03d}" for i in range(30)]
+    assert merged[f"{COLUMN}_理由"].eq("テスト").all()
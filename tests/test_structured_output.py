@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""構造化出力（スキーマの指定・応答の解析と検証・修復の依頼）のテスト"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from analyzer.structured_output import (
+    DEFAULT_RESULT_SCHEMA, check_response, is_strict_compatible, parse_json, strip_code_fence, to_gemini_schema
+)
+from conftest import make_records
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+@pytest.mark.parametrize("response, expected", [
+    ('{"result": "IA"}', '{"result": "IA"}'),
+    ('```json\n{"result": "IA"}\n```', '{"result": "IA"}'),
+    ('  ```\n{"result": "IA"}\n```  ', '{"result": "IA"}'),
+    ('```json{"result": "IA"}```', '{"result": "IA"}'),
+    # 出力が途中で切れて末尾のフェンスがない場合
+    ('```json\n{"result": "IA"', '{"result": "IA"'),
+])
+def test_strip_code_fence(response, expected):
+    assert strip_code_fence(response) == expected
+
+
+def test_strip_code_fence_keeps_fences_inside_values():
+    value = {"result": "所見: ```json ... ```", "reason": "```"}
+    response = "```json\n" + json.dumps(value, ensure_ascii=False) + "\n```"
+    assert parse_json(response) == value
+    assert parse_json(json.dumps(value, ensure_ascii=False)) == value
+
+
+def test_parse_json_ignores_surrounding_text():
+    assert parse_json('結果は以下の通りです。\n{"result": "IA", "reason": "記載"}\n以上です。') == {"result": "IA", "reason": "記載"}
+    with pytest.raises(json.JSONDecodeError):
+        parse_json("該当なし")
+
+
+def test_check_response_reports_schema_errors():
+    value, error = check_response('{"result": "IA", "reason": "記載"}', DEFAULT_RESULT_SCHEMA)
+    assert error is None
+    assert value == {"result": "IA", "reason": "記載"}
+
+    _, error = check_response('{"result": 1, "extra": true}', DEFAULT_RESULT_SCHEMA)
+    assert "$.result" in error
+    assert "$.reason" in error
+    assert "$.extra" in error
+
+    _, error = check_response("IA期です", DEFAULT_RESULT_SCHEMA)
+    assert "JSONとして解析できません" in error
+
+
+def test_strict_compatibility_and_gemini_schema():
+    assert is_strict_compatible(DEFAULT_RESULT_SCHEMA)
+    assert not is_strict_compatible({"type": "object", "properties": {"a": {"type": "string"}}, "required": []})
+
+    converted = to_gemini_schema({"type": "object", "properties": {"a": {"type": ["string", "null"]}},
+                                  "additionalProperties": False})
+    assert converted == {"type": "object", "properties": {"a": {"type": "string", "nullable": True}}}
+
+
+def test_schema_is_sent_with_each_request(make_analyzer, fake_client):
+    captured = []
+    create = fake_client.chat.completions.create
+
+    def capture(*args, **kwargs):
+        captured.append(kwargs)
+        return create(*args, **kwargs)
+
+    fake_client.chat.completions.create = capture
+    analyzer = make_analyzer(make_records(2))
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert captured
+    assert all(kwargs["extra_body"]["guided_json"]["required"] == ["result", "reason"] for kwargs in captured)
+
+
+def replace_responses(fake_client, responses):
+    """偽のクライアントの応答を、指定した応答を順に返す呼び出しに置き換える（記録した呼び出しのリストを返す）"""
+    calls = []
+
+    def create(model, messages, **kwargs):
+        calls.append(messages)
+        message = SimpleNamespace(content=responses[min(len(calls), len(responses)) - 1])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    fake_client.chat.completions.create = create
+    return calls
+
+
+def test_invalid_response_is_repaired_once(make_analyzer, fake_client, capsys):
+    calls = replace_responses(fake_client, ["IA期です", '```json\n{"result": "IA", "reason": "修復"}\n```'])
+    analyzer = make_analyzer(make_records(1))
+
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    assert len(calls) == 2
+    # 修復の依頼には問題点とスキーマを示し、元の応答をそのまま渡す
+    assert "JSONとして解析できません" in calls[1][0]["content"]
+    assert calls[1][1]["content"].endswith("IA期です")
+    assert analyzer.df[COLUMN].eq("IA").all()
+    assert analyzer.df[f"{COLUMN}_理由"].eq("修復").all()
+    assert "修復を依頼します" in capsys.readouterr().out
+
+
+def test_unrepairable_response_is_kept_as_json_error(make_analyzer, fake_client):
+    calls = replace_responses(fake_client, ["IA期です"])
+    analyzer = make_analyzer(make_records(1))
+
+    assert analyzer.analyze_with_template(TEMPLATE_KEY)["success"]
+    # 修復は1回だけ依頼する
+    assert len(calls) == 2
+    assert analyzer.df[COLUMN].eq("IA期です").all()
+    assert analyzer.df[f"{COLUMN}_理由"].eq("JSONエラー").all()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""使用量の集計・予算上限による中止・実行前の見積もりのテスト"""
+import pandas as pd
+import pytest
+
+from analyzer import ExcelAnalyzer
+from analyzer.usage import BudgetExceededError, UsageTracker, estimate_cost
+from conftest import TEMPLATE_PATH
+
+TEMPLATE_KEY = "cancer_stage"
+COLUMN = "分析結果_cancer_stage_extract"
+
+
+def priced_analyzer(make_analyzer, df, budget_usd, **kwargs):
+    """偽のクライアントを使いつつ、料金が既知のモデルとして使用量を集計する分析器を作成する"""
+    analyzer = make_analyzer(df, **kwargs)
+    analyzer.provider = "openai"
+    analyzer.model_name = "gpt-4o-mini"
+    analyzer.usage.budget_usd = budget_usd
+    return analyzer
+
+
+@pytest.mark.parametrize("max_workers", [1, 16])
+def test_budget_stops_remaining_patients(make_analyzer, fake_client, max_workers):
+    df = pd.DataFrame([{"ID": f"P{i:03d}", "day": "2023-01-01", "text": "肺癌の診断" * 50} for i in range(200)])
+    analyzer = priced_analyzer(make_analyzer, df, 0.0005, max_workers=max_workers)
+
+    result = analyzer.analyze_with_template(TEMPLATE_KEY)
+
+    assert not result["success"]
+    assert analyzer.usage.budget_exceeded()
+    # 見込み料金を予約してから呼び出すため、並列実行でも超過は最後に開始した1回分までに収まり、予約はすべて解放される
+    cost_per_call = analyzer.usage.cost_usd / analyzer.usage.requests
+    assert analyzer.usage.cost_usd < 0.0005 + cost_per_call
+    assert analyzer.usage.reserved_usd == 0
+    assert 0 < len(fake_client.calls) < 200
+    reasons = analyzer.df.drop_duplicates("ID")[f"{COLUMN}_理由"]
+    assert reasons.eq("予算上限に達したため未分析").sum() == 200 - len(fake_client.calls)
+
+
+def test_reserve_refuses_when_budget_is_committed():
+    tracker = UsageTracker(budget_usd=1.0)
+    first = tracker.reserve(0.6)
+    second = tracker.reserve(0.6)
+    # 使用額と予約額の合計が上限に達した後は呼び出しを開始しない
+    with pytest.raises(BudgetExceededError):
+        tracker.reserve(0.1)
+    assert tracker.budget_exceeded()
+
+    tracker.release(first)
+    tracker.release(second)
+    assert tracker.reserved_usd == 0
+
+
+def test_budget_counts_recorded_cost():
+    tracker = UsageTracker(budget_usd=0.01)
+    tracker.record(1000, 100, 0.004)
+    tracker.check_budget()
+    tracker.record(1000, 100, 0.007)
+    with pytest.raises(BudgetExceededError):
+        tracker.check_budget()
+    assert tracker.summary()["requests"] == 2
+
+
+def test_cached_input_tokens_are_discounted():
+    full = estimate_cost("openai", "gpt-4o-mini", 10_000, 0)
+    cached = estimate_cost("openai", "gpt-4o-mini", 10_000, 0, cached_input_tokens=10_000)
+    assert cached < full
+    assert estimate_cost("openai", "unknown-model", 10_000, 0) is None
+    assert estimate_cost("vllm", "any-model", 10_000, 1_000) == 0
+
+
+def test_unpriced_model_warns_that_budget_is_ignored(capsys):
+    analyzer = ExcelAnalyzer(template_path=TEMPLATE_PATH, provider="openai", api_key="x", budget_usd=1.0)
+    capsys.readouterr()
+
+    analyzer.set_model("unknown-model")
+    assert "予算上限" in capsys.readouterr().out
+    analyzer.set_model("gpt-4o-mini")
+    assert "予算上限" not in capsys.readouterr().out
+
+
+def test_estimate_run_counts_requests_and_tokens(make_analyzer):
+    df = pd.DataFrame([{"ID": f"P{i}", "day": "2023-01-01", "text": "肺癌の診断"} for i in range(4)])
+    analyzer = priced_analyzer(make_analyzer, df, None)
+
+    single = analyzer.estimate_run([TEMPLATE_KEY])
+    assert single["patients"] == 4
+    assert single["requests"] == 4
+    assert single["input_tokens"] > 0
+    assert single["max_output_tokens"] == 4 * analyzer.max_tokens
+    assert 0 < single["estimated_cost_usd"] <= single["max_cost_usd"]
+
+    keys = [TEMPLATE_KEY, "cancer_diagnosis"]
+    assert analyzer.estimate_run(keys)["requests"] == 8
+    # まとめて実行する場合は患者ごとに1回だけ呼び出す
+    assert analyzer.estimate_run(keys, fused=True)["requests"] == 4